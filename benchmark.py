@@ -0,0 +1,328 @@
+'''
+File: benchmark.py
+Author: listenzcc
+Date: 2023-01-12
+
+The benchmark of the encode -> send -> receive -> store -> serve pipeline.
+Every stage is measured in isolation, and the pipeline is measured end-to-end over the loopback.
+The results are printed as the JSON lines, or written into the output file.
+
+Usage:
+    python benchmark.py --channels 64 256 --sample-rates 1000 8000 --clients 1 4 16 --output bench_output.txt
+'''
+
+# %%
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import numpy as np
+
+from main_setup import main_setup
+from coding_toolbox import generate_package, encode_header, decode_header, decode_body, pack_body, unpack_body, compression_flags, header_codec, header_codec_v2
+from eeg_data_set import DataSet
+from eeg_generator import SyntheticSource
+from signal_sender import SocketServer, AsyncSocketServer
+from data_center import SocketClient, Stream, WebsocketServer, default_device, parse_request
+
+# %%
+
+
+def measure(fn, number):
+    '''
+    Measure the duration of every call of the function
+
+    Args:
+        :param: fn: The function to call;
+        :param: number: The number of the calls.
+
+    Return:
+        :return: The dict of the calls, mean, p50, p99 and max durations in microseconds.
+    '''
+    durations = np.zeros(number)
+    for i in range(number):
+        t = time.perf_counter()
+        fn()
+        durations[i] = time.perf_counter() - t
+    durations *= 1e6
+    return dict(calls=number,
+                mean_us=float(np.mean(durations)),
+                p50_us=float(np.percentile(durations, 50)),
+                p99_us=float(np.percentile(durations, 99)),
+                max_us=float(np.max(durations)))
+
+
+class Benchmark(object):
+    '''
+    The benchmark of one configuration of channels, sample rate and clients.
+    '''
+
+    def __init__(self, channels, sample_rate, clients, interval=main_setup['interval'], number=200):
+        '''
+        Args:
+            :param: channels: The channels of the package;
+            :param: sample_rate: The sample rate;
+            :param: clients: The number of the clients of the signal sender and the data center;
+            :param: interval: The interval of the package in milliseconds;
+            :param: number: The number of the calls of every stage.
+        '''
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.clients = clients
+        self.interval = interval
+        self.samples = int(interval / 1000 * sample_rate)
+        self.number = number
+        self.results = []
+
+    def record(self, stage, result):
+        '''
+        Record the result of the stage
+
+        Args:
+            :param: stage: The name of the stage;
+            :param: result: The dict of the result.
+        '''
+        record = dict(stage=stage, channels=self.channels, sample_rate=self.sample_rate,
+                      clients=self.clients, samples=self.samples)
+        record.update(result)
+        if 'mean_us' in record and record['mean_us'] > 0:
+            record['samples_per_second'] = record.get('packages', 1) * self.samples * \
+                1e6 / record['mean_us']
+        self.results.append(record)
+        return record
+
+    def header(self):
+        '''
+        Return the header codec and the header of the configuration,
+        the version 1 is used only for the shape and sample rate of the main_setup, since its receiver assumes them.
+        '''
+        n, k, q, code, data = generate_package(0, self.channels, self.samples)
+        samples = int(main_setup['interval'] / 1000 * main_setup['sample_rate'])
+        if k > 0xFFFF or self.channels != main_setup['channels'] or self.samples != samples or self.sample_rate != main_setup['sample_rate']:
+            return header_codec_v2, header_codec_v2.pack(n, k, q, self.channels, self.samples, sample_rate=self.sample_rate)
+        return header_codec, encode_header(n, k, q)
+
+    def run_codec(self):
+        ''' Measure the generate, header and body codec '''
+        self.record('generate_package', measure(
+            lambda: generate_package(0, self.channels, self.samples), self.number))
+
+        n, k, q, code, data = generate_package(0, self.channels, self.samples)
+        codec, header = self.header()
+        self.record('encode_header', measure(
+            lambda: codec.pack(n, k, q) if codec is header_codec else codec.pack(n, k, q, self.channels, self.samples, sample_rate=self.sample_rate), self.number))
+        self.record('decode_header', measure(
+            lambda: decode_header(header), self.number))
+        self.record('decode_body', measure(
+            lambda: decode_body(code, self.channels), self.number))
+
+        # The packed bodies of the synthetic signal, the random package is not compressible as the EEG
+        data = SyntheticSource(self.channels, self.sample_rate).read(self.samples)
+        for compression in ['delta', 'delta+zlib']:
+            flags = compression_flags[compression]
+            packed = pack_body(data, flags)
+            for stage, fn in [('pack_body', lambda: pack_body(data, flags)),
+                              ('unpack_body', lambda: unpack_body(packed, self.channels, data.dtype, flags))]:
+                result = measure(fn, self.number)
+                result['compression'] = compression
+                result['ratio'] = data.nbytes / len(packed)
+                self.record(stage, result)
+
+        stream = b''.join([header + code] * 100)
+        result = measure(lambda: codec.scan(stream), self.number)
+        result['packages'] = 100
+        self.record('scan_headers', result)
+
+    def run_dataset(self):
+        ''' Measure the dataset append and get_latest '''
+        dataset = DataSet(self.channels, self.samples,
+                          capacity=int(60 * 1000 / self.interval))
+        n, k, q, code, data = generate_package(0, self.channels, self.samples)
+        data = decode_body(code, self.channels)
+        self.record('dataset_append', measure(
+            lambda: dataset.append(0, q, q, data), dataset.capacity))
+
+        latest = int(4 * 1000 / self.interval)
+        self.record('dataset_get_latest', measure(
+            lambda: dataset.get_latest(latest), self.number))
+
+        server = WebsocketServer({default_device: Stream(default_device, dataset)})
+        for fmt in ['binary', 'json']:
+            request = parse_request(json.dumps(dict(latest=latest, format=fmt)))
+            code = server.serialize(request)
+            result = measure(lambda: server.serialize(
+                request), max(5, self.number // 20))
+            result['format'] = fmt
+            result['bytes'] = len(code)
+            result['packages'] = latest
+            self.record('websocket_serialize', result)
+
+    def _start_server(self, server_class):
+        '''
+        Start the signal sender on the free port with the clients draining it
+
+        Args:
+            :param: server_class: The class of the signal sender server.
+
+        Return:
+            :return: server, sockets, received: The server, the client sockets and the received bytes.
+        '''
+        server = server_class()
+        server.port = 0
+        if server_class is SocketServer:
+            server.bind()
+            server.port = server.server.getsockname()[1]
+            server.handling_sessions()
+        else:
+            server.port = self._free_port()
+            server.start()
+
+        received = [0] * self.clients
+        sockets = []
+
+        def _drain(i, client):
+            while True:
+                try:
+                    buffer = client.recv(1024 * 1024)
+                except OSError:
+                    break
+                if not buffer:
+                    break
+                received[i] += len(buffer)
+
+        for i in range(self.clients):
+            client = socket.create_connection((server.host, server.port))
+            sockets.append(client)
+            threading.Thread(target=_drain, args=(
+                i, client), daemon=True).start()
+
+        t = time.time()
+        while len([e for e in server.sessions if getattr(e, 'is_connected', False)]) < self.clients and time.time() - t < 5:
+            time.sleep(0.01)
+        return server, sockets, received
+
+    def _free_port(self):
+        ''' Find the free port of the localhost '''
+        with socket.socket() as s:
+            s.bind(('localhost', 0))
+            return s.getsockname()[1]
+
+    def run_send(self):
+        ''' Measure the signal sender broadcasting to the clients '''
+        codec, header = self.header()
+        n, k, q, code, data = generate_package(0, self.channels, self.samples)
+        buffer = header + code
+
+        for server_class in [SocketServer, AsyncSocketServer]:
+            server, sockets, received = self._start_server(server_class)
+            result = measure(lambda: server.send(buffer), self.number)
+            time.sleep(0.2)
+            result['server'] = server_class.__name__
+            result['received_ratio'] = sum(received) / \
+                (len(buffer) * self.number * self.clients)
+            self.record('server_send', result)
+            for client in sockets:
+                client.close()
+            server.close()
+
+    def run_end_to_end(self):
+        ''' Measure the sender -> receiver -> dataset pipeline at the max speed '''
+        codec, header = self.header()
+        packages = []
+        for i in range(self.number):
+            n, k, q, code, data = generate_package(
+                i, self.channels, self.samples)
+            packages.append((n, k, code))
+
+        server = SocketServer()
+        server.port = 0
+        server.bind()
+        server.port = server.server.getsockname()[1]
+        server.handling_sessions()
+
+        dataset = DataSet(self.channels, self.samples,
+                          capacity=self.number, sample_rate=self.sample_rate)
+        client = SocketClient()
+        client.port = server.port
+        try:
+            client.connect()
+            client.receiving(dataset)
+            while not server.sessions:
+                time.sleep(0.01)
+
+            t = time.perf_counter()
+            for n, k, code in packages:
+                if codec is header_codec:
+                    header = codec.pack(n, k, time.time())
+                else:
+                    header = codec.pack(n, k, time.time(),
+                                        self.channels, self.samples, sample_rate=self.sample_rate)
+                server.send(header + code)
+
+            while dataset.count < self.number and time.perf_counter() - t < 30:
+                time.sleep(0.001)
+            duration = time.perf_counter() - t
+        finally:
+            client.keep_receiving = False
+            if hasattr(client, 'client'):
+                client.client.close()
+            server.close()
+
+        segments = dataset.get_latest(dataset.count)
+        latency = (segments.query2 - segments.query) * 1e6
+
+        if (dataset.samples, dataset.channels) != (self.samples, self.channels):
+            raise RuntimeError('The packages of {} x {} are received as {} x {}'.format(
+                self.samples, self.channels, dataset.samples, dataset.channels))
+
+        self.record('end_to_end', dict(
+            packages=int(dataset.count),
+            packages_per_second=dataset.count / duration,
+            samples_per_second=dataset.count * self.samples / duration,
+            latency_mean_us=float(np.mean(latency)) if len(latency) else 0,
+            latency_p99_us=float(np.percentile(latency, 99)) if len(latency) else 0))
+
+    def run(self, stages):
+        '''
+        Run the stages
+
+        Args:
+            :param: stages: The list of the stages, codec, dataset, send and end_to_end.
+        '''
+        for stage in stages:
+            getattr(self, 'run_{}'.format(stage))()
+        return self.results
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the pipeline')
+    parser.add_argument('--channels', type=int, nargs='+', default=[64])
+    parser.add_argument('--sample-rates', type=int,
+                        nargs='+', default=[main_setup['sample_rate']])
+    parser.add_argument('--clients', type=int, nargs='+', default=[1])
+    parser.add_argument('--interval', type=int,
+                        default=main_setup['interval'])
+    parser.add_argument('--number', type=int, default=200)
+    parser.add_argument('--stages', nargs='+',
+                        default=['codec', 'dataset', 'send', 'end_to_end'])
+    parser.add_argument('--output', default=None,
+                        help='The output file of the JSON lines, default is the stdout')
+    args = parser.parse_args()
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+
+    for channels in args.channels:
+        for sample_rate in args.sample_rates:
+            for clients in args.clients:
+                benchmark = Benchmark(channels, sample_rate, clients,
+                                      args.interval, args.number)
+                results = benchmark.run(args.stages)
+                for result in results:
+                    output.write(json.dumps(result) + '\n')
+                output.flush()
+
+    if args.output:
+        output.close()
@@ -1,10 +1,11 @@
 
 # %%
 import time
+import zlib
 import struct
 import numpy as np
 
-from main_setup import main_setup, logger
+from main_setup import main_setup, logger, LogSampler
 
 # %%
 channels = main_setup['channels']
@@ -13,6 +14,17 @@ sample_rate = main_setup['sample_rate']
 data_length = int(interval / 1000 * sample_rate)
 header_length = main_setup['header_length']
 
+# The samples are transferred as little-endian int32
+sample_dtype = np.dtype('<i4')
+
+# The dtype codes of the samples in the protocol version 2 and the frame
+sample_dtypes = {
+    0: np.dtype('<i4'),
+    1: np.dtype('<f4'),
+    2: np.dtype('<i2'),
+}
+sample_dtype_codes = {v: k for k, v in sample_dtypes.items()}
+
 # %%
 
 '''
@@ -20,6 +32,242 @@ Header encoding and decoding
 '''
 
 
+class HeaderCodec(object):
+    '''
+    Precompiled codec of the package header.
+
+    The header mixes the byte orders, b'data' + (>L n) + (>H k) + (<d q),
+    so it is compiled into the big-endian head and the little-endian stamp,
+    and the numpy dtype of the same layout is used for the batch scanning.
+    '''
+
+    magic = struct.pack('8s', b'data')
+
+    def __init__(self):
+        self.head = struct.Struct('>8sLH')
+        self.stamp = struct.Struct('<d')
+        self.size = self.head.size + self.stamp.size
+        self.dtype = np.dtype([('s', 'S8'), ('n', '>u4'),
+                               ('k', '>u2'), ('q', '<f8')])
+
+        if not self.size == header_length:
+            logger.error('Header codec has {} bytes, but header_length is {}'.format(
+                self.size, header_length))
+
+    def pack(self, n, k, q):
+        '''
+        Pack the header into new bytes
+
+        Args:
+            :param: n: the package id n;
+            :param: k: The length of the bytes;
+            :param: q: The time stamp of the package;
+
+        Return:
+            :return: The encoded header
+        '''
+        return self.head.pack(self.magic, n, k) + self.stamp.pack(q)
+
+    def pack_into(self, buffer, offset, n, k, q):
+        '''
+        Pack the header into the buffer at the offset
+
+        Args:
+            :param: buffer: The writable buffer;
+            :param: offset: The offset of the header in the buffer;
+            :param: n: the package id n;
+            :param: k: The length of the bytes;
+            :param: q: The time stamp of the package;
+        '''
+        self.head.pack_into(buffer, offset, self.magic, n, k)
+        self.stamp.pack_into(buffer, offset + self.head.size, q)
+
+    def unpack_from(self, buffer, offset=0):
+        '''
+        Unpack the header from the buffer at the offset
+
+        Args:
+            :param: buffer: The buffer;
+            :param: offset: The offset of the header in the buffer.
+
+        Return:
+            :return: s, n, k, q: The leading string, package id, bytes length and time stamp.
+        '''
+        s, n, k = self.head.unpack_from(buffer, offset)
+        q, = self.stamp.unpack_from(buffer, offset + self.head.size)
+        return s, n, k, q
+
+    def header_dict(self, output):
+        '''
+        Convert the unpacked header into the dict
+
+        Args:
+            :param: output: The unpacked header.
+
+        Return:
+            :return: The dict of s, n, k and q.
+        '''
+        s, n, k, q = output
+        return dict(s=s, n=n, k=k, q=q)
+
+    def scan(self, buffer, offset=0):
+        '''
+        Scan the back-to-back packages in the contiguous buffer.
+        The scanning stops at the first incomplete or invalid package.
+
+        Args:
+            :param: buffer: The buffer holding the packages;
+            :param: offset: The offset of the first package in the buffer.
+
+        Return:
+            :return: n: The array of the package ids;
+            :return: k: The array of the bytes lengths;
+            :return: q: The array of the time stamps;
+            :return: offsets: The array of the body offsets in the buffer;
+            :return: end: The offset after the last complete package.
+        '''
+        total = len(buffer)
+
+        # Fast path, the packages share the same length,
+        # so the headers are read as the strided view at once
+        if total - offset >= self.size:
+            s, _, k, _ = self.unpack_from(buffer, offset)[:4]
+            stride = self.size + k
+            count = (total - offset) // stride
+            if s == self.magic and count > 0:
+                headers = np.ndarray((count,), dtype=self.dtype, buffer=buffer,
+                                     offset=offset, strides=(stride,))
+                if np.all(headers['k'] == k) and np.all(headers['s'] == self.magic):
+                    offsets = offset + self.size + \
+                        np.arange(count, dtype=np.int64) * stride
+                    return (headers['n'].astype(np.int64), headers['k'].astype(np.int64),
+                            headers['q'].astype(np.float64), offsets,
+                            offset + count * stride)
+
+        # Slow path, walk through the packages one by one
+        ns, ks, qs, offsets = [], [], [], []
+        while total - offset >= self.size:
+            s, n, k, q = self.unpack_from(buffer, offset)[:4]
+            if not s == self.magic:
+                logger.error('Invalid header at {}: {}'.format(offset, s))
+                break
+            if total - offset < self.size + k:
+                break
+            ns.append(n)
+            ks.append(k)
+            qs.append(q)
+            offsets.append(offset + self.size)
+            offset += self.size + k
+
+        return (np.array(ns, dtype=np.int64), np.array(ks, dtype=np.int64),
+                np.array(qs, dtype=np.float64), np.array(offsets, dtype=np.int64),
+                offset)
+
+
+class HeaderCodecV2(HeaderCodec):
+    '''
+    Precompiled codec of the package header of the protocol version 2.
+
+    The header is little-endian in the single struct,
+    b'data' + (version) + (<I n) + (<I k) + (<d q)
+    + (<H channels) + (<I samples) + (<B dtype) + (<B flags) + (<I sample_rate),
+    so it carries the shape, dtype and sample rate of the body, and the 32-bit length.
+    '''
+
+    magic = struct.pack('8s', b'data\x02')
+
+    def __init__(self):
+        self.struct = struct.Struct('<8sIIdHIBBI')
+        self.size = self.struct.size
+        self.dtype = np.dtype([('s', 'S8'), ('n', '<u4'), ('k', '<u4'), ('q', '<f8'),
+                               ('channels', '<u2'), ('samples', '<u4'),
+                               ('dtype', 'u1'), ('flags', 'u1'), ('sample_rate', '<u4')])
+
+    def pack(self, n, k, q, channels=channels, samples=data_length, dtype_code=0, flags=0, sample_rate=sample_rate):
+        '''
+        Pack the header into new bytes
+
+        Args:
+            :param: n: the package id n;
+            :param: k: The length of the bytes;
+            :param: q: The time stamp of the package;
+            :param: channels: The channels of the body;
+            :param: samples: The samples of the body;
+            :param: dtype_code: The code of the sample dtype;
+            :param: flags: The flags of the body;
+            :param: sample_rate: The sample rate of the body.
+
+        Return:
+            :return: The encoded header
+        '''
+        return self.struct.pack(self.magic, n, k, q, channels, samples, dtype_code, flags, sample_rate)
+
+    def pack_into(self, buffer, offset, n, k, q, channels=channels, samples=data_length, dtype_code=0, flags=0, sample_rate=sample_rate):
+        '''
+        Pack the header into the buffer at the offset
+
+        Args:
+            :param: buffer: The writable buffer;
+            :param: offset: The offset of the header in the buffer;
+            :param: n, k, q, channels, samples, dtype_code, flags, sample_rate: See pack.
+        '''
+        self.struct.pack_into(buffer, offset, self.magic, n,
+                              k, q, channels, samples, dtype_code, flags, sample_rate)
+
+    def unpack_from(self, buffer, offset=0):
+        '''
+        Unpack the header from the buffer at the offset
+
+        Args:
+            :param: buffer: The buffer;
+            :param: offset: The offset of the header in the buffer.
+
+        Return:
+            :return: s, n, k, q, channels, samples, dtype_code, flags, sample_rate.
+        '''
+        return self.struct.unpack_from(buffer, offset)
+
+    def header_dict(self, output):
+        '''
+        Convert the unpacked header into the dict
+
+        Args:
+            :param: output: The unpacked header.
+
+        Return:
+            :return: The dict of s, n, k, q, channels, samples, dtype, flags and sample_rate.
+        '''
+        s, n, k, q, header_channels, samples, dtype_code, flags, rate = output
+        return dict(s=s, n=n, k=k, q=q, channels=header_channels, samples=samples,
+                    dtype=sample_dtypes[dtype_code], flags=flags, sample_rate=rate)
+
+
+header_codec = HeaderCodec()
+header_codec_v2 = HeaderCodecV2()
+header_codecs = {
+    1: header_codec,
+    2: header_codec_v2,
+}
+
+
+def header_version(buffer, offset=0):
+    '''
+    Detect the protocol version of the header,
+    the version is the 5th byte of the leading string, 0 refers the version 1.
+
+    Args:
+        :param: buffer: The buffer;
+        :param: offset: The offset of the header in the buffer.
+
+    Return:
+        :return: The protocol version, None if the header is invalid.
+    '''
+    if not bytes(buffer[offset:offset + 4]) == b'data':
+        return None
+    version = buffer[offset + 4]
+    return 1 if version == 0 else version
+
+
 def encode_header(n, k, q):
     '''
     Encode the header based on n, k, q
@@ -32,13 +280,7 @@ def encode_header(n, k, q):
     Return:
         :return: The encoded header
     '''
-    segments = [
-        struct.pack('8s', b'data'),
-        struct.pack('>L', n),
-        struct.pack('>H', k),
-        struct.pack('<d', q)
-    ]
-    return b''.join(segments)
+    return header_codec.pack(n, k, q)
 
 
 def decode_header(code):
@@ -54,19 +296,16 @@ def decode_header(code):
                          n: the package id n;
                          k: The length of the bytes;
                          q: The time stamp of the package;
+                         and channels, samples, dtype, flags and sample_rate of the version 2.
     '''
-    if not len(code) == header_length:
+    codec = header_codecs.get(header_version(code), header_codec)
+    if not len(code) == codec.size:
         logger.error(
-            'Invalid header code, expected 20 bytes, but received {} bytes'.format(len(code)))
+            'Invalid header code, expected {} bytes, but received {} bytes'.format(
+                codec.size, len(code)))
         return
 
-    output = dict(
-        s=struct.unpack('8s', code[:8])[0],  # 8
-        n=struct.unpack('>L', code[8:12])[0],  # 4
-        k=struct.unpack('>H', code[12:14])[0],  # 2
-        q=struct.unpack('<d', code[14:])[0],  # 8
-    )
-    return output
+    return codec.header_dict(codec.unpack_from(code))
 
 
 # %%
@@ -75,12 +314,28 @@ Data encoding and decoding
 '''
 
 
-def generate_package(n=0):
+def encode_body(data, dtype=sample_dtype):
+    '''
+    Encode the data into the body bytes
+
+    Args:
+        :param: data: The 2D array of the data, (samples x channels);
+        :param: dtype: The dtype of the samples.
+
+    Return:
+        :return: code: The code of the data in bytes.
+    '''
+    return np.ascontiguousarray(data, dtype=dtype).tobytes()
+
+
+def generate_package(n=0, channels=channels, samples=data_length):
     '''
     Generate the package of the given time (n)
 
     Args:
         :param: n: The idx number of the package;
+        :param: channels: The channels of the package;
+        :param: samples: The samples of the package;
 
     Return:
         :return: n: the input n;
@@ -89,30 +344,412 @@ def generate_package(n=0):
         :return: code: The code of the package in bytes;
         :return: data: The raw data in numpy array.
     '''
-    data = np.random.randint(-1000, 1000, (data_length, channels))
-    array = data.reshape(np.prod(data.shape)).tolist()
-    code = b''.join([struct.pack('<i', e) for e in array])
+    data = np.random.randint(-1000, 1000, (samples, channels),
+                             dtype=sample_dtype)
+    code = encode_body(data)
     k = len(code)
     q = time.time()
     return n, k, q, code, data
 
 
-def decode_body(code):
+def decode_body(code, channels=channels, dtype=sample_dtype):
     '''
-    Decode the data from the body bytes
+    Decode the data from the body bytes.
+    The data is a read-only view over the code, no copy is made,
+    so copy it if it is required to outlive the code.
 
     Args:
-        :param: code: The decoding code;
+        :param: code: The decoding code, bytes, bytearray or memoryview;
+        :param: channels: The channels of the data;
+        :param: dtype: The dtype of the samples.
 
     Return:
-        :return: data: The decoded data in numpy array.
+        :return: data: The decoded data in numpy array, (samples x channels).
     '''
-    array_length = data_length * channels
-    array = struct.unpack(f'<{array_length}i', code)
-    data = np.asarray(array).reshape(data_length, channels)
+    data = np.frombuffer(code, dtype=dtype).reshape(-1, channels)
+    data.flags.writeable = False
     return data
 
 
+# %%
+'''
+Packed body encoding and decoding,
+the flags of the protocol version 2 header tell how the body is packed.
+
+The delta packing is lossless for the integer samples,
+the first row is kept, and the first-differences of every channel are zigzag encoded,
+(<I rows) + first row (dtype x channels) + widths (<u1 x channels) + groups,
+the differences of the channel c are bit-packed in widths[c] bits.
+The channels of the same width are packed as the group, the groups follow the ascending widths,
+and the channels in the group follow the ascending order,
+every group is the little-endian bits of (channels x rows - 1 x width), padded to the byte.
+The differences wrap around in the dtype, so the cumsum restores the samples exactly.
+The zlib packing compresses the body after the delta packing, if there is.
+'''
+
+body_delta_flag = 1
+body_zlib_flag = 2
+
+# The flags of the compression names of the setup
+compression_flags = {
+    None: 0,
+    'delta': body_delta_flag,
+    'zlib': body_zlib_flag,
+    'delta+zlib': body_delta_flag | body_zlib_flag,
+}
+
+packed_rows_struct = struct.Struct('<I')
+
+
+def pack_body(data, flags=body_delta_flag, zlib_level=1):
+    '''
+    Pack the data into the body bytes
+
+    Args:
+        :param: data: The 2D array of the data, (samples x channels);
+        :param: flags: The packing flags, body_delta_flag and body_zlib_flag;
+        :param: zlib_level: The level of the zlib compression, the fast 1 by default.
+
+    Return:
+        :return: code: The packed code in bytes.
+    '''
+    data = np.asarray(data)
+    dtype = data.dtype.newbyteorder('<')
+
+    if flags & body_delta_flag:
+        if not dtype.kind == 'i':
+            raise ValueError(
+                'The delta packing requires the integer samples, not {}'.format(dtype))
+        rows, columns = data.shape
+        bits = dtype.itemsize * 8
+        unsigned = np.dtype('<u{}'.format(dtype.itemsize))
+
+        parts = [packed_rows_struct.pack(rows)]
+        if rows > 0:
+            x = np.ascontiguousarray(data, dtype=dtype)
+            # The differences wrap around, (channels x rows - 1)
+            d = np.diff(x, axis=0).T
+            zigzag = np.ascontiguousarray(
+                ((d << 1) ^ (d >> (bits - 1))).view(unsigned))
+            # The bit width of the largest zigzag of every channel
+            widths = np.frexp(zigzag.max(axis=1, initial=0))[
+                1].astype(np.uint8)
+            parts += [x[0].tobytes(), widths.tobytes()]
+
+            octets = zigzag.view(np.uint8).reshape(columns, -1, dtype.itemsize)
+            for width in np.unique(widths[widths > 0]).tolist():
+                # The bits are unpacked and packed flat, it is much faster than along the short axis
+                group = octets[widths == width, :, :(width + 7) // 8]
+                planes = np.unpackbits(group.reshape(-1), bitorder='little')
+                planes = planes.reshape(group.shape[:2] + (-1,))[:, :, :width]
+                parts.append(np.packbits(planes, bitorder='little').tobytes())
+        code = b''.join(parts)
+    else:
+        code = encode_body(data, dtype)
+
+    if flags & body_zlib_flag:
+        code = zlib.compress(code, zlib_level)
+    return code
+
+
+def unpack_body(code, channels=channels, dtype=sample_dtype, flags=body_delta_flag):
+    '''
+    Unpack the data from the body bytes
+
+    Args:
+        :param: code: The packed code, bytes, bytearray or memoryview;
+        :param: channels: The channels of the data;
+        :param: dtype: The dtype of the samples;
+        :param: flags: The packing flags, body_delta_flag and body_zlib_flag.
+
+    Return:
+        :return: data: The unpacked data in numpy array, (samples x channels).
+    '''
+    if flags & body_zlib_flag:
+        code = zlib.decompress(code)
+
+    if not flags & body_delta_flag:
+        return np.frombuffer(code, dtype=dtype).reshape(-1, channels)
+
+    dtype = np.dtype(dtype).newbyteorder('<')
+    unsigned = np.dtype('<u{}'.format(dtype.itemsize))
+    rows, = packed_rows_struct.unpack_from(code)
+    data = np.empty((rows, channels), dtype=dtype)
+    if rows == 0:
+        return data
+
+    offset = packed_rows_struct.size
+    first = np.frombuffer(code, dtype=dtype, count=channels, offset=offset)
+    offset += first.nbytes
+    widths = np.frombuffer(code, dtype=np.uint8,
+                           count=channels, offset=offset)
+    offset += channels
+
+    octets = np.zeros((channels, rows - 1, dtype.itemsize), dtype=np.uint8)
+    for width in np.unique(widths[widths > 0]).tolist():
+        selected = widths == width
+        group = int(np.count_nonzero(selected))
+        count = group * (rows - 1) * width
+        size = (count + 7) // 8
+        planes = np.unpackbits(np.frombuffer(code, dtype=np.uint8, count=size, offset=offset),
+                               count=count, bitorder='little')
+        # The bits are padded to the bytes, and packed flat
+        padded = np.zeros((group, rows - 1, (width + 7) // 8 * 8), dtype=np.uint8)
+        padded[:, :, :width] = planes.reshape(-1, rows - 1, width)
+        octets[selected, :, :(width + 7) // 8] = np.packbits(
+            padded, bitorder='little').reshape(padded.shape[:2] + (-1,))
+        offset += size
+
+    zigzag = octets.view(unsigned)[:, :, 0]
+    d = ((zigzag >> 1) ^ -(zigzag & 1)).view(dtype)
+    data[0] = first
+    np.cumsum(d.T, axis=0, dtype=dtype, out=data[1:])
+    data[1:] += first
+    return data
+
+
+# %%
+'''
+Package receiving
+'''
+
+
+class FramedReceiver(object):
+    '''
+    The framed stream reader of the packages.
+    The bytes are received into the preallocated buffer with recv_into,
+    all the complete packages are parsed at once,
+    and the partial package is carried over to the next read.
+    '''
+
+    def __init__(self, client, buffer_size=1024 * 1024):
+        '''
+        Args:
+            :param: client: The connected socket;
+            :param: buffer_size: The initial size of the buffer.
+        '''
+        self.client = client
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        # The buffer[start:end] is received but not parsed
+        self.start = 0
+        self.end = 0
+
+        self.bytes_total = 0
+        self.packages_total = 0
+        # The latest package id, the gap of the ids is the missing packages
+        self.last_n = None
+        self.log_sampler = LogSampler()
+        self._stats_t = time.time()
+        self._stats_bytes = 0
+        self._stats_packages = 0
+
+    def _reserve(self, size):
+        '''
+        Make sure the buffer has room for the size bytes after the start,
+        the pending bytes are moved to the head of the buffer,
+        and the buffer grows if it is too small.
+
+        Args:
+            :param: size: The bytes required after the start.
+        '''
+        pending = self.end - self.start
+        if size > len(self.buffer):
+            buffer = bytearray(max(size, len(self.buffer) * 2))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(self.buffer)
+            logger.info('Receiving buffer grows to {} bytes'.format(
+                len(self.buffer)))
+        elif self.start > 0:
+            # The pending bytes may overlap the head, so they are copied out first
+            self.buffer[:pending] = self.view[self.start:self.end].tobytes()
+        self.start = 0
+        self.end = pending
+
+    def read(self):
+        '''
+        Receive the bytes into the buffer, it blocks until there are bytes.
+        The parsed packages of the previous read are invalid after reading.
+
+        Return:
+            :return: The number of the received bytes, 0 refers the connection is closed.
+        '''
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buffer) - self.end < len(self.buffer) >> 2:
+            self._reserve(self.end - self.start)
+
+        size = self.client.recv_into(self.view[self.end:])
+        self.end += size
+        self.bytes_total += size
+        return size
+
+    def packages(self, raw=False):
+        '''
+        Parse the complete packages in the buffer.
+        The body is the memoryview of the buffer,
+        it is valid until the next read.
+
+        Args:
+            :param: raw: Whether the body is the whole package of the header and the body, e.g. for relaying it.
+
+        Yield:
+            :yield: n, q, channels, sample_rate, dtype, flags, body: The package id, time stamp, channels, sample rate, sample dtype, packing flags and body.
+        '''
+        while self.end - self.start >= 8:
+            version = header_version(self.view, self.start)
+            codec = header_codecs.get(version)
+            if codec is None:
+                self._resync()
+                continue
+
+            if self.end - self.start < codec.size:
+                break
+
+            output = codec.unpack_from(self.view, self.start)
+            k = output[2]
+            total = codec.size + k
+            if self.end - self.start < total:
+                if total > len(self.buffer) - self.start:
+                    self._reserve(total)
+                break
+
+            if version == 1:
+                channels, sample_rate, dtype, flags = main_setup['channels'], main_setup['sample_rate'], sample_dtype, 0
+            else:
+                channels, sample_rate, dtype, flags = output[4], output[8], sample_dtypes[output[6]], output[7]
+
+            body = self.view[self.start + (0 if raw else codec.size):self.start + total]
+            self.start += total
+            self.packages_total += 1
+            yield output[1], output[3], channels, sample_rate, dtype, flags, body
+
+    def _resync(self):
+        ''' Skip the invalid bytes until the next leading string '''
+        position = self.buffer.find(b'data', self.start + 1, self.end)
+        if position < 0:
+            position = max(self.start + 1, self.end - 3)
+        logger.error('Invalid package header, skipped {} bytes'.format(
+            position - self.start))
+        self.start = position
+
+    def stats(self):
+        '''
+        The receiving rates since the last call.
+
+        Return:
+            :return: The dict of bytes/s, packages/s and the totals.
+        '''
+        t = time.time()
+        duration = max(t - self._stats_t, 1e-6)
+        output = dict(
+            bytes_per_second=(self.bytes_total - self._stats_bytes) / duration,
+            packages_per_second=(self.packages_total -
+                                 self._stats_packages) / duration,
+            bytes_total=self.bytes_total,
+            packages_total=self.packages_total,
+        )
+        self._stats_t = t
+        self._stats_bytes = self.bytes_total
+        self._stats_packages = self.packages_total
+        return output
+
+
+# %%
+'''
+Frame encoding and decoding,
+the frame is the binary response of the data center to the explorer.
+
+b'EPDF' + (version) + (dtype) + (channels) + (packages) + (samples) + (sample_rate) + (flags)
++ query (<f8 x packages) + query2 (<f8 x packages) + idx (<u4 x packages)
++ data (dtype x packages x samples x channels)
+
+The header is 24 bytes and every block is aligned with its item size,
+so the browser reads the blocks with typed-array views directly.
+'''
+
+frame_struct = struct.Struct('<4sBBHIIII')
+frame_magic = b'EPDF'
+frame_version = 1
+
+
+def encode_frame(idx, query, query2, data, dtype=sample_dtype, flags=0, sample_rate=sample_rate):
+    '''
+    Encode the segments into the binary frame
+
+    Args:
+        :param: idx: The array of the package ids;
+        :param: query: The array of the time stamps of the packages;
+        :param: query2: The array of the receiving time stamps of the packages;
+        :param: data: The 2D array of the samples, (packages x samples, channels);
+        :param: dtype: The dtype of the samples in the frame, '<i4' or '<f4';
+        :param: flags: The flags of the frame;
+        :param: sample_rate: The sample rate of the samples.
+
+    Return:
+        :return: frame: The frame in bytearray.
+    '''
+    dtype = np.dtype(dtype).newbyteorder('<')
+    packages = len(idx)
+    samples = len(data) // packages if packages > 0 else 0
+    data_channels = data.shape[1] if data.ndim == 2 else 0
+
+    offset = frame_struct.size
+    frame = bytearray(offset + packages * 20 + data.size * dtype.itemsize)
+    frame_struct.pack_into(frame, 0, frame_magic, frame_version, sample_dtype_codes[dtype],
+                           data_channels, packages, samples, sample_rate, flags)
+
+    for array, block_dtype in [(query, '<f8'), (query2, '<f8'), (idx, '<u4')]:
+        block = np.frombuffer(frame, dtype=block_dtype,
+                              count=packages, offset=offset)
+        block[:] = array
+        offset += block.nbytes
+
+    block = np.frombuffer(frame, dtype=dtype, count=data.size, offset=offset)
+    block.reshape(data.shape)[:] = data
+    return frame
+
+
+def decode_frame(frame):
+    '''
+    Decode the binary frame,
+    the arrays are read-only views over the frame.
+
+    Args:
+        :param: frame: The frame bytes.
+
+    Return:
+        :return: header: The dict of the frame header;
+        :return: idx: The array of the package ids;
+        :return: query: The array of the time stamps of the packages;
+        :return: query2: The array of the receiving time stamps of the packages;
+        :return: data: The 2D array of the samples, (packages x samples, channels).
+    '''
+    magic, version, dtype_code, data_channels, packages, samples, rate, flags = frame_struct.unpack_from(
+        frame)
+    if not magic == frame_magic:
+        logger.error('Invalid frame magic: {}'.format(magic))
+        return
+
+    header = dict(version=version, dtype=sample_dtypes[dtype_code], channels=data_channels,
+                  packages=packages, samples=samples, sample_rate=rate, flags=flags)
+
+    offset = frame_struct.size
+    arrays = []
+    for block_dtype in ['<f8', '<f8', '<u4']:
+        block = np.frombuffer(frame, dtype=block_dtype,
+                              count=packages, offset=offset)
+        arrays.append(block)
+        offset += block.nbytes
+    query, query2, idx = arrays
+
+    data = np.frombuffer(frame, dtype=header['dtype'],
+                         count=packages * samples * data_channels, offset=offset)
+    data = data.reshape(packages * samples, data_channels)
+    return header, idx, query, query2, data
+
+
 # %%
 if __name__ == '__main__':
     n, k, q, code, data = generate_package()
@@ -125,8 +762,30 @@ if __name__ == '__main__':
     output = decode_header(header)
     print(output)
 
+    print('---- Scan Check ----')
+    stream = b''.join([encode_header(i, k, q) + code for i in range(5)])
+    ns, ks, qs, offsets, end = header_codec.scan(stream + header)
+    print(ns, ks, offsets, end, len(stream))
+
+    print('---- Header V2 Check ----')
+    header = header_codec_v2.pack(n, k, q, channels, data_length)
+    print(len(header), decode_header(header))
+
     print('---- Decode Check ----')
     data2 = decode_body(code)
     print('The difference values are', np.unique(data - data2))
 
+    print('---- Packed Body Check ----')
+    for compression, flags in compression_flags.items():
+        packed = pack_body(data, flags)
+        data4 = unpack_body(packed, channels, sample_dtype, flags)
+        print(compression, len(code), len(packed),
+              'The difference values are', np.unique(data - data4))
+
+    print('---- Frame Check ----')
+    frame = encode_frame([n], [q], [q], data)
+    header, idx, query, query2, data3 = decode_frame(frame)
+    print(len(frame), header, idx, query)
+    print('The difference values are', np.unique(data - data3))
+
 # %%
@@ -7,48 +7,841 @@ The Data Center of Pseudo EEG Device
 '''
 
 # %%
+import os
 import json
+import math
 import time
+import errno
+import argparse
 import socket
+import selectors
 import threading
 import traceback
-import pandas as pd
+import numpy as np
 
 import asyncio
-import websockets
+
+import multiprocessing
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from main_setup import main_setup, signal_sender_setup, data_center_setup, logger
-from coding_toolbox import decode_header, decode_body
-from eeg_data_set import DataSet
+from coding_toolbox import decode_body, unpack_body, encode_frame, FramedReceiver
+from eeg_data_set import DataSet, Segments, segments_dataframe, default_latest_length, default_latest_length_seconds, data_limit_seconds
+from eeg_pyramid import MinMaxPyramid
+from eeg_recorder import Recorder
+from eeg_pipeline import Pipeline
+from eeg_spectrum import SpectrumCache
+from eeg_shared_stream import SharedStreamWriter, shared_name
+from metrics import metrics, snapshot_path
 
 # %%
-dataset = DataSet()
+
+
+class Stream(object):
+    '''
+    The stream of the device,
+    it is the dataset of the device and the caches listening to it.
+    '''
+
+    def __init__(self, name, dataset=None):
+        '''
+        Args:
+            :param: name: The name of the device;
+            :param: dataset: The dataset of the stream, None for the new DataSet.
+        '''
+        self.name = name
+        self.dataset = DataSet() if dataset is None else dataset
+        self.pyramid = MinMaxPyramid(sample_rate=self.dataset.sample_rate)
+        self.dataset.add_listener(self.pyramid.append)
+        self.dataset.add_configure_listener(self.pyramid.configure)
+        self.spectrum = SpectrumCache(sample_rate=self.dataset.sample_rate)
+        self.dataset.add_listener(self.spectrum.append)
+        self.dataset.add_configure_listener(self.spectrum.configure)
+
+        self.recorder = None
+        if data_center_setup['record_folder'] is not None:
+            self.recorder = Recorder(os.path.join(
+                data_center_setup['record_folder'], name), compression=data_center_setup['record_compression'])
+            self.dataset.add_listener(self.recorder.append)
+            self.dataset.add_configure_listener(self.recorder.configure)
+
+        self.shared = None
+        if data_center_setup['shared_memory'] is not None:
+            self.shared = SharedStreamWriter(shared_name(name))
+            self.dataset.add_listener(self.shared.append)
+            self.dataset.add_configure_listener(self.shared.configure)
+
+    def close(self):
+        ''' Close the recording and the shared-memory stream of the stream '''
+        if self.recorder is not None:
+            self.dataset.remove_listener(self.recorder.append)
+            self.recorder.close()
+        if self.shared is not None:
+            self.dataset.remove_listener(self.shared.append)
+            self.shared.close()
+
+
+# The first device is the default device
+default_device = next(iter(data_center_setup['devices']))
+
+# The streams of the devices, they are created on demand by get_streams,
+# so importing the module does not allocate the datasets nor start the recorders
+_streams = None
+
+
+def get_streams():
+    '''
+    Get the streams of data_center_setup['devices'], they are created at the first call
+
+    Return:
+        :return: The dict of the streams, by the device name.
+    '''
+    global _streams
+    if _streams is None:
+        _streams = {name: Stream(name)
+                    for name in data_center_setup['devices']}
+    return _streams
+
+
+def __getattr__(name):
+    '''
+    The streams, and the dataset, pyramid, spectrum and recorder of the default device,
+    they are the module attributes being created on demand.
+    '''
+    if name == 'streams':
+        return get_streams()
+    if name in ('dataset', 'pyramid', 'spectrum', 'recorder'):
+        return getattr(get_streams()[default_device], name)
+    raise AttributeError(
+        'module {} has no attribute {}'.format(__name__, name))
 
 # %%
+# The types and formats of the requests
+request_types = ['latest', 'envelope', 'spectrum', 'range', 'stats']
+request_formats = ['json', 'binary', 'dataframe']
 
 
-class WebsocketServer(object):
-    def __init__(self):
+def _check_number(request, key, integer=False, positive=False):
+    '''
+    Check the numeric field of the request, the ValueError is raised if it is invalid
+
+    Args:
+        :param: request: The request;
+        :param: key: The key of the field;
+        :param: integer: Whether the field is the integer;
+        :param: positive: Whether the field is positive.
+    '''
+    value = request[key]
+    kinds = int if integer else (int, float)
+    if isinstance(value, bool) or not isinstance(value, kinds) or not math.isfinite(value) or (positive and value <= 0):
+        raise ValueError('Invalid {} {}, it is the {}{}'.format(
+            key, value, 'positive ' if positive else '', 'integer' if integer else 'number'))
+
+
+def parse_request(msg):
+    '''
+    Parse the request message from the client.
+    The message is either the legacy integer of the latest segments, it is answered by the dataframe format,
+    or the JSON object like
+    {"latest": 100, "format": "binary", "dtype": "int32", "channels": [0, 1], "subscribe": true, "device": "default"},
+    the "since" of the latest package idx of the client asks for the newer packages only,
+    or the envelope request like
+    {"type": "envelope", "seconds": 60, "width": 800, "format": "binary"},
+    or the spectrum request like
+    {"type": "spectrum", "bands": true, "format": "binary"},
+    or the time range request like
+    {"type": "range", "t_start": 1673000000.0, "t_end": 1673000010.0, "format": "binary"},
+    or the stats request of the metrics like
+    {"type": "stats"}.
+    The "device" selects the stream of the device, it is the default device if not provided.
+    The ValueError is raised if the message is not one of them,
+    or its type, format, dtype, latest, since, channels, width, seconds, t_start, t_end or bands is invalid.
+
+    Args:
+        :param: msg: The request message.
+
+    Return:
+        :return: request: The dict of type, latest, since, format, dtype, channels, subscribe, seconds, width, bands, t_start, t_end and device.
+    '''
+    request = dict(type='latest', latest=default_latest_length, since=None, format='json',
+                   dtype='int32', channels=None, subscribe=False,
+                   seconds=default_latest_length_seconds, width=800, bands=False,
+                   t_start=0.0, t_end=None, device=default_device)
+
+    try:
+        request['latest'] = int(msg)
+        request['format'] = 'dataframe'
+        return request
+    except ValueError:
         pass
 
-    async def handle(self, websocket, path):
+    message = json.loads(msg)
+    if not isinstance(message, dict):
+        raise ValueError('The request is not the JSON object')
+    request.update(message)
+
+    if request['type'] not in request_types:
+        raise ValueError('Unknown type {}, it is one of {}'.format(
+            request['type'], request_types))
+    if request['format'] not in request_formats:
+        raise ValueError('Unknown format {}, it is one of {}'.format(
+            request['format'], request_formats))
+    if request['dtype'] not in frame_dtypes:
+        raise ValueError('Unknown dtype {}, it is one of {}'.format(
+            request['dtype'], list(frame_dtypes)))
+
+    try:
+        request['latest'] = int(request['latest'])
+    except (TypeError, ValueError):
+        raise ValueError('Invalid latest {}'.format(request['latest']))
+    if request['latest'] < 0:
+        raise ValueError('Invalid latest {}'.format(request['latest']))
+    if request['since'] is not None and (not isinstance(request['since'], int) or isinstance(request['since'], bool)):
+        raise ValueError('Invalid since {}, it is the package idx'.format(
+            request['since']))
+
+    _check_number(request, 'width', integer=True, positive=True)
+    _check_number(request, 'seconds', positive=True)
+    _check_number(request, 't_start')
+    if request['t_end'] is not None:
+        _check_number(request, 't_end')
+        if request['t_start'] > request['t_end']:
+            raise ValueError('Invalid range, t_start {} is after t_end {}'.format(
+                request['t_start'], request['t_end']))
+    if not isinstance(request['bands'], (bool, list)):
+        raise ValueError('Invalid bands {}, it is true, false or the list'.format(
+            request['bands']))
+
+    channels = request['channels']
+    if channels is not None:
+        if not isinstance(channels, list) or not all(isinstance(e, int) and not isinstance(e, bool) and e >= 0 for e in channels):
+            raise ValueError(
+                'Invalid channels {}, it is the list of the channel indexes'.format(channels))
+    return request
+
+
+frame_dtypes = dict(int32='<i4', float32='<f4')
+# The frame flag of the min/max envelope
+frame_envelope_flag = 1
+# The frame flags of the PSD and the band power
+frame_spectrum_flag = 2
+frame_band_power_flag = 4
+# The frame flag of the since cursor being aged out,
+# the packages do not follow the cursor, so the client should drop its packages
+frame_aged_out_flag = 8
+
+
+def encode_segments(segments, request, aged_out=False, sample_rate=main_setup['sample_rate']):
+    '''
+    Encode the segments as the request asks.
+
+    Args:
+        :param: segments: The Segments of idx, query, query2 and data;
+        :param: request: The parsed request;
+        :param: aged_out: Whether the since cursor of the request is aged out;
+        :param: sample_rate: The sample rate of the segments.
+
+    Return:
+        :return: The binary frame or the JSON string.
+    '''
+    idx, query, query2, data = segments
+    if request['channels'] is not None:
+        data = data[:, request['channels']]
+
+    if request['format'] == 'binary':
+        flags = frame_aged_out_flag if aged_out else 0
+        return encode_frame(idx, query, query2, data, dtype=frame_dtypes[request['dtype']], flags=flags,
+                            sample_rate=sample_rate)
+
+    packages = len(idx)
+    output = dict(
+        idx=idx.tolist(),
+        query=query.tolist(),
+        query2=query2.tolist(),
+        data=data.reshape(packages, -1, data.shape[1]).tolist() if packages else [],
+        sample_rate=sample_rate,
+    )
+    if request['since'] is not None:
+        output['aged_out'] = aged_out
+    return json.dumps(output)
+
+
+def encode_dataframe(segments, samples, channels):
+    '''
+    Encode the segments into the JSON of the dataframe,
+    it is the answer of the legacy request and the "dataframe" format.
+
+    Args:
+        :param: segments: The Segments;
+        :param: samples: The samples in every package;
+        :param: channels: The channels.
+
+    Return:
+        :return: The JSON string.
+    '''
+    return segments_dataframe(segments, samples, channels).to_json()
+
+
+def warm_up():
+    ''' Import the heavy modules in the worker process before the first heavy request '''
+    import pandas
+
+
+def encode_envelope(bucket, t_end, mn, mx, request, sample_rate=main_setup['sample_rate']):
+    '''
+    Encode the min/max envelope as the request asks.
+    The binary envelope is the frame with the flag of frame_envelope_flag,
+    it has one package, the idx is the bucket samples,
+    the query and query2 are the start and end time stamps,
+    and the data rows are the min and max of the buckets in turn.
+
+    Args:
+        :param: bucket: The samples of every bucket;
+        :param: t_end: The time stamp of the end of the envelope;
+        :param: mn: The min of the buckets, (buckets x channels);
+        :param: mx: The max of the buckets, (buckets x channels);
+        :param: request: The parsed request;
+        :param: sample_rate: The sample rate of the signal.
+
+    Return:
+        :return: The binary frame or the JSON string.
+    '''
+    if request['channels'] is not None:
+        mn = mn[:, request['channels']]
+        mx = mx[:, request['channels']]
+
+    t_start = t_end - len(mn) * bucket / sample_rate
+
+    if request['format'] == 'binary':
+        data = np.empty((len(mn) * 2, mn.shape[1]), dtype=mn.dtype)
+        data[0::2] = mn
+        data[1::2] = mx
+        return encode_frame([bucket], [t_start], [t_end], data,
+                            dtype=frame_dtypes[request['dtype']], flags=frame_envelope_flag, sample_rate=sample_rate)
+
+    return json.dumps(dict(bucket=int(bucket), t_start=t_start, t_end=t_end,
+                           min=mn.tolist(), max=mx.tolist()))
+
+
+def encode_spectrum(snapshot, cache, request):
+    '''
+    Encode the spectrum snapshot as the request asks.
+    The binary spectrum is the float32 frame with one package,
+    the idx is the samples of the window, so the frequency resolution is sample_rate / idx,
+    the query and query2 are the start and end time stamps of the averaged windows,
+    and the data rows are the PSD of the frequency bins (flags = frame_spectrum_flag),
+    or the power of the bands (flags = frame_band_power_flag).
+
+    Args:
+        :param: snapshot: The snapshot of the SpectrumCache, None for no spectrum yet;
+        :param: cache: The SpectrumCache;
+        :param: request: The parsed request.
+
+    Return:
+        :return: The binary frame or the JSON string.
+    '''
+    flags = frame_band_power_flag if request['bands'] else frame_spectrum_flag
+    if snapshot is None:
+        if request['format'] == 'binary':
+            return encode_frame([], [], [], np.zeros((0, cache.channels)), dtype=frame_dtypes['float32'], flags=flags,
+                                sample_rate=cache.sample_rate)
+        return json.dumps(dict(windows=0))
+
+    data = snapshot['band_power'] if request['bands'] else snapshot['psd']
+    if request['channels'] is not None:
+        data = data[:, request['channels']]
+
+    if request['format'] == 'binary':
+        return encode_frame([cache.nperseg], [snapshot['t_start']], [snapshot['t_end']], data,
+                            dtype=frame_dtypes['float32'], flags=flags, sample_rate=cache.sample_rate)
+
+    output = dict(t_start=snapshot['t_start'], t_end=snapshot['t_end'],
+                  windows=snapshot['windows'], nperseg=cache.nperseg)
+    if request['bands']:
+        output.update(bands=cache.bands, band_power=data.tolist())
+    else:
+        output.update(freqs=cache.freqs.tolist(), psd=data.tolist())
+    return json.dumps(output)
+
+
+class Subscription(object):
+    '''
+    The subscription of the websocket client,
+    the new segments are queued in the bounded queue,
+    and the oldest one is dropped when the queue is full.
+    '''
+
+    def __init__(self, websocket, request, maxsize=data_center_setup['subscription_queue']):
+        self.websocket = websocket
+        self.request = request
+        self.key = (request['format'], request['dtype'],
+                    tuple(request['channels'] or []))
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        # The time stamp of the latest queued segment
+        self.latest_query = 0
+        self.dropped = 0
+
+    def offer(self, code, q):
+        '''
+        Put the code into the queue, drop the oldest if it is full.
+
+        Args:
+            :param: code: The encoded segment;
+            :param: q: The time stamp of the segment.
+        '''
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+            metrics.count('subscription_dropped')
+            if self.dropped % 100 == 1:
+                logger.warning('Subscription dropped {} segments'.format(
+                    self.dropped))
+        self.queue.put_nowait((code, q))
+
+
+def timed_job(fn, args):
+    '''
+    Run the job of the serialize lane, it is module-level to be run in the process
+
+    Args:
+        :param: fn: The function;
+        :param: args: The args of the function.
+
+    Return:
+        :return: t, seconds, output: The time stamp of the start, the seconds of running and the return of the function.
+    '''
+    t = time.time()
+    output = fn(*args)
+    return t, time.time() - t, output
+
+
+class SerializeLane(object):
+    '''
+    The bounded executor of the serializing jobs,
+    the jobs are run by the threads or the processes out of the event loop,
+    and the time waiting for the worker is the queue time.
+    '''
+
+    def __init__(self, name, workers, processes=False):
+        '''
+        Args:
+            :param: name: The name of the lane, it is in the names of the metrics;
+            :param: workers: The max jobs being run concurrently;
+            :param: processes: Whether the workers are the processes, the function and the args should be picklable.
+        '''
+        self.name = name
+        self.workers = workers
+        if processes:
+            # The spawned worker does not inherit the threads and the locks of the data center
+            self.executor = ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self.executor = ThreadPoolExecutor(
+                workers, thread_name_prefix='serialize-{}'.format(name))
+        # The jobs being submitted and not done, the job being run is not done when its client disconnects
+        self.inflight = 0
+        self.lock = threading.Lock()
+        metrics.gauge('serialize_inflight.{}'.format(name),
+                      lambda: self.inflight)
+
+    def _done(self, future):
+        ''' The job is done or dropped, it is called by the executor '''
+        with self.lock:
+            self.inflight -= 1
+
+    async def run(self, fn, *args):
+        '''
+        Run the job in the lane, it is an async function.
+        The job waiting for the worker is dropped if it is cancelled,
+        and the result of the job being run is discarded.
+
+        Args:
+            :param: fn: The function;
+            :param: args: The args of the function.
+
+        Return:
+            :return: The return of the function.
+        '''
+        t = time.time()
+        with self.lock:
+            self.inflight += 1
+        future = self.executor.submit(timed_job, fn, args)
+        future.add_done_callback(self._done)
+        t_start, seconds, output = await asyncio.wrap_future(future)
+        metrics.observe('serialize_queue.{}'.format(self.name), t_start - t)
+        metrics.observe('serialize.{}'.format(self.name), seconds)
+        return output
+
+
+class WebsocketServer(object):
+    def __init__(self, streams=None):
+        '''
+        Args:
+            :param: streams: The dict of the streams being served, by the device name, None for the streams of the devices.
+        '''
+        if streams is None:
+            streams = get_streams()
+        self.streams = streams
+        self.loop = None
+        self.subscriptions = set()
+        # The heavy requests are encoded in the processes,
+        # so they do not hold the GIL of the event loop and the light requests
+        self.lanes = dict(
+            light=SerializeLane('light', data_center_setup['serialize_workers']),
+            heavy=SerializeLane(
+                'heavy', data_center_setup['serialize_heavy_workers'], processes=True),
+        )
+        for name, stream in streams.items():
+            stream.dataset.add_listener(self._publisher(name))
+        metrics.gauge('subscriptions', lambda: len(self.subscriptions))
+
+    def _publisher(self, device):
+        '''
+        Make the listener publishing the segments of the device
+
+        Args:
+            :param: device: The name of the device.
+        '''
+        def _publish(n, q, q2, data):
+            self.publish(device, n, q, q2, data)
+        return _publish
+
+    def validate(self, request):
+        '''
+        Validate the device and the channels of the parsed request,
+        the ValueError is raised if they are not of the streams.
+
+        Args:
+            :param: request: The parsed request.
+        '''
+        if request['device'] not in self.streams:
+            raise ValueError('Unknown device {}, it is one of {}'.format(
+                request['device'], list(self.streams)))
+
+        channels = self.streams[request['device']].dataset.channels
+        if request['channels'] and max(request['channels']) >= channels:
+            raise ValueError('Invalid channels {}, the device has {} channels'.format(
+                request['channels'], channels))
+
+    def serialize(self, request):
+        '''
+        Serialize the latest segments of the dataset as the request asks.
+
+        Args:
+            :param: request: The parsed request.
+
+        Return:
+            :return: The binary frame or the JSON string.
+        '''
+        fn, args = self.prepare(request)
+        return fn(*args)
+
+    def prepare(self, request):
+        '''
+        Query the dataset as the request asks, and choose the encoding function,
+        the encoding of the segments is the module-level function,
+        so it can be run in the process of the heavy lane.
+
+        Args:
+            :param: request: The parsed request.
+
+        Return:
+            :return: fn, args: The encoding function and its args.
+        '''
+        if request['type'] == 'stats':
+            return json.dumps, (metrics.snapshot(),)
+
+        stream = self.streams[request['device']]
+
+        if request['type'] == 'envelope':
+            pyramid = stream.pyramid
+            samples = int(request['seconds'] * pyramid.sample_rate)
+            return encode_envelope, (*pyramid.envelope(samples, int(request['width'])), request,
+                                     pyramid.sample_rate)
+
+        if request['type'] == 'spectrum':
+            return encode_spectrum, (stream.spectrum.spectrum(), stream.spectrum, request)
+
+        dataset = stream.dataset
+
+        if request['type'] == 'range':
+            t_end = np.inf if request['t_end'] is None else request['t_end']
+            return encode_segments, (dataset.get_range(request['t_start'], t_end), request,
+                                     False, dataset.sample_rate)
+
+        if request['since'] is not None:
+            segments, aged_out = self.since(dataset, request)
+            return encode_segments, (segments, request, aged_out, dataset.sample_rate)
+
+        if request['format'] != 'dataframe' or request['channels'] is not None:
+            return encode_segments, (dataset.get_latest(request['latest']), request,
+                                     False, dataset.sample_rate)
+
+        return encode_dataframe, (dataset.get_latest(request['latest']), dataset.samples, dataset.channels)
+
+    def estimate(self, request):
+        '''
+        Estimate the bytes of the response of the request,
+        it chooses the lane serializing the request.
+
+        Args:
+            :param: request: The parsed request.
+
+        Return:
+            :return: The estimated bytes.
+        '''
+        if request['type'] in ('stats', 'envelope', 'spectrum'):
+            return 0
+
+        dataset = self.streams[request['device']].dataset
+        if request['type'] == 'range':
+            t_end = time.time() if request['t_end'] is None else request['t_end']
+            seconds = max(0, t_end - max(request['t_start'],
+                                         t_end - data_limit_seconds))
+            packages = seconds * dataset.sample_rate / dataset.samples
+        elif request['since'] is not None:
+            # The poll is sized by the packages after its cursor, at most the latest
+            packages = request['latest']
+            if dataset.contains(request['since']):
+                packages = min(packages, dataset.count_since(request['since']))
+        else:
+            packages = request['latest']
+        packages = min(packages, dataset.count, dataset.capacity)
+
+        channels = dataset.channels if request['channels'] is None else len(
+            request['channels'])
+        size = packages * dataset.samples * channels * dataset.dtype.itemsize
+        if request['format'] != 'binary':
+            # Every sample is about 8 characters of the JSON
+            size *= 2
+        return size
+
+    async def respond(self, websocket, request, prepared=None):
+        '''
+        Serialize the request out of the event loop, it is an async function.
+        The light request is serialized in the thread,
+        and the heavy request is queried in the thread and encoded in the process.
+
+        Args:
+            :param: websocket: The websocket connection;
+            :param: request: The parsed request;
+            :param: prepared: The (fn, args) being prepared, None for preparing by the request.
+
+        Return:
+            :return: The binary frame or the JSON string, None if the client disconnects.
         '''
-        Handle message from the client, it is an async function.
+        heavy = self.estimate(
+            request) > data_center_setup['serialize_heavy_bytes']
+        if not heavy:
+            if prepared is None:
+                return await self._unless_closed(websocket, self.lanes['light'].run(self.serialize, request))
+            fn, args = prepared
+            return await self._unless_closed(websocket, self.lanes['light'].run(fn, *args))
+
+        metrics.count('serialize_heavy')
+        if prepared is None:
+            prepared = await self._unless_closed(websocket, self.lanes['light'].run(self.prepare, request))
+            if prepared is None:
+                return None
+        fn, args = prepared
+        return await self._unless_closed(websocket, self.lanes['heavy'].run(fn, *args))
+
+    async def _unless_closed(self, websocket, coroutine):
+        '''
+        Await the coroutine, it is cancelled if the client disconnects before it is done.
+
+        Args:
+            :param: websocket: The websocket connection;
+            :param: coroutine: The coroutine of the job.
+
+        Return:
+            :return: The return of the coroutine, None if the client disconnects.
+        '''
+        job = asyncio.ensure_future(coroutine)
+        closed = asyncio.ensure_future(websocket.wait_closed())
+        try:
+            await asyncio.wait([job, closed], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            closed.cancel()
+
+        if not job.done():
+            job.cancel()
+            metrics.count('serialize_cancelled')
+            logger.debug('Serializing is cancelled, the client disconnects')
+            return None
+        return job.result()
+
+    def since(self, dataset, request):
+        '''
+        Get the packages after the since cursor of the request, at most the latest packages,
+        the cursor is aged out if it is not in the dataset, or the packages are more than the latest,
+        since the packages do not follow the cursor in both cases.
+
+        Args:
+            :param: dataset: The dataset;
+            :param: request: The parsed request.
+
+        Return:
+            :return: segments: The Segments after the cursor;
+            :return: aged_out: Whether the cursor is aged out.
+        '''
+        since = int(request['since'])
+        aged_out = dataset.count > 0 and not dataset.contains(since)
+        segments = dataset.get_since(since)
+        if len(segments.idx) > request['latest']:
+            segments = dataset.get_latest(request['latest'])
+            aged_out = True
+        return segments, aged_out
+
+    def publish(self, device, n, q, q2, data):
+        '''
+        Publish the new segment to the subscriptions,
+        it is called by the dataset in the receiving thread.
+
+        Args:
+            :param: device: The name of the device;
+            :param: n: The count of the signal segment;
+            :param: q: The timestamp of the signal segment;
+            :param: q2: The timestamp of receiving the signal segment
+            :param: data: The 2D array of the signal segment
+        '''
+        if self.loop is None or not self.subscriptions:
+            return
+
+        segments = Segments(np.array([n]), np.array([q]),
+                            np.array([q2]), np.array(data))
+        self.loop.call_soon_threadsafe(self._dispatch, device, segments)
+
+    def _dispatch(self, device, segments):
+        '''
+        Dispatch the segments to the subscriptions of the device in the event loop,
+        the segments are encoded once for the subscriptions of the same request.
+
+        Args:
+            :param: device: The name of the device;
+            :param: segments: The Segments to dispatch.
+        '''
+        t = time.perf_counter()
+        codes = dict()
+        q = segments.query[-1]
+        for subscription in list(self.subscriptions):
+            if not subscription.request['device'] == device:
+                continue
+            if q <= subscription.latest_query:
+                continue
+            if subscription.key not in codes:
+                codes[subscription.key] = encode_segments(
+                    segments, subscription.request, sample_rate=self.streams[device].dataset.sample_rate)
+            subscription.offer(codes[subscription.key], q)
+            subscription.latest_query = q
+        metrics.observe('dispatch', time.perf_counter() - t)
+
+    async def subscribe(self, websocket, request):
+        '''
+        Serve the subscription until the client disconnects,
+        it sends the backfill of the latest segments,
+        and pushes the new segments as they arrive.
+
+        Args:
+            :param: websocket: The websocket connection;
+            :param: request: The parsed request.
+        '''
+        import websockets
+
+        subscription = Subscription(websocket, request)
+        peer = '{}:{}'.format(*websocket.remote_address[:2])
+        metrics.gauge('subscription_queue.{}'.format(peer),
+                      lambda: subscription.queue.qsize())
+
+        segments = self.streams[request['device']
+                                ].dataset.get_latest(request['latest'])
+        if len(segments.query) > 0:
+            subscription.latest_query = segments.query[-1]
+        self.subscriptions.add(subscription)
+        logger.info('Subscription starts, {} subscriptions'.format(
+            len(self.subscriptions)))
+
+        try:
+            code = await self.respond(websocket, request, (encode_segments, (segments, request)))
+            if code is None:
+                return
+            await websocket.send(code)
+            metrics.count('ws_bytes.{}'.format(peer), len(code))
+            while True:
+                code, q = await subscription.queue.get()
+                t = time.perf_counter()
+                await websocket.send(code)
+                metrics.observe('push', time.perf_counter() - t)
+                # From the stamp of the sender to the push of the subscriber
+                metrics.observe('end_to_end', time.time() - q)
+                metrics.count('ws_bytes.{}'.format(peer), len(code))
+
+        except websockets.ConnectionClosed:
+            pass
+
+        finally:
+            self.subscriptions.discard(subscription)
+            metrics.discard('subscription_queue.{}'.format(peer))
+            logger.info('Subscription stops, {} subscriptions, {} segments dropped'.format(
+                len(self.subscriptions), subscription.dropped))
+
+    async def handle(self, websocket, path=None):
+        '''
+        Handle messages from the client, it is an async function.
+        Every request is answered until the client disconnects,
+        and the subscription keeps the connection until the client disconnects.
 
         Args:
             :param: websocket: The websocket connection;
             :param: path: The request path.
         '''
+        import websockets
+
+        peer = '{}:{}'.format(*websocket.remote_address[:2])
+
         def _send(bytes):
+            metrics.count('ws_bytes.{}'.format(peer), len(bytes))
             return websocket.send(bytes)
 
         logger.debug('Received message: {}'.format(path))
 
-        msg = await websocket.recv()
+        try:
+            async for msg in websocket:
+                try:
+                    request = parse_request(msg)
+                    self.validate(request)
+                except ValueError as err:
+                    # The client is told the error, and the connection answers its next requests
+                    logger.warning(
+                        'Invalid request {}: {}'.format(msg[:80], err))
+                    metrics.count('ws_invalid_requests')
+                    await _send(json.dumps(dict(error=str(err))))
+                    continue
+
+                if request['subscribe']:
+                    await self.subscribe(websocket, request)
+                    return
 
-        df = dataset.get_latest(int(msg))
+                metrics.count('ws_requests')
+                try:
+                    code = await self.respond(websocket, request)
+                except (ValueError, TypeError) as err:
+                    # The request passes the parsing but fails the serializing
+                    logger.warning(
+                        'Failed request {}: {}'.format(msg[:80], err))
+                    metrics.count('ws_invalid_requests')
+                    await _send(json.dumps(dict(error=str(err))))
+                    continue
+                if code is None:
+                    return
+                await _send(code)
 
-        await _send(df.to_json())
+        except websockets.ConnectionClosed:
+            pass
+
+        finally:
+            metrics.discard('ws_bytes.{}'.format(peer))
 
         return
 
@@ -60,24 +853,81 @@ class WebsocketServer(object):
             :param: host: The hostname of the websocket server;
             :param: port: The port of the websocket server.
         '''
-        host = data_center_setup['host']
-        port = data_center_setup['port']
-        async_server = websockets.serve(self.handle, host, port)
-        asyncio.get_event_loop().run_until_complete(async_server)
-        asyncio.get_event_loop().run_forever()
+        # The websockets is imported only in the role serving it
+        import websockets
+
+        host = data_center_setup['host'] if host is None else host
+        port = data_center_setup['port'] if port is None else port
+
+        # The worker process of the heavy lane is started ahead
+        self.lanes['heavy'].executor.submit(warm_up)
+
+        async def _serve():
+            self.loop = asyncio.get_running_loop()
+            async with websockets.serve(self.handle, host, port, compression=data_center_setup['websocket_compression']):
+                logger.info(
+                    'Websocket server listening on {}:{}'.format(host, port))
+                await asyncio.Future()
+
+        # The serving is cancelled at the KeyboardInterrupt, so the server is closed
+        asyncio.run(_serve())
 
 
 # %%
 
-HEADER_LENGTH = main_setup['header_length']
+def ingest(receiver, dataset=None, pipeline=None):
+    '''
+    Decode the received packages, and append them into the dataset
+
+    Args:
+        :param: receiver: The FramedReceiver;
+        :param: dataset: The dataset restoring the data;
+        :param: pipeline: The DSP pipeline between decoding and appending, None for the raw data.
+    '''
+    for n, q, channels, sample_rate, dtype, flags, body in receiver.packages():
+        q2 = time.time()
+        # From the stamp of the sender to the receiving
+        metrics.observe('receive', q2 - q)
+        metrics.count('packages_received')
+        metrics.count('bytes_received', len(body))
+        if receiver.last_n is not None and n > receiver.last_n + 1:
+            metrics.count('packages_missing', n - receiver.last_n - 1)
+        receiver.last_n = n
+
+        t = time.perf_counter()
+        if flags:
+            data = unpack_body(body, channels, dtype, flags)
+        else:
+            data = decode_body(body, channels, dtype)
+        t1 = time.perf_counter()
+        metrics.observe('decode', t1 - t)
+        if pipeline is not None:
+            pipeline.configure(sample_rate)
+            data = pipeline.process(data)
+            t2 = time.perf_counter()
+            metrics.observe('pipeline', t2 - t1)
+            t1 = t2
+        if dataset is not None:
+            dataset.configure(data.shape[1], data.shape[0],
+                              data.dtype, sample_rate)
+            dataset.append(n, q, q2, data)
+            metrics.observe('append', time.perf_counter() - t1)
+        if receiver.log_sampler.ready():
+            logger.debug('Ingested {} packages in {:.2f} seconds, the latest is {} of {} at {:.3f}'.format(
+                receiver.log_sampler.count, receiver.log_sampler.period, n, data.shape, q))
 
 
 class SocketClient(object):
     ''' Socket client for Pseudo EEG Device '''
 
-    def __init__(self):
+    def __init__(self, pipeline=None):
+        '''
+        Args:
+            :param: pipeline: The DSP pipeline between decoding and appending, None for the raw data.
+        '''
         self.host = signal_sender_setup['host']
         self.port = signal_sender_setup['port']
+        self.pipeline = pipeline
 
     def connect(self):
         ''' Connect to the server '''
@@ -98,32 +948,26 @@ class SocketClient(object):
         def _loop():
             logger.info('Start receiving loop')
 
+            self.receiver = FramedReceiver(self.client)
+            stats_t = time.time()
+            t = stats_t
+
             try:
                 while self.keep_receiving:
-                    buffer = self.client.recv(80)
-                    if buffer.startswith(b'data'):
-                        output = decode_header(
-                            buffer[:HEADER_LENGTH])
-                        n = output['n']
-                        k = output['k']
-                        q = output['q']
-
-                        logger.debug('Expecting package length: {}'.format(k))
-                        while k + HEADER_LENGTH > len(buffer):
-                            buffer += self.client.recv(min(1024,
-                                                           k+HEADER_LENGTH - len(buffer)))
-
-                        if not k + HEADER_LENGTH == len(buffer):
-                            logger.error(
-                                'Received unexpected package with wrong length')
-                            break
-
-                        package = buffer[HEADER_LENGTH:]
-                        q2 = time.time()
-                        data = decode_body(package)
-                        if dataset is not None:
-                            dataset.append(n, q, q2, data)
-                        print(n, q, q2, data.shape, data[0][0])
+                    if self.receiver.read() == 0:
+                        logger.info('Connection closed by the server')
+                        break
+
+                    t = time.time()
+                    ingest(self.receiver, dataset, self.pipeline)
+
+                    if t - stats_t > 10:
+                        stats_t = t
+                        logger.info('Receiving stats: {}'.format(
+                            self.receiver.stats()))
+                        if self.pipeline is not None:
+                            logger.info('Pipeline stats: {}'.format(
+                                self.pipeline.stats()))
 
             except ConnectionAbortedError as err:
                 logger.error('ConnectionAbortedError occurred')
@@ -140,19 +984,228 @@ class SocketClient(object):
         t.start()
 
 
+class Device(object):
+    ''' The connection of the device in the DeviceHub '''
+
+    def __init__(self, name, host, port, stream, pipeline=None):
+        '''
+        Args:
+            :param: name: The name of the device;
+            :param: host: The host of the signal sender;
+            :param: port: The port of the signal sender;
+            :param: stream: The stream of the device;
+            :param: pipeline: The DSP pipeline of the device, None for the raw data.
+        '''
+        self.name = name
+        self.host = host
+        self.port = port
+        self.stream = stream
+        self.pipeline = pipeline
+        self.client = None
+        self.receiver = None
+        self.connected = False
+        # The time of the next connecting
+        self.retry_t = 0
+
+
+class DeviceHub(object):
+    '''
+    The hub receives the devices on one selector loop in one thread,
+    the sockets are non-blocking, and every device is received into its own stream.
+    The disconnected device is connected again after retry_seconds.
+    '''
+
+    def __init__(self, streams=None, retry_seconds=2.0):
+        '''
+        Args:
+            :param: streams: The dict of the streams, by the device name, None for the streams of the devices;
+            :param: retry_seconds: The seconds between the connecting tries.
+        '''
+        if streams is None:
+            streams = get_streams()
+        self.streams = streams
+        self.retry_seconds = retry_seconds
+        self.selector = selectors.DefaultSelector()
+        self.devices = dict()
+        self.keep_receiving = False
+        self.thread = None
+        metrics.gauge('devices_connected', lambda: sum(
+            e.connected for e in self.devices.values()))
+
+    def add(self, name, host, port, pipeline=None):
+        '''
+        Add the device, the new stream is created if the device is new,
+        it should be added before the WebsocketServer is created to be served.
+
+        Args:
+            :param: name: The name of the device;
+            :param: host: The host of the signal sender;
+            :param: port: The port of the signal sender;
+            :param: pipeline: The DSP pipeline of the device, None for the raw data.
+        '''
+        if name not in self.streams:
+            self.streams[name] = Stream(name)
+        self.devices[name] = Device(
+            name, host, port, self.streams[name], pipeline)
+        logger.info('Device {} of {}:{} is added'.format(name, host, port))
+
+    def _connect(self, device):
+        ''' Start connecting the device, the socket is writable when it is connected '''
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.setblocking(False)
+        try:
+            err = client.connect_ex((device.host, device.port))
+        except (OSError, OverflowError) as exc:
+            # The unresolvable host or the invalid port fails the device only
+            logger.debug('Device {} can not connect: {}'.format(
+                device.name, exc))
+            err = exc
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            client.close()
+            device.retry_t = time.time() + self.retry_seconds
+            return
+        device.client = client
+        self.selector.register(client, selectors.EVENT_WRITE, device)
+
+    def _connected(self, device):
+        ''' Check the connecting of the device, and start receiving it '''
+        err = device.client.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            logger.debug('Device {} can not connect: {}'.format(
+                device.name, os.strerror(err)))
+            self._close(device)
+            return
+        device.connected = True
+        device.receiver = FramedReceiver(device.client)
+        self.selector.modify(device.client, selectors.EVENT_READ, device)
+        logger.info('Device {} is connected to {}:{}'.format(
+            device.name, device.host, device.port))
+
+    def _close(self, device):
+        '''
+        Close the connection of the device, it is connected again later,
+        the recording of the device ends, and the next connection starts the new one.
+        '''
+        if device.connected:
+            logger.info('Device {} is disconnected'.format(device.name))
+            if device.stream.recorder is not None:
+                # The writing thread packs the chunk, the receiving loop does not wait for it
+                device.stream.recorder.close(wait=False)
+        self.selector.unregister(device.client)
+        device.client.close()
+        device.client = None
+        device.receiver = None
+        device.connected = False
+        device.retry_t = time.time() + self.retry_seconds
+
+    def _receive(self, device):
+        ''' Receive the device and ingest the packages into its stream '''
+        try:
+            if device.receiver.read() == 0:
+                self._close(device)
+                return
+        except BlockingIOError:
+            return
+        except OSError as err:
+            logger.error('Device {} receiving error: {}'.format(
+                device.name, err))
+            self._close(device)
+            return
+
+        ingest(device.receiver, device.stream.dataset, device.pipeline)
+
+    def receiving(self):
+        ''' Keep receiving the devices in the thread '''
+        self.keep_receiving = True
+
+        def _loop():
+            logger.info('Start receiving loop of {} devices'.format(
+                len(self.devices)))
+            stats_t = time.time()
+
+            while self.keep_receiving:
+                t = time.time()
+                for device in self.devices.values():
+                    if device.client is None and t >= device.retry_t:
+                        self._connect(device)
+
+                for key, mask in self.selector.select(timeout=0.5):
+                    device = key.data
+                    try:
+                        if device.connected:
+                            self._receive(device)
+                        else:
+                            self._connected(device)
+                    except Exception as err:
+                        logger.error('Device {} unknown error occurs {}'.format(
+                            device.name, err))
+                        logger.error(traceback.format_exc())
+                        self._close(device)
+
+                if t - stats_t > 10:
+                    stats_t = t
+                    for device in self.devices.values():
+                        if device.connected:
+                            logger.info('Device {} receiving stats: {}'.format(
+                                device.name, device.receiver.stats()))
+                        if device.pipeline is not None:
+                            logger.info('Device {} pipeline stats: {}'.format(
+                                device.name, device.pipeline.stats()))
+
+            for device in self.devices.values():
+                if device.client is not None:
+                    self._close(device)
+            logger.info('Stop receiving loop')
+
+        self.thread = threading.Thread(target=_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        ''' Stop receiving the devices, it waits for the receiving loop closing the devices '''
+        self.keep_receiving = False
+        if self.thread is not None:
+            self.thread.join()
+
+
 # %%
-if __name__ == '__main__':
-    try:
-        client = SocketClient()
-        client.connect()
-        client.receiving(dataset)
-    except:
-        print('!!! Can not connect to server !!!')
+def main(argv=None, prog=None):
+    '''
+    Run the data center, it receives the devices and serves the websocket
+
+    Args:
+        :param: argv: The command line arguments, None for the sys.argv;
+        :param: prog: The program name of the usage.
+    '''
+    parser = argparse.ArgumentParser(
+        prog=prog, description='EEG data center')
+    parser.add_argument('--port', type=int, default=data_center_setup['port'],
+                        help='The port of the websocket server')
+    args = parser.parse_args(argv)
+
+    metrics.keep_snapshotting(snapshot_path('data_center'))
+
+    hub = DeviceHub()
+    for name, (host, port) in data_center_setup['devices'].items():
+        pipeline = None
+        if data_center_setup['pipeline'] is not None:
+            pipeline = Pipeline.from_setup(data_center_setup['pipeline'])
+        hub.add(name, host, port, pipeline)
+    hub.receiving()
 
+    # The websocket server runs until the KeyboardInterrupt
     ws = WebsocketServer()
-    ws.start()
+    try:
+        ws.start(port=args.port)
+    except KeyboardInterrupt:
+        logger.info('Data center is interrupted')
+    finally:
+        # The recordings are closed after the last packages are received
+        hub.stop()
+        for stream in get_streams().values():
+            stream.close()
+
+    print(get_streams()[default_device].dataset.get_latest())
 
-    input('Press Enter to quit')
 
-    print(dataset.get_latest())
-    pass
+if __name__ == '__main__':
+    main()
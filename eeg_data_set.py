@@ -7,7 +7,9 @@ The DataSet of the EEG data.
 '''
 
 # %%
-import pandas as pd
+import numpy as np
+
+from collections import namedtuple
 from main_setup import main_setup, logger
 
 # %%
@@ -19,26 +21,123 @@ data_limit_seconds = 1800
 
 # %%
 default_latest_length = int(
-    default_latest_length_seconds * main_setup['sample_rate'] / main_setup['interval'])
-logger.info('Default latest length is set to {} seconds'.format(
-    default_latest_length_seconds))
+    default_latest_length_seconds * 1000 / main_setup['interval'])
+
+data_limit = int(data_limit_seconds * 1000 / main_setup['interval'])
+
+data_length = int(main_setup['interval'] / 1000 * main_setup['sample_rate'])
+
+# The segments of the dataset,
+# idx, query and query2 are the arrays of the packages,
+# data is the 2D array of the samples (samples x channels).
+Segments = namedtuple('Segments', ['idx', 'query', 'query2', 'data'])
+
+
+def segments_dataframe(segments, samples, channels):
+    '''
+    Convert the segments into the dataframe,
+    the data column contains the 2D array of every segment.
+
+    Args:
+        :param: segments: The Segments;
+        :param: samples: The samples in every package;
+        :param: channels: The channels.
 
-data_limit = int(data_limit_seconds *
-                 main_setup['sample_rate'] / main_setup['interval'])
-data_limit_overflow = int(data_limit_seconds * 1.5 *
-                          main_setup['sample_rate'] / main_setup['interval'])
-logger.info('Data limit is set to {} seconds'.format(data_limit_seconds))
+    Return:
+        return: df: The dataframe of the segments.
+    '''
+    # The pandas is heavy, it is imported only when the dataframe is required
+    import pandas as pd
+
+    df = pd.DataFrame(dict(
+        idx=segments.idx,
+        query=segments.query,
+        query2=segments.query2,
+        data=list(segments.data.reshape(-1, samples, channels)),
+    ))
+
+    df = df[['idx', 'query', 'query2', 'data']]
+    return df
 
 
 class DataSet(object):
-    ''' Main dataset of the Pseudo EEG Device Signal '''
+    '''
+    Main dataset of the Pseudo EEG Device Signal.
+
+    The signal is restored in the preallocated ring buffer,
+    the samples are in the (capacity x samples, channels) array,
+    and the idx, query and query2 are in the parallel metadata arrays.
 
-    def __init__(self):
+    The query is increasing, and so is the idx in the run of the sender,
+    the ring of them is at most two sorted parts,
+    so the packages are searched by the time stamp or the idx in O(log n).
+    '''
+
+    def __init__(self, channels=main_setup['channels'], samples=data_length,
+                 capacity=data_limit, dtype=np.int32, sample_rate=main_setup['sample_rate']):
+        '''
+        Args:
+            :param: channels: The channels of the signal;
+            :param: samples: The samples in every package;
+            :param: capacity: The max number of the packages being restored;
+            :param: dtype: The dtype of the samples;
+            :param: sample_rate: The sample rate of the signal.
+        '''
+        self.channels = channels
+        self.samples = samples
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.sample_rate = sample_rate
+        self.listeners = []
+        self.configure_listeners = []
+        logger.info('Dataset restores {} packages, the default latest length is {} seconds'.format(
+            capacity, default_latest_length_seconds))
         self.reset()
 
     def reset(self):
         ''' Reset the dataset '''
-        self.dataset = []
+        self.idx = np.zeros(self.capacity, dtype=np.int64)
+        self.query = np.zeros(self.capacity, dtype=np.float64)
+        self.query2 = np.zeros(self.capacity, dtype=np.float64)
+        self.data = np.zeros((self.capacity * self.samples, self.channels),
+                             dtype=self.dtype)
+        # The total count of the appended packages
+        self.count = 0
+        # The count of the first package of the current run of the sender,
+        # the run restarts when the idx is not increasing
+        self.run_start = 0
+        logger.debug('Dataset is reset with {} packages of {} x {} samples'.format(
+            self.capacity, self.samples, self.channels))
+
+    def configure(self, channels, samples, dtype=None, sample_rate=None):
+        '''
+        Configure the shape and sample rate of the signal,
+        the dataset is reset if the shape, dtype or sample rate changes,
+        and the capacity is scaled to keep the samples being restored.
+        The configure listeners are called after the reset.
+
+        Args:
+            :param: channels: The channels of the signal;
+            :param: samples: The samples in every package;
+            :param: dtype: The dtype of the samples, None for not changing;
+            :param: sample_rate: The sample rate of the signal, None for not changing.
+        '''
+        dtype = self.dtype if dtype is None else np.dtype(dtype)
+        sample_rate = self.sample_rate if sample_rate is None else sample_rate
+        if channels == self.channels and samples == self.samples and dtype == self.dtype and sample_rate == self.sample_rate:
+            return
+
+        logger.warning('Dataset is reconfigured from {} x {} {} at {} Hz to {} x {} {} at {} Hz'.format(
+            self.samples, self.channels, self.dtype, self.sample_rate, samples, channels, dtype, sample_rate))
+        self.capacity = max(1, self.capacity * self.samples // samples)
+        self.channels = channels
+        self.samples = samples
+        self.dtype = dtype
+        self.sample_rate = sample_rate
+        self.reset()
+
+        for listener in self.configure_listeners:
+            listener(channels, samples, dtype, sample_rate)
 
     def append(self, n, q, q2, data):
         '''
@@ -50,34 +149,226 @@ class DataSet(object):
             :param: q2: The timestamp of receiving the signal segment
             :param: data: The 2D array of the signal segment
         '''
+        if not data.shape == (self.samples, self.channels):
+            logger.error('Invalid data shape {}, expected {}'.format(
+                data.shape, (self.samples, self.channels)))
+            return
+
+        if self.count > 0 and n <= self.idx[(self.count - 1) % self.capacity]:
+            logger.info('Dataset starts the new run at package {}'.format(n))
+            self.run_start = self.count
 
-        if self.length() > data_limit_overflow:
-            self.dataset = self.dataset[-data_limit >> 1:]
-            logger.warning(
-                'Dataset is beyond its limit * 1.5, shrinking it back to its limit')
+        slot = self.count % self.capacity
+        self.idx[slot] = n
+        self.query[slot] = q
+        self.query2[slot] = q2
+        segment = self.data[slot * self.samples:(slot + 1) * self.samples]
+        segment[:] = data
+        self.count += 1
 
-        self.dataset.append((n, q, q2, data))
+        for listener in self.listeners:
+            listener(n, q, q2, segment)
+
+    def add_listener(self, listener):
+        '''
+        Add the listener being called after every append,
+        as listener(n, q, q2, data), the data is the view of the ring.
+
+        Args:
+            :param: listener: The callable listener.
+        '''
+        self.listeners.append(listener)
+
+    def add_configure_listener(self, listener):
+        '''
+        Add the listener being called after the dataset is reconfigured,
+        as listener(channels, samples, dtype, sample_rate).
+
+        Args:
+            :param: listener: The callable listener.
+        '''
+        self.configure_listeners.append(listener)
+
+    def remove_listener(self, listener):
+        '''
+        Remove the listener
+
+        Args:
+            :param: listener: The callable listener.
+        '''
+        if listener in self.listeners:
+            self.listeners.remove(listener)
 
     def length(self):
         '''
         Get the length of the dataset
         '''
-        return len(self.dataset)
+        return min(self.count, self.capacity)
+
+    def _take(self, array, start, stop, scale=1):
+        '''
+        Take the packages from start to stop (in count) of the ring array,
+        it is a view unless the range wraps around the end of the ring.
+
+        Args:
+            :param: array: The ring array;
+            :param: start: The first package in count;
+            :param: stop: The package after the last package in count;
+            :param: scale: The rows of every package in the array.
+        '''
+        a = start % self.capacity
+        b = a + stop - start
+        if b <= self.capacity:
+            return array[a * scale:b * scale]
+        return np.concatenate([array[a * scale:],
+                               array[:(b - self.capacity) * scale]])
+
+    def _search(self, array, value, side='left', start=None):
+        '''
+        Search the sorted ring array by the binary search of its two parts.
+
+        Args:
+            :param: array: The ring array, it is sorted from the start to the latest package;
+            :param: value: The value to search;
+            :param: side: The side of the searchsorted, 'left' or 'right';
+            :param: start: The first package in count being searched, None for the oldest package.
+
+        Return:
+            :return: The package in count where the value would be inserted.
+        '''
+        oldest = self.count - self.length()
+        start = oldest if start is None else max(start, oldest)
+        a = start % self.capacity
+        m = self.count - start
+        if a + m <= self.capacity:
+            return start + int(np.searchsorted(array[a:a + m], value, side))
+
+        older = array[a:]
+        k = int(np.searchsorted(older, value, side))
+        if k < len(older):
+            return start + k
+        return start + k + int(np.searchsorted(array[:a + m - self.capacity], value, side))
+
+    def get_packages(self, start, stop):
+        '''
+        Get the packages from start to stop in count.
+        The arrays are views of the ring buffer if possible,
+        so copy them if they are required to outlive the ring.
+
+        Args:
+            :param: start: The first package in count;
+            :param: stop: The package after the last package in count.
+
+        Return:
+            return: segments: The Segments of the idx, query, query2 and data.
+        '''
+        start = max(start, self.count - self.length())
+        stop = max(start, min(stop, self.count))
+        return Segments(
+            idx=self._take(self.idx, start, stop),
+            query=self._take(self.query, start, stop),
+            query2=self._take(self.query2, start, stop),
+            data=self._take(self.data, start, stop, self.samples),
+        )
 
     def get_latest(self, latest=default_latest_length):
         '''
-        Convert the dataset into the dataframe
+        Get the latest segments of the dataset.
+        The arrays are views of the ring buffer if possible,
+        so copy them if they are required to outlive the ring.
 
         Args:
             :param: latest: Require the latest n segments.
 
         Return:
-            return: df: The dataframe of the dataset.
+            return: segments: The Segments of the idx, query, query2 and data.
         '''
-        df = pd.DataFrame(self.dataset[-latest:],
-                          columns=['idx', 'query', 'query2', 'data'])
+        latest = max(0, min(latest, self.length()))
+        return self.get_packages(self.count - latest, self.count)
 
-        df = df[['idx', 'query', 'query2', 'data']]
-        return df
+    def get_range(self, t_start, t_end):
+        '''
+        Get the packages whose query is in [t_start, t_end),
+        the samples are the contiguous block of the packages.
 
-# %%
+        Args:
+            :param: t_start: The start time stamp;
+            :param: t_end: The end time stamp.
+
+        Return:
+            return: segments: The Segments of the idx, query, query2 and data.
+        '''
+        return self.get_packages(self._search(self.query, t_start),
+                                 self._search(self.query, t_end))
+
+    def get_since(self, idx):
+        '''
+        Get the packages after the package idx in the current run of the sender,
+        all the packages of the run are returned if the idx is older than them,
+        or if the idx is newer than the latest package, it is of the previous run.
+
+        Args:
+            :param: idx: The idx of the latest package being received.
+
+        Return:
+            return: segments: The Segments of the idx, query, query2 and data.
+        '''
+        if self.count > 0 and idx > self.idx[(self.count - 1) % self.capacity]:
+            return self.get_packages(self.run_start, self.count)
+
+        start = self._search(self.idx, idx, 'right', self.run_start)
+        return self.get_packages(start, self.count)
+
+    def count_since(self, idx):
+        '''
+        Count the packages after the package idx in the current run of the sender,
+        it is the length of the get_since without taking the packages.
+
+        Args:
+            :param: idx: The idx of the latest package being received.
+
+        Return:
+            :return: The count of the packages.
+        '''
+        if self.count > 0 and idx > self.idx[(self.count - 1) % self.capacity]:
+            start = self.run_start
+        else:
+            start = self._search(self.idx, idx, 'right', self.run_start)
+        return self.count - max(start, self.count - self.length())
+
+    def contains(self, idx):
+        '''
+        Whether the package idx of the current run of the sender is in the dataset.
+
+        Args:
+            :param: idx: The idx of the package.
+        '''
+        pos = self._search(self.idx, idx, 'left', self.run_start)
+        return pos < self.count and self.idx[pos % self.capacity] == idx
+
+    def sample_times(self, query):
+        '''
+        Get the time stamps of the samples of the packages,
+        the sample j of the package is query + j / sample_rate.
+
+        Args:
+            :param: query: The time stamps of the packages.
+
+        Return:
+            :return: The time stamps of the samples, (packages x samples,).
+        '''
+        return (np.asarray(query)[:, np.newaxis] +
+                np.arange(self.samples) / self.sample_rate).ravel()
+
+    def get_latest_dataframe(self, latest=default_latest_length):
+        '''
+        Convert the latest segments into the dataframe,
+        the data column contains the 2D array of every segment.
+
+        Args:
+            :param: latest: Require the latest n segments.
+
+        Return:
+            return: df: The dataframe of the dataset.
+        '''
+        return segments_dataframe(self.get_latest(latest), self.samples, self.channels)
@@ -0,0 +1,256 @@
+'''
+File: eeg_generator.py
+Author: listenzcc
+Date: 2023-01-16
+
+The synthetic EEG-like signal generator.
+
+The signal is mixed from the latent sources into the channels,
+the latent sources are the 1/f background, the alpha and beta oscillations,
+the line noise and the blinks, and the independent sensor noise is added.
+The batch of the samples is generated at once,
+and the phases and filter states are carried across the batches,
+so the signal is continuous across the packages.
+'''
+
+# %%
+import numpy as np
+
+from main_setup import main_setup, logger
+
+# %%
+# The corner frequencies of the AR(1) components of the 1/f background,
+# the sum of the Lorentzians of the log-spaced corners approximates the 1/f spectrum
+default_corners = [0.5, 2.0, 8.0, 32.0, 128.0]
+# The amplitudes in µV
+default_amplitudes = dict(
+    background=10.0,
+    alpha=12.0,
+    beta=4.0,
+    line=3.0,
+    blink=120.0,
+    noise=2.0,
+)
+# The rate of the blinks per second, and the duration of the blink in seconds
+blink_rate = 0.25
+blink_duration = 0.4
+
+
+def ar1_block_filter(e, a, state, transfer, carry):
+    '''
+    Filter the innovations with the bank of AR(1) filters, x[t] = a x[t-1] + e[t],
+    the recursion is solved in the closed form on the blocks,
+    the samples inside the block are the matmul with the Toeplitz matrix,
+    and the states between the blocks are the matmul with the Toeplitz matrix of the block ends.
+
+    Args:
+        :param: e: The innovations, (sources x blocks x block);
+        :param: a: The poles of the filters, (sources,);
+        :param: state: The last outputs of the previous batch, (sources,);
+        :param: transfer: The Toeplitz matrices of a^(i-j) in the block, (sources x block x block);
+        :param: carry: The Toeplitz matrices of a^(block x (i-j)) between the blocks, (sources x blocks x blocks).
+
+    Return:
+        :return: x: The outputs, (sources x blocks x block);
+        :return: state: The last outputs of the batch, (sources,).
+    '''
+    blocks, block = e.shape[1], e.shape[2]
+    # The responses of the blocks from the zero states
+    y = np.matmul(e, transfer.transpose(0, 2, 1))
+    # The states of the block ends, s[b] = y[b, -1] + a^block s[b-1]
+    ends = np.matmul(carry, y[:, :, -1:])[:, :, 0]
+    ends += np.power(a[:, np.newaxis] ** block,
+                     np.arange(1, blocks + 1)) * state[:, np.newaxis]
+    # The states before the blocks decay into the blocks
+    before = np.concatenate([state[:, np.newaxis], ends[:, :-1]], axis=1)
+    decay = np.power(a[:, np.newaxis], np.arange(1, block + 1))
+    y += before[:, :, np.newaxis] * decay[:, np.newaxis, :]
+    return y, ends[:, -1].copy()
+
+
+class SyntheticSource(object):
+    '''
+    The source of the synthetic EEG-like signal.
+    The channels are placed on the line from the frontal (0) to the occipital (1) sites,
+    the mixing weights of the latent sources are smooth along the line.
+    '''
+
+    def __init__(self, channels=main_setup['channels'], sample_rate=main_setup['sample_rate'],
+                 batch_seconds=1.0, block=64, resolution=0.1, dtype='<i4', line_frequency=50.0,
+                 seed=None):
+        '''
+        Args:
+            :param: channels: The channels of the source;
+            :param: sample_rate: The sample rate of the source;
+            :param: batch_seconds: The seconds of the samples generated at once;
+            :param: block: The samples of the block of the AR(1) closed form;
+            :param: resolution: The µV of the unit of the integer samples;
+            :param: dtype: The dtype of the samples, '<i4' in the resolution units, or '<f4' in µV;
+            :param: line_frequency: The frequency of the line noise;
+            :param: seed: The seed of the random generator.
+        '''
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.dtype = np.dtype(dtype)
+        self.resolution = resolution
+        self.rng = np.random.default_rng(seed)
+
+        # The batch is the whole blocks
+        self.block = block
+        self.blocks = max(1, int(np.ceil(batch_seconds * sample_rate / block)))
+        self.batch = self.blocks * block
+
+        self._setup_background()
+        self._setup_oscillators(line_frequency)
+        self._setup_mixing()
+
+        # The pending samples of the latest batch, and its cursor
+        self.pending = np.zeros((0, channels), dtype=self.dtype)
+        self.cursor = 0
+        # The tail of the blinks crossing the batches
+        self.blink_tail = np.zeros(0, dtype=np.float32)
+
+        logger.info('Synthetic source of {} channels at {} Hz, {} samples every batch'.format(
+            channels, sample_rate, self.batch))
+
+    def _setup_background(self):
+        ''' Setup the AR(1) bank of the 1/f background '''
+        corners = np.array(
+            [e for e in default_corners if e < self.sample_rate / 2])
+        self.poles = np.exp(-2 * np.pi * corners / self.sample_rate)
+        # Every component has the same variance
+        self.gains = np.sqrt(1 - self.poles ** 2) / np.sqrt(len(corners))
+        self.states = np.zeros(len(corners))
+
+        i = np.arange(self.block)
+        lag = i[:, np.newaxis] - i[np.newaxis, :]
+        self.transfer = np.where(
+            lag >= 0, self.poles[:, np.newaxis, np.newaxis] ** np.maximum(lag, 0), 0)
+        b = np.arange(self.blocks)
+        lag = b[:, np.newaxis] - b[np.newaxis, :]
+        self.carry = np.where(lag >= 0,
+                              (self.poles[:, np.newaxis, np.newaxis] ** self.block) ** np.maximum(lag, 0), 0)
+
+    def _setup_oscillators(self, line_frequency):
+        ''' Setup the frequencies and phases of the oscillators '''
+        # alpha, beta, line, and the slow amplitude modulations of the alpha and beta
+        self.frequencies = np.array([10.0, 20.0, line_frequency,
+                                     self.rng.uniform(0.1, 0.3), self.rng.uniform(0.2, 0.5)])
+        self.phases = self.rng.uniform(0, 2 * np.pi, len(self.frequencies))
+        self.steps = 2 * np.pi * self.frequencies / self.sample_rate
+        self.ramp = np.arange(self.batch)[:, np.newaxis] * self.steps[np.newaxis, :]
+
+        n = max(1, int(blink_duration * self.sample_rate))
+        self.blink_template = (
+            0.5 - 0.5 * np.cos(2 * np.pi * np.arange(n) / n)).astype(np.float32)
+
+    def _setup_mixing(self):
+        ''' Setup the mixing matrix of the latent sources into the channels '''
+        x = np.linspace(0, 1, self.channels)
+        amp = default_amplitudes
+        k = len(self.poles)
+        # The background components are spread along the line with the random signs
+        centers = self.rng.uniform(0, 1, (k, 1))
+        background = np.exp(-((x - centers) / 0.3) ** 2) * \
+            self.rng.choice([-1, 1], (k, 1))
+        background *= amp['background'] / \
+            np.sqrt(np.mean(background ** 2, axis=1, keepdims=True))
+        self.mixing = np.concatenate([
+            background,
+            amp['alpha'] * np.exp(-((x - 0.85) / 0.25) ** 2)[np.newaxis],
+            amp['beta'] * np.exp(-((x - 0.5) / 0.25) ** 2)[np.newaxis],
+            amp['line'] * self.rng.uniform(0.7, 1.3, (1, self.channels)),
+            amp['blink'] * np.exp(-x / 0.1)[np.newaxis],
+        ]).astype(np.float32)
+
+    def _blinks(self):
+        ''' Generate the blink course of the batch, the tail crossing the batch is carried '''
+        course = np.zeros(self.batch + len(self.blink_template), dtype=np.float32)
+        course[:len(self.blink_tail)] += self.blink_tail
+        # There are a few blinks every batch
+        m = self.rng.poisson(blink_rate * self.batch / self.sample_rate)
+        n = len(self.blink_template)
+        for onset in self.rng.integers(0, self.batch, m):
+            course[onset:onset + n] += self.blink_template
+        self.blink_tail = course[self.batch:].copy()
+        return course[:self.batch]
+
+    def generate(self):
+        '''
+        Generate the next batch
+
+        Return:
+            :return: data: The 2D array of the samples, (batch x channels).
+        '''
+        k = len(self.poles)
+        latent = np.empty((self.batch, k + 4), dtype=np.float32)
+
+        # The 1/f background
+        e = self.rng.standard_normal((k, self.blocks, self.block)) * \
+            self.gains[:, np.newaxis, np.newaxis]
+        x, self.states = ar1_block_filter(
+            e, self.poles, self.states, self.transfer, self.carry)
+        latent[:, :k] = x.reshape(k, -1).T
+
+        # The oscillators, the phases are carried
+        s = np.sin(self.ramp + self.phases)
+        self.phases = (self.phases + self.steps * self.batch) % (2 * np.pi)
+        latent[:, k] = s[:, 0] * (1 + 0.6 * s[:, 3])
+        latent[:, k + 1] = s[:, 1] * (1 + 0.6 * s[:, 4])
+        latent[:, k + 2] = s[:, 2]
+        latent[:, k + 3] = self._blinks()
+
+        data = np.matmul(latent, self.mixing)
+        data += self.rng.standard_normal((self.batch, self.channels), dtype=np.float32) * \
+            default_amplitudes['noise']
+
+        if self.dtype.kind == 'f':
+            return data.astype(self.dtype)
+        data *= 1 / self.resolution
+        return data.astype(self.dtype)
+
+    def read(self, samples):
+        '''
+        Read the next samples
+
+        Args:
+            :param: samples: The number of the samples.
+
+        Return:
+            :return: data: The 2D array of the samples, (samples x channels).
+        '''
+        parts = []
+        remain = samples
+        while remain > 0:
+            if self.cursor >= len(self.pending):
+                self.pending = self.generate()
+                self.cursor = 0
+            m = min(remain, len(self.pending) - self.cursor)
+            parts.append(self.pending[self.cursor:self.cursor + m])
+            self.cursor += m
+            remain -= m
+
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+
+# %%
+if __name__ == '__main__':
+    import time
+
+    source = SyntheticSource(256, 10000)
+    source.read(1)
+    t = time.perf_counter()
+    for _ in range(10):
+        data = source.read(10000)
+    cost = (time.perf_counter() - t) / 10
+    print('256 channels at 10 kHz costs {:.1f} % of one core'.format(cost * 100))
+
+    source = SyntheticSource(4, 1000, dtype='<f4')
+    data = source.read(60000)
+    spectrum = np.abs(np.fft.rfft(data[:, -1] - data[:, -1].mean())) ** 2
+    freqs = np.fft.rfftfreq(len(data), 1 / 1000)
+    for f in [1, 5, 10, 20, 50, 100]:
+        band = (freqs > f - 0.5) & (freqs < f + 0.5)
+        print('{} Hz: {:.2e}'.format(f, spectrum[band].mean()))
@@ -0,0 +1,390 @@
+'''
+File: eeg_pipeline.py
+Author: listenzcc
+Date: 2023-01-17
+
+The streaming DSP pipeline of the EEG data.
+
+The pipeline works between decoding the package and appending it into the DataSet,
+every stage processes one segment at a time, vectorized over the channels,
+and the states of the filters are carried across the segments,
+so the data is filtered once at the ingest.
+'''
+
+# %%
+import time
+import numpy as np
+
+from main_setup import main_setup, logger
+
+try:
+    from scipy.signal import sosfilt
+except ImportError:
+    sosfilt = None
+
+# %%
+
+
+def biquad(kind, freq, sample_rate, q=np.sqrt(0.5)):
+    '''
+    Design the second-order section by the RBJ cookbook
+
+    Args:
+        :param: kind: The kind of the section, 'lowpass', 'highpass' or 'notch';
+        :param: freq: The corner or center frequency;
+        :param: sample_rate: The sample rate;
+        :param: q: The quality factor.
+
+    Return:
+        :return: sos: The section of b0, b1, b2, a0, a1, a2, normalized by a0.
+    '''
+    w = 2 * np.pi * freq / sample_rate
+    cos, alpha = np.cos(w), np.sin(w) / (2 * q)
+    if kind == 'lowpass':
+        b = [(1 - cos) / 2, 1 - cos, (1 - cos) / 2]
+    elif kind == 'highpass':
+        b = [(1 + cos) / 2, -(1 + cos), (1 + cos) / 2]
+    elif kind == 'notch':
+        b = [1, -2 * cos, 1]
+    else:
+        raise ValueError('Unknown biquad kind {}'.format(kind))
+    a = [1 + alpha, -2 * cos, 1 - alpha]
+    return np.array(b + a) / a[0]
+
+
+def bandpass_sos(low, high, sample_rate, order=2):
+    '''
+    Design the band-pass filter as the cascade of the high-pass and low-pass sections
+
+    Args:
+        :param: low: The low corner frequency;
+        :param: high: The high corner frequency;
+        :param: sample_rate: The sample rate;
+        :param: order: The sections of the high-pass and the low-pass.
+
+    Return:
+        :return: sos: The second-order sections, (sections x 6).
+    '''
+    return np.array([biquad('highpass', low, sample_rate)] * order +
+                    [biquad('lowpass', high, sample_rate)] * order)
+
+
+def notch_sos(freq, sample_rate, q=30.0):
+    '''
+    Design the notch filter
+
+    Args:
+        :param: freq: The center frequency;
+        :param: sample_rate: The sample rate;
+        :param: q: The quality factor.
+
+    Return:
+        :return: sos: The second-order sections, (1 x 6).
+    '''
+    return np.array([biquad('notch', freq, sample_rate, q)])
+
+
+def allpole_matrices(a1, a2, length):
+    '''
+    The closed form of the all-pole recursion y[n] = w[n] - a1 y[n-1] - a2 y[n-2] on the block,
+    y = H w + g1 y[-1] + g2 y[-2].
+
+    Args:
+        :param: a1: The coefficient a1;
+        :param: a2: The coefficient a2;
+        :param: length: The samples of the block.
+
+    Return:
+        :return: H: The Toeplitz matrix of the impulse response, (length x length);
+        :return: g: The responses of the states y[-1] and y[-2], (length x 2).
+    '''
+    h = np.zeros(length + 2)
+    g = np.zeros((length + 2, 2))
+    h[2] = 1
+    g[0, 1], g[1, 0] = 1, 1
+    for n in range(2, length + 2):
+        h[n] += -a1 * h[n - 1] - a2 * h[n - 2]
+        g[n] = -a1 * g[n - 1] - a2 * g[n - 2]
+    h, g = h[2:], g[2:]
+    i = np.arange(length)
+    lag = i[:, np.newaxis] - i[np.newaxis, :]
+    H = np.where(lag >= 0, h[np.maximum(lag, 0)], 0)
+    return H, g
+
+
+class NumpySosfilt(object):
+    '''
+    The fallback of the scipy sosfilt along the axis 0, in the direct form I.
+    The cascade of the sections is linear in the samples of the block and the states,
+    so it is composed into the matrix of the block once, by the basis through the sections,
+    and the block is filtered by the matmul, there is no loop over the samples.
+    The states are (x[-1], x[-2], y[-1], y[-2]) of every section, (sections x 4 x channels).
+    '''
+
+    def __init__(self, sos, block=64):
+        '''
+        Args:
+            :param: sos: The second-order sections, (sections x 6);
+            :param: block: The max samples of the block.
+        '''
+        self.sos = sos
+        self.block = block
+        self.composites = dict()
+
+    def _sections(self, y, zi):
+        '''
+        Filter the block through the sections in the closed form
+
+        Args:
+            :param: y: The samples of the block, (samples x columns);
+            :param: zi: The states, (sections x 4 x columns).
+        '''
+        zi = zi.copy()
+        n = len(y)
+        for s, (b0, b1, b2, a0, a1, a2) in enumerate(self.sos):
+            x1, x2, y1, y2 = zi[s]
+            ext = np.concatenate([x2[np.newaxis], x1[np.newaxis], y])
+            w = b0 * ext[2:] + b1 * ext[1:-1] + b2 * ext[:-2]
+            H, g = allpole_matrices(a1, a2, n)
+            out = H @ w + g[:, :1] * y1 + g[:, 1:] * y2
+            yext = np.concatenate([y2[np.newaxis], y1[np.newaxis], out])
+            zi[s] = ext[-1], ext[-2], yext[-1], yext[-2]
+            y = out
+        return y, zi
+
+    def _composite(self, length):
+        '''
+        The matrix mapping the samples and the states of the block into the outputs and the new states
+
+        Args:
+            :param: length: The samples of the block.
+
+        Return:
+            :return: The matrix, (length + states) x (length + states).
+        '''
+        if length not in self.composites:
+            states = len(self.sos) * 4
+            basis = np.eye(length + states)
+            y, zi = self._sections(
+                basis[:length], basis[length:].reshape(len(self.sos), 4, -1))
+            self.composites[length] = np.concatenate(
+                [y, zi.reshape(states, -1)])
+        return self.composites[length]
+
+    def __call__(self, x, zi):
+        '''
+        Filter the samples
+
+        Args:
+            :param: x: The samples, (samples x channels);
+            :param: zi: The states, (sections x 4 x channels).
+
+        Return:
+            :return: y: The filtered samples;
+            :return: zi: The new states.
+        '''
+        x = np.asarray(x, dtype=np.float64)
+        z = zi.reshape(-1, x.shape[1])
+        y = np.empty_like(x)
+        for a in range(0, len(x), self.block):
+            m = min(self.block, len(x) - a)
+            A = self._composite(m)
+            r = A[:, :m] @ x[a:a + m] + A[:, m:] @ z
+            y[a:a + m] = r[:m]
+            z = r[m:]
+        return y, z.reshape(zi.shape)
+
+
+class Stage(object):
+    '''
+    The stage of the pipeline,
+    the stage is reset when the channels of the segments change.
+    '''
+    name = 'stage'
+
+    def reset(self, channels):
+        '''
+        Reset the states of the stage
+
+        Args:
+            :param: channels: The channels of the segments.
+        '''
+        pass
+
+    def process(self, data):
+        '''
+        Process the segment
+
+        Args:
+            :param: data: The 2D array of the segment, (samples x channels).
+
+        Return:
+            :return: The processed segment.
+        '''
+        return data
+
+
+class Scale(Stage):
+    ''' Scale the samples into µV of float32 '''
+    name = 'scale'
+
+    def __init__(self, resolution=0.1):
+        '''
+        Args:
+            :param: resolution: The µV of the unit of the samples.
+        '''
+        self.resolution = resolution
+
+    def process(self, data):
+        return np.multiply(data, self.resolution, dtype=np.float32)
+
+
+class SosFilter(Stage):
+    ''' Filter the samples with the second-order sections, the states are carried '''
+
+    def __init__(self, sos, name='sos'):
+        '''
+        Args:
+            :param: sos: The second-order sections, (sections x 6);
+            :param: name: The name of the stage.
+        '''
+        self.sos = np.asarray(sos, dtype=np.float64)
+        self.name = name
+        self.zi = None
+        self.sosfilt = None if sosfilt is not None else NumpySosfilt(self.sos)
+
+    def reset(self, channels):
+        states = 2 if self.sosfilt is None else 4
+        self.zi = np.zeros((len(self.sos), states, channels))
+
+    def process(self, data):
+        if self.sosfilt is None:
+            y, self.zi = sosfilt(self.sos, data, axis=0, zi=self.zi)
+        else:
+            y, self.zi = self.sosfilt(data, self.zi)
+        return y.astype(data.dtype, copy=False)
+
+
+class CommonAverage(Stage):
+    ''' Re-reference the samples to the common average of the channels '''
+    name = 'car'
+
+    def process(self, data):
+        return data - data.mean(axis=1, keepdims=True, dtype=np.float64).astype(data.dtype)
+
+
+class Pipeline(object):
+    '''
+    The pipeline of the stages, every stage is timed.
+    '''
+
+    def __init__(self, stages, setup=None, sample_rate=main_setup['sample_rate']):
+        '''
+        Args:
+            :param: stages: The list of the stages;
+            :param: setup: The setup dict of the stages, the stages are built again from it if the sample rate changes;
+            :param: sample_rate: The sample rate of the stages.
+        '''
+        self.stages = stages
+        self.setup = setup
+        self.sample_rate = sample_rate
+        self.channels = None
+        # The calls, total and max seconds of every stage
+        self.timing = np.zeros((len(stages), 3))
+
+    @classmethod
+    def from_setup(cls, setup, sample_rate=main_setup['sample_rate']):
+        '''
+        Build the pipeline from the setup dict
+
+        Args:
+            :param: setup: The dict of resolution, bandpass, notch and car, the None value skips the stage;
+            :param: sample_rate: The sample rate of the segments.
+        '''
+        stages = []
+        if setup.get('resolution') is not None:
+            stages.append(Scale(setup['resolution']))
+        if setup.get('bandpass') is not None:
+            low, high = setup['bandpass']
+            stages.append(SosFilter(bandpass_sos(
+                low, high, sample_rate), 'bandpass'))
+        if setup.get('notch') is not None:
+            stages.append(SosFilter(notch_sos(
+                setup['notch'], sample_rate), 'notch'))
+        if setup.get('car'):
+            stages.append(CommonAverage())
+        logger.info('Pipeline of {} at {} Hz, filtering with the {}'.format(
+            [e.name for e in stages], sample_rate, 'NumpySosfilt' if sosfilt is None else 'scipy sosfilt'))
+        return cls(stages, setup, sample_rate)
+
+    def configure(self, sample_rate):
+        '''
+        Build the stages again if the sample rate changes,
+        the filters are designed for the sample rate.
+
+        Args:
+            :param: sample_rate: The sample rate of the segments.
+        '''
+        if sample_rate == self.sample_rate or self.setup is None:
+            return
+
+        logger.warning('Pipeline is reconfigured from {} Hz to {} Hz'.format(
+            self.sample_rate, sample_rate))
+        self.stages = self.from_setup(self.setup, sample_rate).stages
+        self.sample_rate = sample_rate
+        self.channels = None
+        self.timing = np.zeros((len(self.stages), 3))
+
+    def process(self, data):
+        '''
+        Process the segment through the stages
+
+        Args:
+            :param: data: The 2D array of the segment, (samples x channels).
+
+        Return:
+            :return: The processed segment.
+        '''
+        if not data.shape[1] == self.channels:
+            self.channels = data.shape[1]
+            for stage in self.stages:
+                stage.reset(self.channels)
+            logger.debug('Pipeline is reset with {} channels'.format(
+                self.channels))
+
+        for i, stage in enumerate(self.stages):
+            t = time.perf_counter()
+            data = stage.process(data)
+            t = time.perf_counter() - t
+            timing = self.timing[i]
+            timing[0] += 1
+            timing[1] += t
+            timing[2] = max(timing[2], t)
+        return data
+
+    def stats(self):
+        '''
+        Summary the timing of the stages
+
+        Return:
+            :return: The dict of the stages, with the calls, mean and max microseconds.
+        '''
+        return {stage.name: dict(calls=int(calls),
+                                 mean_us=total / max(1, calls) * 1e6,
+                                 max_us=largest * 1e6)
+                for stage, (calls, total, largest) in zip(self.stages, self.timing)}
+
+
+# %%
+if __name__ == '__main__':
+    sample_rate = 1000
+    t = np.arange(sample_rate * 10) / sample_rate
+    x = np.stack([np.sin(2 * np.pi * f * t) for f in [0.1, 10, 50, 200]], axis=1)
+    x = (x * 1000).astype(np.int32)
+
+    pipeline = Pipeline.from_setup(
+        dict(resolution=0.1, bandpass=[1.0, 40.0], notch=50.0), sample_rate)
+    y = np.concatenate([pipeline.process(e) for e in np.split(x, 250)])
+    print('Gains of 0.1, 10, 50, 200 Hz:',
+          np.abs(y[-sample_rate:]).max(axis=0) / 100)
+    print(pipeline.stats())
@@ -0,0 +1,226 @@
+'''
+File: eeg_pyramid.py
+Author: listenzcc
+Date: 2023-01-13
+
+The multi-resolution min/max pyramid of the EEG data.
+'''
+
+# %%
+import numpy as np
+
+from main_setup import main_setup, logger
+from eeg_data_set import data_limit_seconds
+
+# %%
+# The samples of the bucket of the finest level
+default_base = 16
+# The buckets of the level being merged into the bucket of the next level
+default_factor = 4
+
+
+class MinMaxPyramid(object):
+    '''
+    The min/max pyramid of the signal.
+
+    The level l has the buckets of base x factor^l samples,
+    every bucket restores the min and max of its samples of every channel,
+    and the buckets are in the ring arrays of the level.
+    The pyramid is updated incrementally as the segments arrive,
+    the incomplete bucket of every level is pending until it is complete.
+    '''
+
+    def __init__(self, channels=main_setup['channels'],
+                 capacity=data_limit_seconds * main_setup['sample_rate'],
+                 sample_rate=main_setup['sample_rate'],
+                 base=default_base, factor=default_factor, dtype=np.int32):
+        '''
+        Args:
+            :param: channels: The channels of the signal;
+            :param: capacity: The max number of the samples being covered;
+            :param: sample_rate: The sample rate of the signal;
+            :param: base: The samples of the bucket of the finest level;
+            :param: factor: The buckets being merged into the bucket of the next level;
+            :param: dtype: The dtype of the samples.
+        '''
+        self.channels = channels
+        self.capacity = capacity
+        self.sample_rate = sample_rate
+        self.base = base
+        self.factor = factor
+        self.dtype = np.dtype(dtype)
+        self.reset()
+
+    def reset(self):
+        ''' Reset the pyramid '''
+        self.buckets = []
+        self.levels = []
+        bucket = self.base
+        while bucket <= self.capacity:
+            size = self.capacity // bucket
+            self.buckets.append(bucket)
+            self.levels.append(dict(
+                min=np.zeros((size, self.channels), dtype=self.dtype),
+                max=np.zeros((size, self.channels), dtype=self.dtype),
+                # The total count of the completed buckets
+                count=0,
+                # The pending min and max of the incomplete bucket
+                pending_min=np.zeros((0, self.channels), dtype=self.dtype),
+                pending_max=np.zeros((0, self.channels), dtype=self.dtype),
+            ))
+            bucket *= self.factor
+
+        # The total count of the samples and the time stamp of the latest sample
+        self.count = 0
+        self.latest_time = 0.0
+        logger.debug('Pyramid is reset with buckets of {} samples'.format(
+            self.buckets))
+
+    def configure(self, channels, samples, dtype, sample_rate):
+        '''
+        Configure the pyramid as the dataset is reconfigured,
+        it is the configure listener of the DataSet,
+        the capacity is scaled to keep the seconds being covered.
+
+        Args:
+            :param: channels: The channels of the signal;
+            :param: samples: The samples in every package;
+            :param: dtype: The dtype of the samples;
+            :param: sample_rate: The sample rate of the signal.
+        '''
+        logger.warning('Pyramid is reconfigured to {} channels of {} at {} Hz'.format(
+            channels, dtype, sample_rate))
+        self.capacity = int(self.capacity * sample_rate / self.sample_rate)
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        self.sample_rate = sample_rate
+        self.reset()
+
+    def append(self, n, q, q2, data):
+        '''
+        Append the signal segment into the pyramid,
+        it is the listener of the DataSet.
+
+        Args:
+            :param: n: The count of the signal segment;
+            :param: q: The timestamp of the signal segment;
+            :param: q2: The timestamp of receiving the signal segment
+            :param: data: The 2D array of the signal segment
+        '''
+        if not data.shape[1] == self.channels or not data.dtype == self.dtype:
+            logger.warning('Pyramid is reconfigured to {} channels of {}'.format(
+                data.shape[1], data.dtype))
+            self.channels = data.shape[1]
+            self.dtype = data.dtype
+            self.reset()
+
+        self.count += len(data)
+        self.latest_time = q + (len(data) - 1) / self.sample_rate
+        self._push(0, data, data)
+
+    def _push(self, level, mn, mx):
+        '''
+        Push the min and max of the items into the level,
+        the items are the samples of the level 0,
+        or the buckets of the previous level.
+
+        Args:
+            :param: level: The level;
+            :param: mn: The min of the items;
+            :param: mx: The max of the items.
+        '''
+        if level >= len(self.levels):
+            return
+
+        size = self.base if level == 0 else self.factor
+        lv = self.levels[level]
+
+        if len(lv['pending_min']) > 0:
+            mn = np.concatenate([lv['pending_min'], mn])
+            mx = np.concatenate([lv['pending_max'], mx])
+
+        m = len(mn) // size
+        lv['pending_min'] = mn[m * size:].copy()
+        lv['pending_max'] = mx[m * size:].copy()
+        if m == 0:
+            return
+
+        bmin = mn[:m * size].reshape(m, size, -1).min(axis=1)
+        bmax = mx[:m * size].reshape(m, size, -1).max(axis=1)
+
+        ring = len(lv['min'])
+        a = lv['count'] % ring
+        if m > ring:
+            bmin, bmax = bmin[-ring:], bmax[-ring:]
+            a = (lv['count'] + m - ring) % ring
+        k = min(len(bmin), ring - a)
+        lv['min'][a:a + k] = bmin[:k]
+        lv['max'][a:a + k] = bmax[:k]
+        lv['min'][:len(bmin) - k] = bmin[k:]
+        lv['max'][:len(bmin) - k] = bmax[k:]
+        lv['count'] += m
+
+        self._push(level + 1, bmin, bmax)
+
+    def _latest(self, level, m, end=None):
+        '''
+        Get the latest m buckets of the level before the end
+
+        Args:
+            :param: level: The level;
+            :param: m: The number of the buckets;
+            :param: end: The count of the buckets after the latest one being got, None for all the completed buckets.
+
+        Return:
+            :return: mn, mx: The min and max of the buckets.
+        '''
+        lv = self.levels[level]
+        ring = len(lv['min'])
+        end = lv['count'] if end is None else end
+        m = min(m, end, ring - (lv['count'] - end))
+        a = (end - m) % ring
+        if a + m <= ring:
+            return lv['min'][a:a + m], lv['max'][a:a + m]
+        return (np.concatenate([lv['min'][a:], lv['min'][:a + m - ring]]),
+                np.concatenate([lv['max'][a:], lv['max'][:a + m - ring]]))
+
+    def envelope(self, samples, width):
+        '''
+        Get the min/max envelope of the latest samples at the target width,
+        the coarsest level not coarser than the required bucket is used,
+        and its buckets are merged to the required bucket in the groups aligned to the bucket index.
+
+        Args:
+            :param: samples: The number of the latest samples;
+            :param: width: The target number of the buckets, e.g. the pixel width.
+
+        Return:
+            :return: bucket: The samples of every bucket;
+            :return: t_end: The time stamp of the end of the envelope;
+            :return: mn: The min of the buckets, (buckets x channels);
+            :return: mx: The max of the buckets, (buckets x channels).
+        '''
+        required = max(1, samples // max(1, width))
+        level = 0
+        for i, bucket in enumerate(self.buckets):
+            if bucket <= required:
+                level = i
+
+        bucket = self.buckets[level]
+        group = max(1, required // bucket)
+        lv = self.levels[level]
+        # The groups are aligned to the bucket index, so the merged buckets do not shift as the buckets arrive,
+        # and the buckets of the incomplete group are not covered
+        end = lv['count'] // group * group
+        m = min(samples // bucket, end, len(lv['min']) - (lv['count'] - end))
+        m = m // group * group
+        mn, mx = self._latest(level, m, end)
+
+        if group > 1:
+            mn = mn.reshape(-1, group, self.channels).min(axis=1)
+            mx = mx.reshape(-1, group, self.channels).max(axis=1)
+
+        # The pending samples are not covered by the merged buckets
+        pending = self.count - end * bucket
+        t_end = self.latest_time - pending / self.sample_rate
+        return bucket * group, t_end, mn, mx
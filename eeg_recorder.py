@@ -0,0 +1,577 @@
+'''
+File: eeg_recorder.py
+Author: listenzcc
+Date: 2023-01-14
+
+The on-disk recorder and reader of the EEG data.
+
+The recording is the folder of the chunk files and the meta.json,
+every chunk file is memory-mapped, it holds the metadata table of the packages,
+(idx <i8, query <f8, query2 <f8) x chunk_packages,
+and follows the samples (chunk_packages x samples, channels).
+
+If the recording is compressed, the chunk file is replaced by the packed chunk file when it is full,
+the metadata table is kept, and the samples are packed in the blocks of pack_packages,
+every block is (<I length) + the packed body of the coding_toolbox.
+'''
+
+# %%
+import os
+import json
+import time
+import queue
+import atexit
+import struct
+import collections
+import threading
+import numpy as np
+
+from main_setup import main_setup, logger
+from eeg_data_set import Segments
+from coding_toolbox import pack_body, unpack_body, body_delta_flag, compression_flags
+from metrics import metrics
+
+# %%
+index_dtype = np.dtype([('idx', '<i8'), ('query', '<f8'), ('query2', '<f8')])
+
+# The packages in every chunk file, 60 seconds by default
+default_chunk_packages = int(60 * 1000 / main_setup['interval'])
+# The packages in every write batch
+default_batch_packages = 25
+# The max seconds of the packages waiting in the batch
+default_batch_seconds = 1.0
+# The packages in every block of the packed chunk
+pack_packages = 25
+block_struct = struct.Struct('<I')
+
+
+def chunk_path(folder, chunk):
+    '''
+    The path of the chunk file
+
+    Args:
+        :param: folder: The folder of the recording;
+        :param: chunk: The idx of the chunk.
+    '''
+    return os.path.join(folder, 'chunk_{:05d}.dat'.format(chunk))
+
+
+def packed_chunk_path(folder, chunk):
+    '''
+    The path of the packed chunk file
+
+    Args:
+        :param: folder: The folder of the recording;
+        :param: chunk: The idx of the chunk.
+    '''
+    return os.path.join(folder, 'chunk_{:05d}.pak'.format(chunk))
+
+
+def open_chunk(path, meta, mode):
+    '''
+    Memory-map the chunk file
+
+    Args:
+        :param: path: The path of the chunk file;
+        :param: meta: The meta of the recording;
+        :param: mode: The mode of the memmap, 'w+' or 'r'.
+
+    Return:
+        :return: mm, index, data: The memmap, the metadata table and the samples.
+    '''
+    packages = meta['chunk_packages']
+    dtype = np.dtype(meta['dtype'])
+    index_size = packages * index_dtype.itemsize
+    size = index_size + packages * meta['samples'] * \
+        meta['channels'] * dtype.itemsize
+    mm = np.memmap(path, dtype=np.uint8, mode=mode, shape=(size,))
+    index = mm[:index_size].view(index_dtype)
+    data = mm[index_size:].view(dtype).reshape(-1, meta['channels'])
+    return mm, index, data
+
+
+def pack_chunk(folder, chunk, meta):
+    '''
+    Pack the chunk file into the packed chunk file,
+    the chunk file is removed after the packed chunk file is in place.
+
+    Args:
+        :param: folder: The folder of the recording;
+        :param: chunk: The idx of the chunk;
+        :param: meta: The meta of the recording.
+    '''
+    path = chunk_path(folder, chunk)
+    mm, index, data = open_chunk(path, meta, 'r')
+    rows = pack_packages * meta['samples']
+    parts = [index.tobytes()]
+    for i in range(0, len(data), rows):
+        code = pack_body(data[i:i + rows], meta['flags'])
+        parts += [block_struct.pack(len(code)), code]
+    del mm, index, data
+
+    packed = packed_chunk_path(folder, chunk)
+    with open(packed + '.tmp', 'wb') as f:
+        f.write(b''.join(parts))
+    os.replace(packed + '.tmp', packed)
+    os.remove(path)
+
+
+def unpack_chunk(folder, chunk, meta):
+    '''
+    Unpack the packed chunk file into the memory
+
+    Args:
+        :param: folder: The folder of the recording;
+        :param: chunk: The idx of the chunk;
+        :param: meta: The meta of the recording.
+
+    Return:
+        :return: None, index, data: The metadata table and the samples, like open_chunk without the memmap.
+    '''
+    with open(packed_chunk_path(folder, chunk), 'rb') as f:
+        code = f.read()
+    index = np.frombuffer(code, dtype=index_dtype,
+                          count=meta['chunk_packages'])
+    offset = index.nbytes
+    blocks = []
+    while offset < len(code):
+        length, = block_struct.unpack_from(code, offset)
+        offset += block_struct.size
+        blocks.append(unpack_body(memoryview(code)[offset:offset + length],
+                                  meta['channels'], meta['dtype'], meta['flags']))
+        offset += length
+    return None, index, np.concatenate(blocks)
+
+
+def write_meta(folder, meta):
+    '''
+    Write the meta of the recording, it is replaced atomically.
+
+    Args:
+        :param: folder: The folder of the recording;
+        :param: meta: The meta of the recording.
+    '''
+    path = os.path.join(folder, 'meta.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(path + '.tmp', path)
+
+
+class Recorder(object):
+    '''
+    The recorder streams the segments into the recording on the disk.
+    The segments are batched in the receiving thread,
+    and the batches are written by the writing thread,
+    so the receiving loop is not blocked by the disk.
+    '''
+
+    def __init__(self, root='record',
+                 chunk_packages=default_chunk_packages,
+                 batch_packages=default_batch_packages,
+                 batch_seconds=default_batch_seconds,
+                 max_batches=100,
+                 compression=None):
+        '''
+        Args:
+            :param: root: The root folder of the recordings;
+            :param: chunk_packages: The packages in every chunk file;
+            :param: batch_packages: The packages in every write batch;
+            :param: batch_seconds: The max seconds of the packages waiting in the batch;
+            :param: max_batches: The max batches waiting for the writing thread;
+            :param: compression: The compression of the full chunks, None, 'delta', 'zlib' or 'delta+zlib'.
+        '''
+        self.root = root
+        self.chunk_packages = chunk_packages
+        self.batch_packages = batch_packages
+        self.batch_seconds = batch_seconds
+        self.batches = queue.Queue(maxsize=max_batches)
+        self.flags = compression_flags[compression]
+        self.sample_rate = main_setup['sample_rate']
+        self.dropped = 0
+        self.meta = None
+        self.folder = None
+
+        t = threading.Thread(target=self._writing, daemon=True)
+        t.start()
+        atexit.register(self.close)
+
+    def _start_recording(self, data):
+        '''
+        Start the new recording of the shape and dtype of the data
+
+        Args:
+            :param: data: The 2D array of the signal segment.
+        '''
+        if self.meta is not None:
+            self.flush()
+            self.batches.put(None)
+
+        self.folder = os.path.join(
+            self.root, time.strftime('%Y%m%d-%H%M%S'))
+        suffix = 0
+        while os.path.exists(self.folder):
+            suffix += 1
+            self.folder = os.path.join(self.root, '{}-{}'.format(
+                time.strftime('%Y%m%d-%H%M%S'), suffix))
+        os.makedirs(self.folder)
+
+        self.meta = dict(
+            channels=data.shape[1],
+            samples=data.shape[0],
+            dtype=np.dtype(data.dtype).str,
+            sample_rate=self.sample_rate,
+            chunk_packages=self.chunk_packages,
+            packages=0,
+            flags=self.flags,
+        )
+        if self.flags & body_delta_flag and not np.dtype(data.dtype).kind == 'i':
+            logger.warning('The delta compression requires the integer samples, not {}'.format(
+                data.dtype))
+            self.meta['flags'] &= ~body_delta_flag
+        write_meta(self.folder, self.meta)
+        self._new_batch()
+        logger.info('Recording starts in {}'.format(self.folder))
+
+    def _new_batch(self):
+        ''' Allocate the new batch '''
+        meta = self.meta
+        self.batch = dict(
+            folder=self.folder,
+            meta=dict(meta),
+            index=np.zeros(self.batch_packages, dtype=index_dtype),
+            data=np.zeros((self.batch_packages * meta['samples'], meta['channels']),
+                          dtype=meta['dtype']),
+            count=0,
+            t=time.time(),
+        )
+
+    def configure(self, channels, samples, dtype, sample_rate):
+        '''
+        Configure the sample rate as the dataset is reconfigured,
+        it is the configure listener of the DataSet,
+        the new recording starts at the next segment if the sample rate changes.
+
+        Args:
+            :param: channels: The channels of the signal;
+            :param: samples: The samples in every package;
+            :param: dtype: The dtype of the samples;
+            :param: sample_rate: The sample rate of the signal.
+        '''
+        self.sample_rate = sample_rate
+
+    def append(self, n, q, q2, data):
+        '''
+        Append the signal segment into the batch,
+        it is the listener of the DataSet.
+
+        Args:
+            :param: n: The count of the signal segment;
+            :param: q: The timestamp of the signal segment;
+            :param: q2: The timestamp of receiving the signal segment
+            :param: data: The 2D array of the signal segment
+        '''
+        meta = self.meta
+        if meta is None or not data.shape == (meta['samples'], meta['channels']) or not np.dtype(data.dtype).str == meta['dtype'] or not meta['sample_rate'] == self.sample_rate:
+            self._start_recording(data)
+
+        batch = self.batch
+        i = batch['count']
+        batch['index'][i] = (n, q, q2)
+        batch['data'][i * len(data):(i + 1) * len(data)] = data
+        batch['count'] += 1
+
+        if batch['count'] == self.batch_packages or time.time() - batch['t'] > self.batch_seconds:
+            self.flush()
+
+    def flush(self):
+        ''' Hand the batch over to the writing thread '''
+        if self.meta is None or self.batch['count'] == 0:
+            return
+
+        try:
+            self.batches.put_nowait(self.batch)
+        except queue.Full:
+            self.dropped += self.batch['count']
+            metrics.count('record_dropped', self.batch['count'])
+            logger.error('Recorder is too slow, {} packages dropped'.format(
+                self.dropped))
+        self._new_batch()
+
+    def close(self, wait=True):
+        '''
+        Flush the batch and end the recording,
+        the chunk is packed and the meta is written by the writing thread,
+        and the next segment starts the new recording.
+
+        Args:
+            :param: wait: Whether to wait for the writing thread writing the batches.
+        '''
+        if self.meta is not None:
+            self.flush()
+            self.meta = None
+            self.batches.put(None)
+        if wait:
+            self.batches.join()
+
+    def _writing(self):
+        '''
+        Write the batches into the chunk files,
+        the chunk and the meta are flushed when the queue is drained,
+        or after every max_unflushed batches.
+        The chunk is packed when it is full or the recording ends, if the recording is compressed.
+        '''
+        max_unflushed = 10
+        unflushed = 0
+        chunk = None
+        folder = None
+        meta = None
+
+        def _flush():
+            if chunk is not None:
+                chunk[0].flush()
+            if meta is not None:
+                write_meta(folder, meta)
+
+        def _pack():
+            if chunk is not None and meta['flags']:
+                t = time.time()
+                pack_chunk(folder, chunk[3], meta)
+                logger.debug('Chunk {} is packed in {:.3f} seconds'.format(
+                    chunk[3], time.time() - t))
+
+        while True:
+            batch = self.batches.get()
+            try:
+                if batch is None:
+                    _flush()
+                    _pack()
+                    unflushed = 0
+                    chunk = None
+                    continue
+
+                if not batch['folder'] == folder:
+                    folder = batch['folder']
+                    meta = batch['meta']
+                    chunk = None
+
+                samples = meta['samples']
+                count = batch['count']
+                done = 0
+                while done < count:
+                    c, offset = divmod(meta['packages'],
+                                       meta['chunk_packages'])
+                    if chunk is None or not chunk[3] == c:
+                        if chunk is not None:
+                            chunk[0].flush()
+                            _pack()
+                        path = chunk_path(folder, c)
+                        mode = 'r+' if os.path.exists(path) else 'w+'
+                        chunk = open_chunk(path, meta, mode) + (c,)
+
+                    m = min(count - done, meta['chunk_packages'] - offset)
+                    mm, index, data, _ = chunk
+                    index[offset:offset + m] = batch['index'][done:done + m]
+                    data[offset * samples:(offset + m) * samples] = \
+                        batch['data'][done * samples:(done + m) * samples]
+                    done += m
+                    meta['packages'] += m
+
+                unflushed += 1
+                if self.batches.empty() or unflushed >= max_unflushed:
+                    _flush()
+                    unflushed = 0
+
+            except Exception as err:
+                logger.error('Recorder writing error: {}'.format(err))
+
+            finally:
+                self.batches.task_done()
+
+
+class RecordingReader(object):
+    '''
+    The reader of the recording,
+    the chunk files are memory-mapped, so the recording is not loaded.
+    The packed chunk files are unpacked into the memory,
+    and only the latest max_unpacked of them are kept.
+    '''
+
+    def __init__(self, folder, max_unpacked=4):
+        '''
+        Args:
+            :param: folder: The folder of the recording;
+            :param: max_unpacked: The max unpacked chunks kept in the memory.
+        '''
+        self.folder = folder
+        self.chunks = dict()
+        self.unpacked = collections.OrderedDict()
+        # The metadata tables of the packed chunks
+        self.indexes = dict()
+        self.max_unpacked = max_unpacked
+        self.refresh()
+
+    def refresh(self):
+        ''' Read the meta of the recording, the recording may be growing '''
+        with open(os.path.join(self.folder, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.meta.setdefault('flags', 0)
+        self.channels = self.meta['channels']
+        self.samples = self.meta['samples']
+        self.sample_rate = self.meta['sample_rate']
+        self.chunk_packages = self.meta['chunk_packages']
+        self.count = self.meta['packages']
+
+    def length(self):
+        ''' Get the number of the packages in the recording '''
+        return self.count
+
+    def _chunk(self, c):
+        '''
+        Memory-map the chunk
+
+        Args:
+            :param: c: The idx of the chunk.
+        '''
+        if c in self.chunks:
+            return self.chunks[c]
+
+        if c in self.unpacked:
+            self.unpacked.move_to_end(c)
+            return self.unpacked[c]
+
+        if not os.path.exists(packed_chunk_path(self.folder, c)):
+            try:
+                self.chunks[c] = open_chunk(chunk_path(
+                    self.folder, c), self.meta, 'r')
+                return self.chunks[c]
+            except FileNotFoundError:
+                # The chunk is packed just now
+                pass
+
+        self.unpacked[c] = unpack_chunk(self.folder, c, self.meta)
+        if len(self.unpacked) > self.max_unpacked:
+            self.unpacked.popitem(last=False)
+        return self.unpacked[c]
+
+    def _index(self, c):
+        '''
+        Get the metadata table of the chunk, the packed chunk is not unpacked
+
+        Args:
+            :param: c: The idx of the chunk.
+        '''
+        if c in self.chunks or c in self.unpacked:
+            return self._chunk(c)[1]
+        if c not in self.indexes:
+            path = packed_chunk_path(self.folder, c)
+            if not os.path.exists(path):
+                return self._chunk(c)[1]
+            self.indexes[c] = np.fromfile(
+                path, dtype=index_dtype, count=self.chunk_packages)
+        return self.indexes[c]
+
+    def get_packages(self, start, stop):
+        '''
+        Get the packages from start to stop,
+        the arrays are views of the memmap if they are in the same chunk.
+
+        Args:
+            :param: start: The first package;
+            :param: stop: The package after the last package.
+
+        Return:
+            return: segments: The Segments of the idx, query, query2 and data.
+        '''
+        start = max(0, start)
+        stop = min(stop, self.count)
+        parts = []
+        p = start
+        while p < stop:
+            c, offset = divmod(p, self.chunk_packages)
+            m = min(stop - p, self.chunk_packages - offset)
+            mm, index, data = self._chunk(c)
+            parts.append((index[offset:offset + m],
+                          data[offset * self.samples:(offset + m) * self.samples]))
+            p += m
+
+        if len(parts) == 0:
+            index = np.zeros(0, dtype=index_dtype)
+            data = np.zeros((0, self.channels), dtype=self.meta['dtype'])
+        elif len(parts) == 1:
+            index, data = parts[0]
+        else:
+            index = np.concatenate([e[0] for e in parts])
+            data = np.concatenate([e[1] for e in parts])
+
+        return Segments(idx=index['idx'], query=index['query'],
+                        query2=index['query2'], data=data)
+
+    def get_latest(self, latest):
+        '''
+        Get the latest packages
+
+        Args:
+            :param: latest: Require the latest n packages.
+
+        Return:
+            return: segments: The Segments of the idx, query, query2 and data.
+        '''
+        return self.get_packages(self.count - latest, self.count)
+
+    def _search(self, t):
+        '''
+        Search the first package whose query is not less than t
+
+        Args:
+            :param: t: The time stamp.
+        '''
+        chunks = (self.count + self.chunk_packages - 1) // self.chunk_packages
+        # Search the chunk by its first query, then search in the chunk
+        lo, hi = 0, chunks
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._index(mid)['query'][0] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        c = max(0, lo - 1)
+        end = min(self.chunk_packages, self.count - c * self.chunk_packages)
+        if end <= 0:
+            return self.count
+        query = self._index(c)['query'][:end]
+        return c * self.chunk_packages + int(np.searchsorted(query, t))
+
+    def get_range(self, t_start, t_end):
+        '''
+        Get the packages whose query is in [t_start, t_end)
+
+        Args:
+            :param: t_start: The start time stamp;
+            :param: t_end: The end time stamp.
+
+        Return:
+            return: segments: The Segments of the idx, query, query2 and data.
+        '''
+        return self.get_packages(self._search(t_start), self._search(t_end))
+
+
+# %%
+if __name__ == '__main__':
+    import tempfile
+
+    root = tempfile.mkdtemp()
+    data = np.arange(40 * 8, dtype=np.int32).reshape(40, 8)
+    recorder = Recorder(root, chunk_packages=30,
+                        batch_packages=8, compression='delta+zlib')
+    for n in range(100):
+        recorder.append(n, n * 0.04, n * 0.04, data + n)
+    recorder.close()
+
+    folder = os.path.join(root, os.listdir(root)[0])
+    print('Files:', sorted(os.listdir(folder)))
+    reader = RecordingReader(folder)
+    segments = reader.get_packages(0, reader.length())
+    print('Packages:', reader.length(), 'Flags:', reader.meta['flags'])
+    print('The difference values are', np.unique(
+        segments.data.reshape(-1, 40, 8) - (data + np.arange(100)[:, np.newaxis, np.newaxis])),
+        np.unique(segments.idx - np.arange(100)))
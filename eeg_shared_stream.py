@@ -0,0 +1,442 @@
+'''
+File: eeg_shared_stream.py
+Author: listenzcc
+Date: 2023-01-22
+
+The shared-memory stream of the EEG data.
+
+The data center writes the packages of the device into the ring of the shared memory,
+and the analysis processes of the same host attach to it by the name,
+they follow the write cursor and get the zero-copy numpy views of the new packages,
+so they consume the full-rate stream in parallel without the websocket nor the data center process.
+
+The block is the header, the index ring and the data ring,
+the packages are counted by the sequence from 1,
+and the package of the sequence s is in the slot (s - 1) % capacity.
+The slot sequence is set to 0 before the slot is written, and to s after it is written,
+so the reader detects the package being overwritten (the overrun) by the slot sequence.
+'''
+
+# %%
+import time
+import atexit
+import numpy as np
+
+from multiprocessing import shared_memory, resource_tracker
+
+from main_setup import main_setup, data_center_setup, logger
+from coding_toolbox import sample_dtypes, sample_dtype_codes
+from eeg_data_set import Segments, data_length
+
+# %%
+shared_magic = b'EPDS'
+shared_version = 1
+
+# The header of the block, the cursor is the sequence of the latest written package
+header_dtype = np.dtype([
+    ('magic', 'S4'),
+    ('version', '<u4'),
+    ('channels', '<u4'),
+    ('samples', '<u4'),
+    ('capacity', '<u4'),
+    ('sample_rate', '<u4'),
+    ('dtype', '<u4'),
+    ('closed', '<u4'),
+    ('cursor', '<u8'),
+])
+
+# The index of the slot
+slot_dtype = np.dtype([
+    ('seq', '<u8'),
+    ('idx', '<i8'),
+    ('query', '<f8'),
+    ('query2', '<f8'),
+])
+
+# The rings are aligned to the cache line
+alignment = 64
+
+# The names of the blocks created in this process,
+# their entries of the resource tracker belong to the writer, the readers of this process keep them
+_created_names = set()
+
+
+def _aligned(size):
+    return (size + alignment - 1) // alignment * alignment
+
+
+def shared_name(device):
+    '''
+    The name of the shared memory of the device
+
+    Args:
+        :param: device: The name of the device.
+
+    Return:
+        :return: The name of the shared memory.
+    '''
+    return '{}-{}'.format(data_center_setup['shared_memory'], device)
+
+
+class SharedBlock(object):
+    ''' The views of the header, the index ring and the data ring in the shared memory '''
+
+    def __init__(self, shm, channels, samples, capacity, dtype):
+        '''
+        Args:
+            :param: shm: The SharedMemory;
+            :param: channels: The channels of the signal;
+            :param: samples: The samples in every package;
+            :param: capacity: The packages of the ring;
+            :param: dtype: The dtype of the samples.
+        '''
+        self.shm = shm
+        self.channels = channels
+        self.samples = samples
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+
+        offset = _aligned(header_dtype.itemsize)
+        self.header = np.ndarray(1, header_dtype, shm.buf)[0]
+        self.slots = np.ndarray(capacity, slot_dtype, shm.buf, offset)
+        offset = _aligned(offset + capacity * slot_dtype.itemsize)
+        self.data = np.ndarray(
+            (capacity * samples, channels), self.dtype, shm.buf, offset)
+
+    @staticmethod
+    def size(channels, samples, capacity, dtype):
+        ''' The bytes of the block '''
+        return (_aligned(header_dtype.itemsize) +
+                _aligned(capacity * slot_dtype.itemsize) +
+                capacity * samples * channels * np.dtype(dtype).itemsize)
+
+    def release(self):
+        ''' Release the views, the shared memory can not be closed with them '''
+        self.header = self.slots = self.data = None
+
+
+class SharedStreamWriter(object):
+    '''
+    The writer of the shared-memory stream, it is the listener of the dataset.
+    The block is created at the first package,
+    and it is created again if the shape or dtype of the packages changes,
+    the readers attach to the new block when the old one is closed.
+    '''
+
+    def __init__(self, name, seconds=data_center_setup['shared_memory_seconds']):
+        '''
+        Args:
+            :param: name: The name of the shared memory;
+            :param: seconds: The seconds of the ring.
+        '''
+        self.name = name
+        self.seconds = seconds
+        self.sample_rate = main_setup['sample_rate']
+        self.block = None
+        atexit.register(self.close)
+
+    def _create(self, samples, channels, dtype):
+        ''' Create the block of the shape, the old block is closed '''
+        self.close()
+
+        capacity = max(2, int(self.seconds * self.sample_rate / samples))
+        size = SharedBlock.size(channels, samples, capacity, dtype)
+        try:
+            shm = shared_memory.SharedMemory(self.name, create=True, size=size)
+        except FileExistsError:
+            # It is left by the crashed data center
+            logger.warning(
+                'Shared memory {} exists, it is replaced'.format(self.name))
+            old = shared_memory.SharedMemory(self.name)
+            old.close()
+            old.unlink()
+            shm = shared_memory.SharedMemory(self.name, create=True, size=size)
+        _created_names.add(shm._name)
+
+        block = SharedBlock(shm, channels, samples, capacity, dtype)
+        block.slots['seq'] = 0
+        header = block.header
+        header['version'] = shared_version
+        header['channels'] = channels
+        header['samples'] = samples
+        header['capacity'] = capacity
+        header['sample_rate'] = self.sample_rate
+        header['dtype'] = sample_dtype_codes[block.dtype]
+        header['closed'] = 0
+        header['cursor'] = 0
+        # The magic is written at last, the readers wait for it
+        header['magic'] = shared_magic
+        self.block = block
+        logger.info('Shared memory {} is created with {} packages of {} x {} {}, {} bytes'.format(
+            self.name, capacity, samples, channels, block.dtype, size))
+
+    def configure(self, channels, samples, dtype, sample_rate):
+        '''
+        Configure the sample rate, it is the configure listener of the dataset,
+        the block is created again at the next package if the sample rate changes.
+
+        Args:
+            :param: channels: The channels of the package;
+            :param: samples: The samples of the package;
+            :param: dtype: The dtype of the samples;
+            :param: sample_rate: The sample rate of the signal.
+        '''
+        self.sample_rate = sample_rate
+
+    def append(self, n, q, q2, data):
+        '''
+        Write the package into the ring, it is the listener of the dataset
+
+        Args:
+            :param: n: The count of the package;
+            :param: q: The timestamp of the package;
+            :param: q2: The timestamp of receiving the package;
+            :param: data: The 2D array of the package (samples x channels).
+        '''
+        block = self.block
+        if block is None or data.shape != (block.samples, block.channels) or data.dtype != block.dtype or block.header['sample_rate'] != self.sample_rate:
+            self._create(data.shape[0], data.shape[1], data.dtype)
+            block = self.block
+
+        seq = int(block.header['cursor']) + 1
+        slot = (seq - 1) % block.capacity
+        entry = block.slots[slot]
+        # The slot is invalid while it is being written
+        entry['seq'] = 0
+        block.data[slot * block.samples:(slot + 1) * block.samples] = data
+        entry['idx'] = n
+        entry['query'] = q
+        entry['query2'] = q2
+        entry['seq'] = seq
+        block.header['cursor'] = seq
+
+    def close(self):
+        ''' Close and unlink the block, the readers are told by the closed flag '''
+        if self.block is None:
+            return
+        block, self.block = self.block, None
+        block.header['closed'] = 1
+        shm = block.shm
+        block.release()
+        shm.close()
+        shm.unlink()
+        _created_names.discard(shm._name)
+        logger.info('Shared memory {} is closed'.format(self.name))
+
+
+# The segments of no package, the poll returns them when the block is not attached
+empty_segments = Segments(np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0),
+                          np.zeros((0, 0), dtype=np.int32))
+
+
+class SharedStreamReader(object):
+    '''
+    The reader of the shared-memory stream.
+
+    Usage:
+        reader = SharedStreamReader('epd-default')
+        while True:
+            seq, segments = reader.wait()
+            result = analysis(segments.data)
+            if not reader.valid(seq):
+                # The packages are overwritten while they are analyzed
+                ...
+
+    The segments are the views of the ring, they are valid until the writer overwrites them,
+    the valid(seq) tells whether the packages from the seq are still intact.
+    The packages being overwritten before they are read are skipped,
+    and they are counted in the overruns.
+    '''
+
+    def __init__(self, name, latest=0, attach_seconds=10.0):
+        '''
+        Args:
+            :param: name: The name of the shared memory;
+            :param: latest: The latest packages being read first, 0 for only the new packages;
+            :param: attach_seconds: The seconds waiting for the writer to create the block.
+        '''
+        self.name = name
+        self.latest = latest
+        self.attach_seconds = attach_seconds
+        self.block = None
+        # The sequence of the next package to read
+        self.next_seq = None
+        # The packages overwritten before they are read
+        self.overruns = 0
+
+    def attach(self):
+        ''' Attach to the block, it waits until the writer creates it '''
+        t = time.time()
+        while not self.try_attach():
+            if time.time() - t > self.attach_seconds:
+                raise TimeoutError(
+                    'Shared memory {} is not available'.format(self.name))
+            time.sleep(0.1)
+
+    def try_attach(self):
+        '''
+        Try to attach to the block once, it does not block
+
+        Return:
+            :return: Whether the block is attached.
+        '''
+        self.detach()
+
+        try:
+            try:
+                shm = shared_memory.SharedMemory(self.name, track=False)
+            except TypeError:
+                # Python < 3.13, the attached memory should not be unlinked by the tracker of the reader,
+                # but the entry of the writer of this process is kept for its unlinking
+                shm = shared_memory.SharedMemory(self.name)
+                if shm._name not in _created_names:
+                    resource_tracker.unregister(shm._name, 'shared_memory')
+        except FileNotFoundError:
+            return False
+
+        header = np.ndarray(1, header_dtype, shm.buf)[0]
+        if not header['magic'] == shared_magic or header['closed']:
+            del header
+            shm.close()
+            return False
+
+        if header['version'] != shared_version:
+            raise ValueError('Shared memory version {} is not supported'.format(
+                header['version']))
+
+        self.block = SharedBlock(shm, int(header['channels']), int(header['samples']),
+                                 int(header['capacity']), sample_dtypes[int(header['dtype'])])
+        self.sample_rate = int(header['sample_rate'])
+        cursor = int(header['cursor'])
+        self.next_seq = max(1, cursor + 1 - min(self.latest,
+                                                self.block.capacity - 1))
+        logger.info('Shared memory {} is attached, {} packages of {} x {} {}'.format(
+            self.name, self.block.capacity, self.block.samples, self.block.channels, self.block.dtype))
+        return True
+
+    def detach(self):
+        ''' Detach from the block, the views of the segments should be released before '''
+        if self.block is None:
+            return
+        block, self.block = self.block, None
+        shm = block.shm
+        block.release()
+        try:
+            shm.close()
+        except BufferError:
+            # The segments are still being used, the memory is unmapped when they are released
+            pass
+
+    @property
+    def cursor(self):
+        ''' The sequence of the latest written package '''
+        return int(self.block.header['cursor'])
+
+    def valid(self, seq):
+        '''
+        Check whether the packages from the seq are intact,
+        the later packages are intact if the package of the seq is.
+
+        Args:
+            :param: seq: The sequence of the first package being checked.
+
+        Return:
+            :return: Whether the package of the seq is not overwritten.
+        '''
+        block = self.block
+        return block is not None and int(block.slots[(seq - 1) % block.capacity]['seq']) == seq
+
+    def poll(self, max_packages=None):
+        '''
+        Read the new packages since the last poll, it does not block.
+        The packages are the contiguous slots of the ring,
+        so the packages after the end of the ring are read by the next poll.
+        The block is tried to be attached once if it is not attached,
+        or it is closed by the writer, the wait keeps trying.
+
+        Args:
+            :param: max_packages: The max packages being read, None for all.
+
+        Return:
+            :return: seq, segments: The sequence of the first package and the Segments of the views,
+                     the segments are empty if there is no new package,
+                     and the seq is None if the block is not attached.
+        '''
+        if self.block is None or self.block.header['closed']:
+            if self.block is not None:
+                logger.info('Shared memory {} is closed by the writer'.format(
+                    self.name))
+            if not self.try_attach():
+                return None, empty_segments
+
+        block = self.block
+        cursor = self.cursor
+        oldest = max(1, cursor + 2 - block.capacity)
+        if self.next_seq < oldest:
+            # The slot of the oldest package may be being written, so it is skipped too
+            self.overruns += oldest - self.next_seq
+            logger.warning('Shared memory {} overruns {} packages'.format(
+                self.name, oldest - self.next_seq))
+            self.next_seq = oldest
+
+        seq = self.next_seq
+        count = cursor - seq + 1
+        slot = (seq - 1) % block.capacity
+        count = min(count, block.capacity - slot)
+        if max_packages is not None:
+            count = min(count, max_packages)
+        count = max(0, count)
+
+        slots = block.slots[slot:slot + count]
+        segments = Segments(slots['idx'], slots['query'], slots['query2'],
+                            block.data[slot * block.samples:(slot + count) * block.samples])
+        self.next_seq = seq + count
+        return seq, segments
+
+    def wait(self, max_packages=None, interval=None, timeout=None):
+        '''
+        Read the new packages, it blocks until there are,
+        and it waits for the writer creating the block if it is not attached.
+
+        Args:
+            :param: max_packages: The max packages being read, None for all;
+            :param: interval: The seconds between the polls, None for the quarter of the package interval;
+            :param: timeout: The max seconds of waiting, None for ever.
+
+        Return:
+            :return: seq, segments: The same as the poll, the segments are empty if it times out.
+        '''
+        if interval is None:
+            interval = main_setup['interval'] / 1000 / 4
+        t = time.time()
+        while True:
+            seq, segments = self.poll(max_packages)
+            if len(segments.idx) > 0:
+                return seq, segments
+            if timeout is not None and time.time() - t > timeout:
+                return seq, segments
+            time.sleep(interval)
+
+
+# %%
+if __name__ == '__main__':
+    writer = SharedStreamWriter('epd-test', seconds=1)
+    reader = SharedStreamReader('epd-test', latest=5)
+
+    for n in range(10):
+        writer.append(n, time.time(), time.time(), np.full(
+            (data_length, main_setup['channels']), n, dtype=np.int32))
+
+    seq, segments = reader.poll()
+    print('Read', seq, segments.idx, segments.data.shape, segments.data[::data_length, 0])
+
+    for n in range(10, 100):
+        writer.append(n, time.time(), time.time(), np.full(
+            (data_length, main_setup['channels']), n, dtype=np.int32))
+    print('Valid', reader.valid(seq))
+    seq, segments = reader.poll()
+    print('Read', seq, segments.idx, 'overruns', reader.overruns)
+
+    del segments
+    reader.detach()
+    writer.close()
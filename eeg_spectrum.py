@@ -0,0 +1,208 @@
+'''
+File: eeg_spectrum.py
+Author: listenzcc
+Date: 2023-01-18
+
+The incremental spectral features of the EEG data,
+the Welch PSD and the band power of the latest seconds.
+'''
+
+# %%
+import numpy as np
+
+from main_setup import main_setup, logger
+
+# %%
+# The bands of the band power in Hz
+default_bands = dict(
+    delta=[1.0, 4.0],
+    theta=[4.0, 8.0],
+    alpha=[8.0, 13.0],
+    beta=[13.0, 30.0],
+    gamma=[30.0, 45.0],
+)
+
+
+class SpectrumCache(object):
+    '''
+    The rolling Welch PSD of the signal.
+
+    The window of nperseg samples hops every (1 - overlap) x nperseg samples,
+    the periodogram of every window is computed once as the samples arrive,
+    and the PSD is the average of the latest periodograms in the ring,
+    the sum of the ring is updated incrementally.
+    The PSD and the band power are published as the snapshot after every update,
+    so the requests read the snapshot without computing.
+    '''
+
+    def __init__(self, channels=main_setup['channels'], sample_rate=main_setup['sample_rate'],
+                 seconds=1.0, overlap=0.5, average=8, bands=default_bands):
+        '''
+        Args:
+            :param: channels: The channels of the signal;
+            :param: sample_rate: The sample rate of the signal;
+            :param: seconds: The seconds of the window;
+            :param: overlap: The overlap of the windows, in [0, 1);
+            :param: average: The number of the latest windows being averaged;
+            :param: bands: The dict of the bands of the band power.
+        '''
+        self.channels = channels
+        self.seconds = seconds
+        self.overlap = overlap
+        self.average = average
+        self.bands = bands
+        self._windowing(sample_rate)
+        self.reset()
+
+    def _windowing(self, sample_rate):
+        '''
+        Compute the window, the frequency bins and the bands of the sample rate
+
+        Args:
+            :param: sample_rate: The sample rate of the signal.
+        '''
+        self.sample_rate = sample_rate
+        self.nperseg = max(2, int(self.seconds * sample_rate))
+        self.hop = max(1, int(self.nperseg * (1 - self.overlap)))
+
+        self.window = np.hanning(self.nperseg + 2)[1:-1]
+        # The density scale of the periodogram, and the one-sided doubling
+        self.scale = 1 / (sample_rate * np.sum(self.window ** 2))
+        self.freqs = np.fft.rfftfreq(self.nperseg, 1 / sample_rate)
+        self.one_sided = np.full(len(self.freqs), 2.0)
+        self.one_sided[0] = 1
+        if self.nperseg % 2 == 0:
+            self.one_sided[-1] = 1
+
+        # The integration matrix of the bands, (bands x bins)
+        df = self.freqs[1] - self.freqs[0]
+        self.band_matrix = np.array([(self.freqs >= lo) & (self.freqs < hi)
+                                     for lo, hi in self.bands.values()]) * df
+
+    def configure(self, channels, samples, dtype, sample_rate):
+        '''
+        Configure the cache as the dataset is reconfigured,
+        it is the configure listener of the DataSet.
+
+        Args:
+            :param: channels: The channels of the signal;
+            :param: samples: The samples in every package;
+            :param: dtype: The dtype of the samples;
+            :param: sample_rate: The sample rate of the signal.
+        '''
+        logger.warning('Spectrum is reconfigured to {} channels at {} Hz'.format(
+            channels, sample_rate))
+        self.channels = channels
+        self._windowing(sample_rate)
+        self.reset()
+
+    def reset(self):
+        ''' Reset the cache '''
+        bins = len(self.freqs)
+        self.ring = np.zeros((self.average, bins, self.channels))
+        self.ring_t = np.zeros(self.average)
+        self.sum = np.zeros((bins, self.channels))
+        # The total count of the windows
+        self.count = 0
+        # The samples after the start of the next window are the buffer[:fill],
+        # the buffer holds the window and the package, it grows for the larger package
+        self.buffer = np.zeros((self.nperseg, self.channels))
+        self.fill = 0
+        # The time stamp of the first sample of the buffer
+        self.tail_t = 0.0
+        self.snapshot = None
+        logger.debug('Spectrum is reset with windows of {} samples every {} samples'.format(
+            self.nperseg, self.hop))
+
+    def append(self, n, q, q2, data):
+        '''
+        Append the signal segment, it is the listener of the DataSet.
+
+        Args:
+            :param: n: The count of the signal segment;
+            :param: q: The timestamp of the signal segment;
+            :param: q2: The timestamp of receiving the signal segment
+            :param: data: The 2D array of the signal segment
+        '''
+        if not data.shape[1] == self.channels:
+            logger.warning('Spectrum is reconfigured to {} channels'.format(
+                data.shape[1]))
+            self.channels = data.shape[1]
+            self.reset()
+
+        if self.fill == 0:
+            self.tail_t = q
+        if self.fill + len(data) > len(self.buffer):
+            buffer = np.zeros((self.nperseg + len(data), self.channels))
+            buffer[:self.fill] = self.buffer[:self.fill]
+            self.buffer = buffer
+        self.buffer[self.fill:self.fill + len(data)] = data
+        self.fill += len(data)
+        buffer = self.buffer[:self.fill]
+
+        windows = (self.fill - self.nperseg) // self.hop + 1
+        if windows <= 0:
+            return
+
+        # The windows are the strided views of the buffer, (windows x channels x nperseg)
+        segments = np.lib.stride_tricks.sliding_window_view(
+            buffer, self.nperseg, axis=0)[:windows * self.hop:self.hop]
+        segments = segments - segments.mean(axis=2, keepdims=True)
+        spectrum = np.fft.rfft(segments * self.window, axis=2)
+        periodograms = (spectrum.real ** 2 + spectrum.imag ** 2) * self.scale
+        periodograms *= self.one_sided
+        # The time stamps of the ends of the windows
+        ends = self.tail_t + (np.arange(windows) * self.hop +
+                              self.nperseg) / self.sample_rate
+
+        for periodogram, t in zip(periodograms, ends):
+            i = self.count % self.average
+            self.sum += periodogram.T - self.ring[i]
+            self.ring[i] = periodogram.T
+            self.ring_t[i] = t
+            self.count += 1
+
+        # Only the samples after the consumed hops are shifted to the head
+        consumed = windows * self.hop
+        self.fill -= consumed
+        self.buffer[:self.fill] = self.buffer[consumed:consumed + self.fill]
+        self.tail_t += consumed / self.sample_rate
+        self._publish()
+
+    def _publish(self):
+        ''' Publish the snapshot of the PSD and the band power '''
+        m = min(self.count, self.average)
+        psd = self.sum / m
+        t_end = self.ring_t[(self.count - 1) % self.average]
+        t_start = t_end - ((m - 1) * self.hop + self.nperseg) / self.sample_rate
+        self.snapshot = dict(
+            t_start=t_start,
+            t_end=t_end,
+            windows=m,
+            psd=psd.astype(np.float32),
+            band_power=(self.band_matrix @ psd).astype(np.float32),
+        )
+
+    def spectrum(self):
+        '''
+        Get the latest spectrum
+
+        Return:
+            :return: The snapshot dict of t_start, t_end, windows, psd (bins x channels) and band_power (bands x channels),
+                     or None if there is not the full window yet.
+        '''
+        return self.snapshot
+
+
+# %%
+if __name__ == '__main__':
+    sample_rate = 1000
+    t = np.arange(sample_rate * 20) / sample_rate
+    x = np.stack([np.sin(2 * np.pi * 10 * t), np.sin(2 * np.pi * 20 * t)], axis=1) * 10
+    cache = SpectrumCache(2, sample_rate)
+    for i, e in enumerate(np.split(x, 500)):
+        cache.append(i, t[i * 40], t[i * 40], e)
+    snapshot = cache.spectrum()
+    print('Peaks:', cache.freqs[np.argmax(snapshot['psd'], axis=0)])
+    print('Band power:', dict(zip(cache.bands, snapshot['band_power'].round(2).tolist())))
+    print('Power:', np.sum(snapshot['psd'], axis=0) * cache.freqs[1], np.var(x, axis=0))
@@ -0,0 +1,60 @@
+'''
+File: epd.py
+Author: listenzcc
+Date: 2023-01-21
+
+The command line entry of the Pseudo EEG Device.
+
+The config is loaded before the role is imported,
+and only the modules of the role are imported,
+e.g. the sender does not import the websockets nor the pandas.
+
+Usage:
+    python epd.py [--config config.json] sender [--port 23340] [--compression delta]
+    python epd.py [--config config.json] data-center [--port 23334]
+    python epd.py [--config config.json] relay [--upstream localhost:23333] [--port 23335]
+'''
+
+# %%
+import os
+import argparse
+
+# The modules of the roles, they are imported after the config is loaded
+roles = {
+    'sender': 'signal_sender',
+    'data-center': 'data_center',
+    'relay': 'relay',
+}
+
+# %%
+
+
+def main(argv=None):
+    '''
+    Load the config and run the role,
+    the arguments after the role are parsed by the module of the role.
+
+    Args:
+        :param: argv: The command line arguments, None for the sys.argv.
+    '''
+    parser = argparse.ArgumentParser(
+        description='Pseudo EEG device, the arguments after the role are of the role, see <role> --help')
+    parser.add_argument('--config', default=None,
+                        help='The JSON config file of the setups, the EPD_CONFIG environment variable by default')
+    parser.add_argument('role', choices=list(roles),
+                        help='The role of the process')
+    args, role_argv = parser.parse_known_args(argv)
+
+    import main_setup
+    main_setup.load_config(args.config)
+    if args.config is not None:
+        # The spawned worker processes load the config too
+        os.environ['EPD_CONFIG'] = args.config
+
+    module = __import__(roles[args.role])
+    module.main(role_argv, prog='{} {}'.format(parser.prog, args.role))
+
+
+# %%
+if __name__ == '__main__':
+    main()
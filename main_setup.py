@@ -1,5 +1,12 @@
 # %%
+import os
+import json
+import time
+import queue
+import threading
+import atexit
 import logging
+import logging.handlers
 
 # %%
 # ----------------------------------------------------------------
@@ -9,38 +16,113 @@ main_setup = dict(
     interval=40,  # milliseconds
     channels=64,  # channels
     header_length=22,  # header length
+    protocol_version=1,  # 1 or 2, the version 2 carries channels, samples and dtype
+)
+
+# The high density setup, it requires the protocol version 2
+high_density_setup = dict(
+    sample_rate=8000,  # Hz
+    interval=10,  # milliseconds
+    channels=256,  # channels
+    protocol_version=2,
+)
+
+# The presets updating the main setup,
+# they are selected by {"preset": "<name>"} in the config file or the EPD_PRESET environment variable
+presets = dict(
+    high_density=high_density_setup,
 )
 
 # ----------------------------------------------------------------
 # Signal sender setup
 signal_sender_setup = dict(
     host='localhost',
-    port=23333
+    port=23333,
+    server_mode='thread',  # 'thread' or 'asyncio'
+    slow_consumer_policy='drop',  # 'drop', 'disconnect' or 'coalesce'
+    max_queue_packages=50,  # packages queued for every session
+    max_queue_bytes=4 * 1024 * 1024,  # bytes queued for every session
+    scheduler_spin=0.0005,  # seconds spinning before every deadline
+    source='synthetic',  # random | synthetic
+    send_queue=100,  # packages waiting for sending
+    prepare_ahead=8,  # packages encoded ahead of the deadlines
+    compression=None,  # None | delta | zlib | delta+zlib, it requires the protocol version 2
 )
 
 # ----------------------------------------------------------------
 # Data center setup
 data_center_setup = dict(
     host='localhost',
-    port=23334
+    port=23334,
+    # The signal senders by the device name, the first one is the default device
+    devices=dict(
+        default=(signal_sender_setup['host'], signal_sender_setup['port']),
+    ),
+    subscription_queue=100,  # packages queued for every subscriber
+    record_folder=None,  # the root folder of the recordings, None for not recording
+    record_compression=None,  # None | delta | zlib | delta+zlib, the full chunks are packed
+    pipeline=None,  # the DSP pipeline at the ingest, e.g. pipeline_setup, None for the raw data
+    shared_memory=None,  # the name prefix of the shared-memory streams, e.g. 'epd', None for not sharing
+    shared_memory_seconds=60,  # seconds of the ring of the shared-memory stream
+    serialize_workers=2,  # threads serializing the light requests, e.g. the polls
+    serialize_heavy_workers=1,  # threads serializing the heavy requests, so they do not delay the light ones
+    serialize_heavy_bytes=4 * 1024 * 1024,  # the estimated response bytes of the heavy request
+    websocket_compression=None,  # None | deflate, the deflate runs in the event loop and delays the other clients
+)
+
+# The DSP pipeline of the data center, the None value skips the stage
+pipeline_setup = dict(
+    resolution=0.1,  # µV of the sample unit, scale into float32 µV
+    bandpass=[1.0, 40.0],  # Hz
+    notch=50.0,  # Hz
+    car=True,  # common average reference
+)
+
+# ----------------------------------------------------------------
+# Metrics setup
+metrics_setup = dict(
+    snapshot_folder='log',  # the folder of the metrics-<role>.json snapshots, None for not writing
+    snapshot_seconds=10.0,  # seconds of the window of the snapshot
+)
+
+# ----------------------------------------------------------------
+# Relay setup
+relay_setup = dict(
+    upstream=(signal_sender_setup['host'], signal_sender_setup['port']),  # the signal sender being relayed
+    host='localhost',
+    port=23335,  # the port of the relay, the clients connect it as the signal sender
+    retry_seconds=2.0,  # seconds between the connecting tries of the upstream
 )
 
 # %%
 default_logging_kwargs = dict(
     name='EPD',
-    filepath='log/epd.log',
-    level_file=logging.DEBUG,
-    level_console=logging.DEBUG,
+    filepath='log/epd.log',  # None for not logging into the file
+    level_file='DEBUG',
+    level_console='INFO',
     format_file='%(asctime)s %(name)s %(levelname)-8s %(message)-40s {{%(filename)s:%(lineno)s:%(module)s:%(funcName)s}}',
     format_console='%(asctime)s %(name)s %(levelname)-8s %(message)-40s {{%(filename)s:%(lineno)s}}'
 )
 
 
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    '''
+    The queue handler without formatting,
+    the record is formatted by the handlers of the listener in its thread,
+    so the logging thread only puts the record into the queue.
+    '''
+
+    def prepare(self, record):
+        return record
+
+
 def generate_logger(name, filepath, level_file, level_console, format_file, format_console):
     '''
     Generate logger from inputs,
     the logger prints message both on the console and into the logging file.
-    The DEFAULT_LOGGING_KWARGS is provided to automatically startup
+    The DEFAULT_LOGGING_KWARGS is provided to automatically startup.
+    The records are put into the queue, and the listener thread writes them through the handlers,
+    so the console and the file do not block the logging thread.
 
     Args:
         :param:name: The name of the logger
@@ -51,23 +133,187 @@ def generate_logger(name, filepath, level_file, level_console, format_file, form
         :param:format_console: The format when logging into the file
     '''
 
-    logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
+    # The levels are the names or the numbers
+    level_file = logging.getLevelName(level_file) if isinstance(
+        level_file, str) else level_file
+    level_console = logging.getLevelName(level_console) if isinstance(
+        level_console, str) else level_console
 
-    file_handler = logging.FileHandler(filepath)
-    file_handler.setFormatter(logging.Formatter(format_file))
-    file_handler.setLevel(level_file)
+    logger = logging.getLogger(name)
 
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(logging.Formatter(format_console))
     console_handler.setLevel(level_console)
+    handlers = [console_handler]
+
+    if filepath is not None:
+        folder = os.path.dirname(filepath)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        file_handler = logging.FileHandler(filepath)
+        file_handler.setFormatter(logging.Formatter(format_file))
+        file_handler.setLevel(level_file)
+        handlers.append(file_handler)
+
+    # The records below the levels of all the handlers are skipped before formatting
+    logger.setLevel(min(e.level for e in handlers))
 
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        records, *handlers, respect_handler_level=True)
+    listener.start()
+    # The queued records are written before the exit
+    atexit.register(listener.stop)
+
+    logger.addHandler(DeferredQueueHandler(records))
 
     return logger
 
 
-logger = generate_logger(**default_logging_kwargs)
+class LogSampler(object):
+    '''
+    The sampler of the hot-path logging, it allows one summary line every seconds.
+
+    Usage:
+        sampler = LogSampler()
+        for package in packages:
+            if sampler.ready():
+                logger.debug('{} packages in {:.2f} seconds'.format(sampler.count, sampler.period))
+    '''
+
+    def __init__(self, seconds=1.0):
+        '''
+        Args:
+            :param: seconds: The seconds between the summary lines.
+        '''
+        self.seconds = seconds
+        self.t = time.monotonic()
+        self.events = 0
+        # The events and seconds of the latest period, they are valid when it is ready
+        self.count = 0
+        self.period = 0.0
+
+    def ready(self):
+        '''
+        Count the event, and check whether the summary line is due
+
+        Return:
+            :return: Whether the summary line is due, the count and period are of the period.
+        '''
+        self.events += 1
+        t = time.monotonic()
+        if t - self.t < self.seconds:
+            return False
+        self.count = self.events
+        self.period = t - self.t
+        self.events = 0
+        self.t = t
+        return True
+
+
+class LazyLogger(object):
+    '''
+    The logger being generated on demand,
+    the logging file, the handlers and the listener thread are created when it is used first,
+    so importing the modules has no side effect, and the config is loaded before it.
+    '''
+
+    def __init__(self, kwargs):
+        '''
+        Args:
+            :param: kwargs: The kwargs of the generate_logger, it is read when the logger is generated.
+        '''
+        self.kwargs = kwargs
+        self.logger = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self.logger is None:
+            with self.lock:
+                if self.logger is None:
+                    self.logger = generate_logger(**self.kwargs)
+        return getattr(self.logger, name)
+
+
+logger = LazyLogger(default_logging_kwargs)
+
+# %%
+# The setups being configured, by the name in the config file and the environment
+setups = dict(
+    main=main_setup,
+    signal_sender=signal_sender_setup,
+    data_center=data_center_setup,
+    pipeline=pipeline_setup,
+    metrics=metrics_setup,
+    relay=relay_setup,
+    logging=default_logging_kwargs,
+)
+
+
+def _update_setup(name, key, value):
+    '''
+    Update the value of the setup
+
+    Args:
+        :param: name: The name of the setup in the setups;
+        :param: key: The key of the setup;
+        :param: value: The new value.
+    '''
+    if name not in setups:
+        raise ValueError('Unknown setup {}, it is one of {}'.format(
+            name, list(setups)))
+    if key not in setups[name]:
+        raise ValueError('Unknown key {} of the setup {}'.format(key, name))
+    setups[name][key] = value
+
+
+def load_config(path=None, environ=os.environ):
+    '''
+    Load the config into the setups in place,
+    the config file is the JSON of {"<setup>": {"<key>": value}},
+    e.g. {"signal_sender": {"port": 23340, "compression": "delta"}}.
+    The "preset" of the config file, or the EPD_PRESET environment variable, selects the preset of the presets,
+    it updates the main setup before the setups of the config file, e.g. {"preset": "high_density"}.
+    The environment variables EPD_<SETUP>__<KEY> override the config file,
+    e.g. EPD_SIGNAL_SENDER__PORT=23340, the values are parsed as the JSON, or they are the strings.
+    It should be called before the other modules are imported,
+    since their defaults are read from the setups at their import.
+
+    Args:
+        :param: path: The path of the config file, None for the EPD_CONFIG environment variable;
+        :param: environ: The environment variables.
+    '''
+    if path is None:
+        path = environ.get('EPD_CONFIG')
+
+    config = dict()
+    if path is not None:
+        with open(path) as f:
+            config = json.load(f)
+
+    preset = environ.get('EPD_PRESET', config.pop('preset', None))
+    if preset is not None:
+        if preset not in presets:
+            raise ValueError('Unknown preset {}, it is one of {}'.format(
+                preset, list(presets)))
+        for key, value in presets[preset].items():
+            _update_setup('main', key, value)
+
+    for name, values in config.items():
+        for key, value in values.items():
+            _update_setup(name, key, value)
+
+    for variable, value in environ.items():
+        if not variable.startswith('EPD_') or '__' not in variable:
+            continue
+        name, key = variable[4:].lower().split('__', 1)
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        _update_setup(name, key, value)
+
+
+load_config()
 
 # %%
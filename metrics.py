@@ -0,0 +1,287 @@
+'''
+File: metrics.py
+Author: listenzcc
+Date: 2023-01-20
+
+The metrics of the sender, the data center and the websocket server.
+
+Every process has its metrics, the latency histograms of the stages,
+the counters of the packages and bytes, and the gauges of the queue depths.
+The metrics are summarized in the windows of snapshot_seconds,
+the latest window is written into the snapshot file,
+and it is served by the stats query of the websocket server.
+'''
+
+# %%
+import os
+import json
+import time
+import bisect
+import threading
+import numpy as np
+
+from main_setup import metrics_setup, logger
+
+# %%
+# The upper bounds of the histogram buckets in seconds, from 1 µs to about 12 s,
+# every bucket is sqrt(2) times wider than the previous one
+default_bounds = (1e-6 * 2 ** (np.arange(48) / 2)).tolist()
+
+
+class LatencyHistogram(object):
+    '''
+    The histogram of the latency in the log-spaced buckets,
+    the quantiles are estimated by the linear interpolation in the buckets.
+    '''
+
+    def __init__(self, bounds=default_bounds):
+        '''
+        Args:
+            :param: bounds: The ascending upper bounds of the buckets in seconds.
+        '''
+        self.bounds = bounds
+        self.reset()
+
+    def reset(self):
+        ''' Reset the histogram '''
+        # The last bucket is for the values beyond the bounds
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        '''
+        Observe the latency
+
+        Args:
+            :param: seconds: The latency in seconds.
+        '''
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        '''
+        Estimate the quantile, it is interpolated in the bucket
+
+        Args:
+            :param: q: The quantile in [0, 1].
+
+        Return:
+            :return: The latency in seconds.
+        '''
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumsum = 0
+        for i, count in enumerate(self.counts):
+            if count > 0 and cumsum + count >= rank:
+                break
+            cumsum += count
+        if i == len(self.bounds):
+            return self.max
+        lower = self.bounds[i - 1] if i > 0 else 0.0
+        value = lower + (self.bounds[i] - lower) * (rank - cumsum) / count
+        return min(self.max, value)
+
+    def summary(self):
+        '''
+        Summary the histogram
+
+        Return:
+            :return: The dict of count, mean, p50, p90, p99 and max latency in milliseconds.
+        '''
+        return dict(count=self.count,
+                    mean_ms=self.total / max(1, self.count) * 1e3,
+                    p50_ms=self.quantile(0.5) * 1e3,
+                    p90_ms=self.quantile(0.9) * 1e3,
+                    p99_ms=self.quantile(0.99) * 1e3,
+                    max_ms=self.max * 1e3)
+
+
+class Metrics(object):
+    '''
+    The metrics of the process, it is thread-safe.
+
+    The histograms are reset at every tick, so the window is the latency of the latest snapshot_seconds,
+    the counters are the totals, and the rates of the window are the increments over the window,
+    the gauges are the functions being called when the snapshot is taken.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = dict()
+        self.counters = dict()
+        self.gauges = dict()
+        self.t0 = time.time()
+        # The time stamp and the counters of the latest tick
+        self.tick_t = self.t0
+        self.tick_counters = dict()
+        # The latest window
+        self.window = None
+
+    def observe(self, stage, seconds):
+        '''
+        Observe the latency of the stage
+
+        Args:
+            :param: stage: The name of the stage;
+            :param: seconds: The latency in seconds.
+        '''
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = LatencyHistogram()
+            self.histograms[stage].observe(seconds)
+
+    def count(self, name, n=1):
+        '''
+        Increase the counter
+
+        Args:
+            :param: name: The name of the counter;
+            :param: n: The increment.
+        '''
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, fn):
+        '''
+        Register the gauge
+
+        Args:
+            :param: name: The name of the gauge;
+            :param: fn: The function returning the value of the gauge.
+        '''
+        self.gauges[name] = fn
+
+    def discard(self, name):
+        '''
+        Discard the counter and the gauge of the name, e.g. the client is disconnected
+
+        Args:
+            :param: name: The name of the counter or the gauge.
+        '''
+        with self.lock:
+            self.counters.pop(name, None)
+            self.tick_counters.pop(name, None)
+        self.gauges.pop(name, None)
+
+    def _window(self, t, reset):
+        '''
+        Summary the window since the latest tick
+
+        Args:
+            :param: t: The time stamp of the end of the window;
+            :param: reset: Whether to start the next window.
+        '''
+        with self.lock:
+            counters = dict(self.counters)
+            latency = {k: v.summary() for k, v in self.histograms.items()}
+            if reset:
+                for histogram in self.histograms.values():
+                    histogram.reset()
+
+        seconds = max(t - self.tick_t, 1e-6)
+        rates = {k: (v - self.tick_counters.get(k, 0)) / seconds
+                 for k, v in counters.items()}
+        window = dict(t_start=self.tick_t, t_end=t,
+                      latency=latency, rates=rates)
+        if reset:
+            self.tick_t = t
+            self.tick_counters = counters
+        return window
+
+    def snapshot(self, tick=False):
+        '''
+        Take the snapshot of the metrics
+
+        Args:
+            :param: tick: Whether to close the window, it is the periodic snapshot.
+
+        Return:
+            :return: The dict of t, uptime, counters, gauges,
+                     and the window of the latency summaries and the rates of the latest snapshot_seconds,
+                     the window is the current one until the first tick.
+        '''
+        t = time.time()
+        if tick or self.window is None:
+            window = self._window(t, reset=tick)
+            if tick:
+                self.window = window
+        else:
+            window = self.window
+
+        gauges = dict()
+        for name, fn in list(self.gauges.items()):
+            try:
+                gauges[name] = fn()
+            except Exception as err:
+                gauges[name] = None
+
+        with self.lock:
+            counters = dict(self.counters)
+
+        return dict(t=t, uptime=t - self.t0, counters=counters, gauges=gauges, window=window)
+
+    def keep_snapshotting(self, path=None, seconds=metrics_setup['snapshot_seconds']):
+        '''
+        Keep taking the periodic snapshot in the thread
+
+        Args:
+            :param: path: The path of the snapshot file, None for not writing the file;
+            :param: seconds: The seconds of the window.
+        '''
+        if path is not None and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        def _loop():
+            logger.info('Metrics snapshot every {} seconds into {}'.format(
+                seconds, path))
+            while True:
+                time.sleep(seconds)
+                snapshot = self.snapshot(tick=True)
+                if path is None:
+                    continue
+                try:
+                    with open(path + '.tmp', 'w') as f:
+                        json.dump(snapshot, f, indent=2)
+                    os.replace(path + '.tmp', path)
+                except Exception as err:
+                    logger.error('Metrics snapshot error: {}'.format(err))
+
+        t = threading.Thread(target=_loop, daemon=True)
+        t.start()
+
+
+def snapshot_path(role):
+    '''
+    The path of the snapshot file of the role
+
+    Args:
+        :param: role: The role of the process, e.g. 'sender' or 'data_center'.
+
+    Return:
+        :return: The path, None if metrics_setup['snapshot_folder'] is None.
+    '''
+    folder = metrics_setup['snapshot_folder']
+    if folder is None:
+        return None
+    return os.path.join(folder, 'metrics-{}.json'.format(role))
+
+
+# The metrics of the process
+metrics = Metrics()
+
+
+# %%
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    values = rng.lognormal(np.log(1e-3), 0.5, 10000)
+    for v in values:
+        metrics.observe('stage', v)
+        metrics.count('packages')
+    print('Estimated', metrics.snapshot()['window']['latency']['stage'])
+    print('Exact p50, p90, p99 in ms', np.percentile(values, [50, 90, 99]) * 1e3)
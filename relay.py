@@ -0,0 +1,159 @@
+'''
+File: relay.py
+Author: listenzcc
+Date: 2023-01-21
+
+The relay of the signal sender.
+
+The relay connects to the upstream signal sender,
+and broadcasts its packages to the clients of the relay as the signal sender does,
+the packages are forwarded as they are received, they are not decoded nor packed again,
+so the clients of many processes or hosts share one connection to the device.
+'''
+
+# %%
+import time
+import socket
+import argparse
+import threading
+import traceback
+
+from main_setup import signal_sender_setup, relay_setup, logger, LogSampler
+from signal_sender import SocketServer, AsyncSocketServer
+from coding_toolbox import FramedReceiver
+from metrics import metrics, snapshot_path
+
+# %%
+
+
+class Relay(object):
+    '''
+    The relay of the upstream signal sender,
+    it is connected again after retry_seconds if the upstream is disconnected.
+    '''
+
+    def __init__(self, server, upstream=None, retry_seconds=relay_setup['retry_seconds']):
+        '''
+        Args:
+            :param: server: The started server of the relay, the SocketServer or the AsyncSocketServer;
+            :param: upstream: The (host, port) of the upstream signal sender, None for relay_setup['upstream'];
+            :param: retry_seconds: The seconds between the connecting tries.
+        '''
+        self.server = server
+        self.host, self.port = relay_setup['upstream'] if upstream is None else upstream
+        self.retry_seconds = retry_seconds
+        self.connected = False
+        self.keep_receiving = False
+        self.log_sampler = LogSampler()
+        metrics.gauge('upstream_connected', lambda: int(self.connected))
+
+    def _relay(self, receiver):
+        '''
+        Forward the packages of the upstream until it is disconnected
+
+        Args:
+            :param: receiver: The FramedReceiver of the upstream.
+        '''
+        while self.keep_receiving:
+            if receiver.read() == 0:
+                return
+
+            for n, q, channels, sample_rate, dtype, flags, package in receiver.packages(raw=True):
+                metrics.observe('receive', time.time() - q)
+                if receiver.last_n is not None and n > receiver.last_n + 1:
+                    metrics.count('packages_missing', n - receiver.last_n - 1)
+                receiver.last_n = n
+
+                t = time.perf_counter()
+                sessions = self.server.send(bytes(package))
+                metrics.observe('send', time.perf_counter() - t)
+                metrics.count('packages_received')
+                metrics.count('bytes_received', len(package))
+                if sessions > 0:
+                    metrics.count('packages_sent')
+                    metrics.count('bytes_sent', len(package) * sessions)
+                else:
+                    metrics.count('packages_unsent')
+
+                if self.log_sampler.ready():
+                    logger.debug('Relayed {} packages in {:.2f} seconds, the latest is {} of {} bytes to {} clients'.format(
+                        self.log_sampler.count, self.log_sampler.period, n, len(package), sessions))
+
+    def receiving(self):
+        ''' Keep receiving the upstream and relaying the packages in the thread '''
+        self.keep_receiving = True
+
+        def _loop():
+            logger.info('Start relaying {}:{}'.format(self.host, self.port))
+            while self.keep_receiving:
+                try:
+                    client = socket.create_connection((self.host, self.port))
+                except OSError as err:
+                    logger.debug('Upstream {}:{} can not connect: {}'.format(
+                        self.host, self.port, err))
+                    time.sleep(self.retry_seconds)
+                    continue
+
+                self.connected = True
+                logger.info('Upstream {}:{} is connected'.format(
+                    self.host, self.port))
+                try:
+                    self._relay(FramedReceiver(client))
+                except OSError as err:
+                    logger.error('Upstream receiving error: {}'.format(err))
+                except Exception as err:
+                    logger.error('Unknown error occurs {}'.format(err))
+                    logger.error(traceback.format_exc())
+                finally:
+                    client.close()
+                    self.connected = False
+
+                logger.info('Upstream {}:{} is disconnected'.format(
+                    self.host, self.port))
+                time.sleep(self.retry_seconds)
+
+            logger.info('Stop relaying')
+
+        t = threading.Thread(target=_loop, daemon=True)
+        t.start()
+
+
+# %%
+def main(argv=None, prog=None):
+    '''
+    Run the relay, it serves the packages of the upstream signal sender
+
+    Args:
+        :param: argv: The command line arguments, None for the sys.argv;
+        :param: prog: The program name of the usage.
+    '''
+    parser = argparse.ArgumentParser(
+        prog=prog, description='Relay of the pseudo EEG device')
+    parser.add_argument('--upstream', default='{}:{}'.format(*relay_setup['upstream']),
+                        help='The host:port of the upstream signal sender')
+    parser.add_argument('--port', type=int, default=relay_setup['port'],
+                        help='The port of the relay')
+    args = parser.parse_args(argv)
+
+    host, port = args.upstream.rsplit(':', 1)
+
+    logger.info('Relay starts')
+    metrics.keep_snapshotting(snapshot_path('relay'))
+
+    if signal_sender_setup['server_mode'] == 'asyncio':
+        server = AsyncSocketServer()
+    else:
+        server = SocketServer()
+    server.host = relay_setup['host']
+    server.port = args.port
+    server.start()
+
+    relay = Relay(server, (host, int(port)))
+    relay.receiving()
+
+    input('Press enter to quit')
+
+
+# %%
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+'''
+File: scheduler.py
+Author: listenzcc
+Date: 2023-01-12
+
+The drift-free scheduler of the packages.
+'''
+
+# %%
+import time
+import numpy as np
+
+from main_setup import main_setup, signal_sender_setup
+
+# %%
+
+
+class LatenessStats(object):
+    '''
+    The statistics of the lateness of the ticks,
+    the latest lateness values are restored in the ring array.
+    '''
+
+    def __init__(self, size=1000):
+        '''
+        Args:
+            :param: size: The number of the latest ticks in the statistics.
+        '''
+        self.size = size
+        self.reset()
+
+    def reset(self):
+        ''' Reset the statistics '''
+        self.values = np.zeros(self.size, dtype=np.float64)
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, lateness):
+        '''
+        Add the lateness of the tick
+
+        Args:
+            :param: lateness: The lateness in seconds.
+        '''
+        self.values[self.count % self.size] = lateness
+        self.count += 1
+        if lateness > self.max:
+            self.max = lateness
+
+    def summary(self):
+        '''
+        Summary the statistics of the latest ticks
+
+        Return:
+            :return: The dict of count, mean, p99 and max (of all the ticks) lateness in seconds.
+        '''
+        values = self.values[:min(self.count, self.size)]
+        if len(values) == 0:
+            return dict(count=0, mean=0.0, p99=0.0, max=0.0)
+        return dict(count=self.count,
+                    mean=float(np.mean(values)),
+                    p99=float(np.percentile(values, 99)),
+                    max=self.max)
+
+
+class DeadlineScheduler(object):
+    '''
+    The scheduler ticks at the fixed interval with the monotonic clock.
+    The deadline of the k-th tick is t0 + k x interval, so it does not drift,
+    it sleeps until the deadline, and optionally spins the last short period.
+    '''
+
+    def __init__(self, interval=main_setup['interval'], spin=signal_sender_setup['scheduler_spin']):
+        '''
+        Args:
+            :param: interval: The interval between the ticks in milliseconds, 0 for no waiting;
+            :param: spin: The seconds of spinning before the deadline, 0 for sleeping only.
+        '''
+        self.interval = interval / 1000
+        self.spin = spin
+        self.stats = LatenessStats()
+        self.start()
+
+    def start(self):
+        ''' Start the ticks from now '''
+        self.t0 = time.monotonic()
+        self.k = 0
+        # The count of the ticks being later than the interval
+        self.late = 0
+        self.stats.reset()
+
+    def wait(self):
+        '''
+        Wait until the deadline of the next tick
+
+        Return:
+            :return: lateness: The lateness of the tick in seconds.
+        '''
+        deadline = self.t0 + self.k * self.interval
+        self.k += 1
+
+        remain = deadline - time.monotonic()
+        if remain > self.spin:
+            time.sleep(remain - self.spin)
+
+        now = time.monotonic()
+        while now < deadline:
+            now = time.monotonic()
+
+        lateness = now - deadline
+        self.stats.add(lateness)
+        if self.interval > 0 and lateness > self.interval:
+            self.late += 1
+        return lateness
+
+    def summary(self):
+        '''
+        Summary the lateness of the ticks
+
+        Return:
+            :return: The dict of the lateness statistics and the late ticks.
+        '''
+        summary = self.stats.summary()
+        summary['late'] = self.late
+        return summary
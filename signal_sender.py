@@ -8,12 +8,20 @@ The signal sender of Pseudo EEG device.
 
 # %%
 import time
+import queue
 import socket
+import argparse
 import threading
 import traceback
+import numpy as np
 
-from main_setup import main_setup, signal_sender_setup, logger
-from coding_toolbox import generate_package, encode_header, decode_header
+from collections import deque
+
+from main_setup import main_setup, signal_sender_setup, logger, LogSampler
+from coding_toolbox import encode_body, encode_header, header_codec_v2, sample_dtype, sample_dtype_codes, pack_body, body_delta_flag, compression_flags
+from scheduler import DeadlineScheduler
+from metrics import metrics, snapshot_path
+from signal_source import ReplaySource, sources
 
 
 # %%
@@ -73,7 +81,10 @@ class SocketServer(object):
         def _loop():
             logger.debug('Handling sessions starts')
             while self.keep_alive:
-                client, address = self.server.accept()
+                try:
+                    client, address = self.server.accept()
+                except OSError:
+                    break
                 session = SocketSession(client=client, address=address)
                 self.sessions.append(session)
                 self.check_sessions()
@@ -82,6 +93,23 @@ class SocketServer(object):
         t = threading.Thread(target=_loop, daemon=True)
         t.start()
 
+    def close(self):
+        ''' Stop handling the sessions, and close the sessions and the server '''
+        self.keep_alive = False
+        for session in self.sessions:
+            session.close()
+            try:
+                session.client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            session.client.close()
+        # The shutdown wakes the blocking accept
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server.close()
+
 
 class SocketSession(object):
     '''
@@ -93,6 +121,8 @@ class SocketSession(object):
         self.client = client
         self.address = address
         self.buffer_size = 1024
+        self.log_sampler = LogSampler()
+        self.metric = 'client_bytes.{}:{}'.format(*address)
         self.start()
 
     def start(self):
@@ -104,6 +134,7 @@ class SocketSession(object):
     def close(self):
         ''' Close the connection with the client '''
         self.is_connected = False
+        metrics.discard(self.metric)
         logger.error('Client closed {}'.format(self.client))
 
     def send(self, buffer, debug=False):
@@ -119,6 +150,7 @@ class SocketSession(object):
         '''
         try:
             self.client.sendall(buffer)
+            metrics.count(self.metric, len(buffer))
             if debug:
                 logger.debug('Client sent {} bytes, {}'.format(
                     len(buffer), buffer[:20]))
@@ -135,7 +167,9 @@ class SocketSession(object):
         while self.is_connected:
             try:
                 buffer = self.client.recv(self.buffer_size)
-                logger.debug('Received {} bytes'.format(len(buffer)))
+                if self.log_sampler.ready():
+                    logger.debug('Received {} messages in {:.2f} seconds, the latest is {} bytes'.format(
+                        self.log_sampler.count, self.log_sampler.period, len(buffer)))
 
                 if len(buffer) == 0:
                     break
@@ -146,57 +180,387 @@ class SocketSession(object):
 
             except Exception as err:
                 logger.error('Unknown error: {}'.format(err))
-                logger.error(traceback.format_exec())
+                logger.error(traceback.format_exc())
                 break
 
         self.close()
 
 
+class AsyncSocketServer(object):
+    '''
+    Socket server as the EEG signal sender,
+    the sessions are served by the asyncio event loop in a single thread.
+    Every session has its write queue,
+    so the slow session does not delay the others.
+    '''
+
+    def __init__(self,
+                 policy=signal_sender_setup['slow_consumer_policy'],
+                 max_queue_packages=signal_sender_setup['max_queue_packages'],
+                 max_queue_bytes=signal_sender_setup['max_queue_bytes']):
+        '''
+        Args:
+            :param: policy: The slow consumer policy, 'drop', 'disconnect' or 'coalesce';
+            :param: max_queue_packages: The max packages queued for every session;
+            :param: max_queue_bytes: The max bytes queued for every session.
+        '''
+        assert policy in ('drop', 'disconnect', 'coalesce'), \
+            'Invalid slow consumer policy: {}'.format(policy)
+        self.host = signal_sender_setup['host']
+        self.port = signal_sender_setup['port']
+        self.policy = policy
+        self.max_queue_packages = max_queue_packages
+        self.max_queue_bytes = max_queue_bytes
+        self.sessions = []
+        self.loop = None
+
+    def start(self):
+        ''' Start the server in the event loop thread '''
+        # The asyncio is imported only when the asyncio server is used
+        import asyncio
+
+        ready = threading.Event()
+
+        async def _serve():
+            server = await asyncio.start_server(self.handle, self.host, self.port)
+            self.server = server
+            logger.info('Server listening on {}:{} ({} policy)'.format(
+                self.host, self.port, self.policy))
+            ready.set()
+            async with server:
+                try:
+                    await server.serve_forever()
+                except asyncio.CancelledError:
+                    logger.info('Server closed')
+            # Let the closed sessions finish
+            await asyncio.gather(*[e for e in asyncio.all_tasks() if e is not asyncio.current_task()],
+                                 return_exceptions=True)
+
+        def _loop():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            try:
+                self.loop.run_until_complete(_serve())
+            except Exception as err:
+                logger.error('Server stops: {}'.format(err))
+                ready.set()
+            finally:
+                self.loop.run_until_complete(
+                    self.loop.shutdown_default_executor())
+                self.loop.close()
+
+        t = threading.Thread(target=_loop, daemon=True)
+        t.start()
+        ready.wait()
+
+    def close(self):
+        ''' Close the sessions and the server in the event loop '''
+        if self.loop is None:
+            return
+
+        def _close():
+            for session in self.sessions:
+                session.close()
+            self.server.close()
+
+        self.loop.call_soon_threadsafe(_close)
+
+    def check_sessions(self):
+        ''' Remove invalid sessions and list the valid sessions '''
+        self.sessions = [e for e in self.sessions if e.is_connected]
+        logger.debug('Found {} sessions'.format(len(self.sessions)))
+        return self.sessions
+
+    def send(self, buffer):
+        '''
+        Send the buffer to all the sessions,
+        it is thread-safe and returns without waiting the sessions.
+
+        Args:
+            :param: buffer: The buffer to send
+
+        Return:
+            :return: n: How many sessions the buffer was queued for
+        '''
+        sessions = [e for e in self.sessions if e.is_connected]
+        if self.loop is None or not sessions:
+            return 0
+        self.loop.call_soon_threadsafe(self._broadcast, buffer)
+        return len(sessions)
+
+    def _broadcast(self, buffer):
+        '''
+        Queue the buffer for all the sessions in the event loop
+
+        Args:
+            :param: buffer: The buffer to send
+        '''
+        for session in self.sessions:
+            if session.is_connected:
+                session.offer(buffer)
+
+    async def handle(self, reader, writer):
+        '''
+        Handle the incoming session until it is closed
+
+        Args:
+            :param: reader: The stream reader;
+            :param: writer: The stream writer.
+        '''
+        session = AsyncSocketSession(self, reader, writer)
+        self.sessions.append(session)
+        self.check_sessions()
+        await session.run()
+        self.check_sessions()
+
+
+class AsyncSocketSession(object):
+    '''
+    The asyncio session of the incoming client.
+    The session is created and maintained by AsyncSocketServer.
+    '''
+
+    def __init__(self, server, reader, writer):
+        import asyncio
+
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.address = writer.get_extra_info('peername')
+        self.buffer_size = 1024
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.dropped = 0
+        self.ready = asyncio.Event()
+        self.is_connected = True
+        self.metric = 'client_bytes.{}:{}'.format(*self.address[:2])
+        metrics.gauge('client_queue.{}:{}'.format(
+            *self.address[:2]), lambda: len(self.queue))
+        logger.info('Client started {}'.format(self.address))
+
+    def close(self):
+        ''' Close the connection with the client '''
+        if self.is_connected:
+            logger.info('Client closed {}, {} packages dropped'.format(
+                self.address, self.dropped))
+        self.is_connected = False
+        metrics.discard(self.metric)
+        metrics.discard('client_queue.{}:{}'.format(*self.address[:2]))
+        self.ready.set()
+        self.writer.close()
+
+    def offer(self, buffer):
+        '''
+        Queue the buffer to send,
+        the slow consumer policy is applied when the queue is beyond its limits.
+
+        Args:
+            :param: buffer: The buffer to send
+        '''
+        # Every item is the buffer and the number of the packages in it
+        self.queue.append((buffer, 1))
+        self.queued_bytes += len(buffer)
+        self.ready.set()
+
+        server = self.server
+        if len(self.queue) <= server.max_queue_packages and self.queued_bytes <= server.max_queue_bytes:
+            return
+
+        if server.policy == 'disconnect':
+            logger.warning('Client {} is too slow, disconnecting'.format(
+                self.address))
+            metrics.count('clients_disconnected')
+            self.close()
+            return
+
+        if server.policy == 'coalesce' and self.queued_bytes <= server.max_queue_bytes:
+            # Merge the queued packages into a single chunk to write at once
+            chunk = b''.join([e[0] for e in self.queue])
+            packages = sum([e[1] for e in self.queue])
+            self.queue.clear()
+            self.queue.append((chunk, packages))
+            return
+
+        while len(self.queue) > 1 and (len(self.queue) > server.max_queue_packages or self.queued_bytes > server.max_queue_bytes):
+            buffer, packages = self.queue.popleft()
+            self.queued_bytes -= len(buffer)
+            self.dropped += packages
+            metrics.count('packages_dropped', packages)
+
+        if server.policy == 'coalesce' and self.queued_bytes > server.max_queue_bytes:
+            logger.warning('Client {} is too slow, disconnecting'.format(
+                self.address))
+            self.close()
+
+    async def writing(self):
+        ''' Write the queued buffers to the client '''
+        while self.is_connected:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.queue and self.is_connected:
+                buffer, packages = self.queue.popleft()
+                self.queued_bytes -= len(buffer)
+                self.writer.write(buffer)
+                await self.writer.drain()
+                metrics.count(self.metric, len(buffer))
+
+    async def listen(self):
+        ''' Handle the message from the client '''
+        while self.is_connected:
+            buffer = await self.reader.read(self.buffer_size)
+            if len(buffer) == 0:
+                break
+
+    async def run(self):
+        ''' Serve the client until either direction stops '''
+        import asyncio
+
+        tasks = [asyncio.ensure_future(self.writing()),
+                 asyncio.ensure_future(self.listen())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks:
+                if task.done() and task.exception() is not None:
+                    logger.error('Client {} error: {}'.format(
+                        self.address, task.exception()))
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.close()
+
+
 class EEG_Pseudo_Device(object):
     '''
     Automatic signal server for Pseudo EEG device
     '''
 
-    def __init__(self):
+    def __init__(self,
+                 channels=main_setup['channels'],
+                 sample_rate=main_setup['sample_rate'],
+                 interval=main_setup['interval'],
+                 protocol_version=main_setup['protocol_version'],
+                 source=None,
+                 speed=1.0,
+                 compression=signal_sender_setup['compression']):
+        '''
+        Args:
+            :param: channels: The channels of the device, it is ignored if the source is provided;
+            :param: sample_rate: The sample rate of the device, it is ignored if the source is provided;
+            :param: interval: The interval between the packages in milliseconds;
+            :param: protocol_version: The protocol version of the header, 1 or 2;
+            :param: source: The signal source, None for the source of signal_sender_setup['source'];
+            :param: speed: The speed of the packages, 1.0 for the real-time, 'max' for the max speed;
+            :param: compression: The compression of the body, None, 'delta', 'zlib' or 'delta+zlib', it requires the protocol version 2.
+        '''
+        if source is None:
+            source = sources[signal_sender_setup['source']](
+                channels, sample_rate)
+        self.source = source
+        self.channels = source.channels
+        self.sample_rate = source.sample_rate
+        self.dtype = np.dtype(source.dtype)
+        self.interval = interval
+        self.speed = speed
+        self.samples = int(interval / 1000 * self.sample_rate)
+        self.protocol_version = protocol_version
+        self.flags = compression_flags[compression]
+
+        if self.flags & body_delta_flag and not self.dtype.kind == 'i':
+            logger.warning('The delta compression requires the integer samples, not {}'.format(
+                self.dtype))
+            self.flags &= ~body_delta_flag
+
+        if protocol_version == 1 and self.samples * self.channels * self.dtype.itemsize > 0xFFFF:
+            logger.warning('The package of {} x {} samples is too large for the protocol version 1, using version 2'.format(
+                self.samples, self.channels))
+            self.protocol_version = 2
+
+        # The receiver of the protocol version 1 assumes the channels, dtype and sample rate of the main_setup
+        if protocol_version == 1 and not (self.dtype == sample_dtype and self.channels == main_setup['channels'] and self.sample_rate == main_setup['sample_rate']):
+            logger.warning('The {} channels of {} at {} Hz are not supported by the protocol version 1, using version 2'.format(
+                self.channels, self.dtype, self.sample_rate))
+            self.protocol_version = 2
+
+        # The flags of the compression are carried by the header of the protocol version 2
+        if protocol_version == 1 and self.flags:
+            logger.warning('The {} compression is not supported by the protocol version 1, using version 2'.format(
+                compression))
+            self.protocol_version = 2
+
+        logger.info('Device of {} channels at {} Hz, {} samples every {} ms at {} speed, protocol version {}, {} compression'.format(
+            self.channels, self.sample_rate, self.samples, interval, speed, self.protocol_version, compression))
         self.reset()
+        metrics.gauge('prepared_queue', lambda: self.prepared.qsize())
+        metrics.gauge('send_queue', lambda: self.buffer.qsize())
         pass
 
     def reset(self):
         '''
         Reset the buffer and package idx
         '''
-        self.buffer = []
+        self.buffer = queue.Queue(maxsize=signal_sender_setup['send_queue'])
+        self.prepared = queue.Queue(maxsize=signal_sender_setup['prepare_ahead'])
         self.n = 0
         self.keep_filling = False
         self.keep_sending = False
         logger.debug('Dataset is reset')
 
+    def encode_header(self, n, k, q):
+        '''
+        Encode the header in the protocol version of the device
+
+        Args:
+            :param: n: the package id n;
+            :param: k: The length of the bytes;
+            :param: q: The time stamp of the package;
+
+        Return:
+            :return: The encoded header
+        '''
+        if self.protocol_version == 2:
+            return header_codec_v2.pack(n, k, q, self.channels, self.samples, sample_dtype_codes[self.dtype], self.flags, self.sample_rate)
+        return encode_header(n, k, q)
+
     def keep_sending_buffer(self, server=None):
         '''
         keep empty the buffer by sending the elements
         '''
-        def _send(header, code):
+        log_sampler = LogSampler()
+        # The packages not sent to any client in the period of the log sampler
+        unsent = [0]
+
+        def _send(header, code, n):
             '''
             Send the header + code
 
             Args:
                 :param: header: The header to send;
-                :param: code: The code to send
+                :param: code: The code to send;
+                :param: n: The package id, for the logging.
 
             Return:
-                :return: n: How many sessions were sent thought
+                :return: sessions: How many sessions were sent thought
             '''
-            output = decode_header(header)
-            n = -1
+            sessions = -1
             if server is not None:
-                n = server.send(header + code)
+                t = time.perf_counter()
+                sessions = server.send(header + code)
+                metrics.observe('send', time.perf_counter() - t)
 
-            if n > 0:
-                print('Sent to {} clients'.format(n), output, len(code))
+            if sessions > 0:
+                metrics.count('packages_sent')
+                metrics.count('bytes_sent', len(header) + len(code))
             else:
-                print('Not sent', output, len(code))
+                metrics.count('packages_unsent')
+                unsent[0] += 1
+
+            if log_sampler.ready():
+                logger.debug('Sent {} packages in {:.2f} seconds, {} not sent, the latest is {} of {} bytes to {} clients'.format(
+                    log_sampler.count, log_sampler.period, unsent[0], n, len(code), max(0, sessions)))
+                unsent[0] = 0
 
-            return n
+            return sessions
 
         def _loop():
             '''
@@ -204,64 +568,159 @@ class EEG_Pseudo_Device(object):
             '''
             self.keep_sending = True
             while self.keep_sending:
-                if len(self.buffer) > 0:
-                    n, k, q, code = self.buffer.pop(0)
-                    header = encode_header(n, k, q)
-                    _send(header, code)
+                try:
+                    n, k, q, code = self.buffer.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                # The package waits in the send queue since it is stamped
+                metrics.observe('send_wait', time.time() - q)
+                header = self.encode_header(n, k, q)
+                _send(header, code, n)
 
         t = threading.Thread(target=_loop, daemon=True)
         t.start()
 
-    def keep_filling_buffer(self, interval=main_setup['interval']):
+    def keep_preparing(self):
+        '''
+        Keep reading and encoding the packages ahead of the deadlines,
+        the prepared queue is bounded, so it blocks when it is far enough ahead.
+        The None is put when the source ends.
+        '''
+        prepared = self.prepared
+
+        def _loop():
+            logger.debug('Start keep_preparing.')
+            while self.keep_filling:
+                t = time.perf_counter()
+                data = self.source.read(self.samples)
+                if len(data) < self.samples:
+                    logger.info('The source ends')
+                    prepared.put(None)
+                    break
+                t1 = time.perf_counter()
+                if self.flags:
+                    code = pack_body(data.astype(self.dtype, copy=False), self.flags)
+                else:
+                    code = encode_body(data, self.dtype)
+                metrics.observe('generate', t1 - t)
+                metrics.observe('encode', time.perf_counter() - t1)
+                prepared.put((data, code))
+            logger.debug('Stop keep_preparing.')
+
+        t = threading.Thread(target=_loop, daemon=True)
+        t.start()
+
+    def keep_filling_buffer(self, interval=None, spin=signal_sender_setup['scheduler_spin']):
         '''
         Keep fill the buffer at the fixed rate
 
         Args:
-            :param: interval: The interval between the filling events in milliseconds
+            :param: interval: The interval between the filling events in milliseconds, None for the device interval at its speed;
+            :param: spin: The seconds of spinning before every deadline, 0 for sleeping only.
         '''
+        if interval is None:
+            interval = 0 if self.speed == 'max' else self.interval / self.speed
+        self.scheduler = DeadlineScheduler(interval, spin)
+        report = max(1, int(10000 / interval)) if interval > 0 else 10000
 
         def _fill_buffer():
             '''
-            Fill the buffer with generated package
+            Fill the buffer with the prepared package
+
+            Return:
+                :return: Whether the package is filled, False refers the source ends.
             '''
-            n, k, q, code, data = generate_package(self.n)
+            prepared = self.prepared.get()
+            if prepared is None:
+                return False
+            data, code = prepared
+            n, k, q = self.n, len(code), time.time()
             self.n += 1
-            self.buffer.append((n, k, q, code))
+            self.buffer.put((n, k, q, code))
+            metrics.count('packages')
+            return True
 
         def _loop():
             '''
             Fill the buffer in a loop until the keep_filling symbol is reset
             '''
             self.keep_filling = True
+            self.keep_preparing()
 
-            t0 = time.time()
-            n0 = self.n
+            self.scheduler.start()
             logger.debug('Start _keep_fill_buffer.')
             while self.keep_filling:
-                if (time.time() - t0) * 1000 < (self.n - n0) * interval:
-                    continue
-                _fill_buffer()
+                lateness = self.scheduler.wait()
+                metrics.observe('schedule', lateness)
+                if self.scheduler.interval > 0 and lateness > self.scheduler.interval:
+                    metrics.count('packages_late')
+                if not _fill_buffer():
+                    self.keep_filling = False
+                    break
+
+                if self.scheduler.k % report == 0:
+                    logger.info('Scheduler lateness: {}'.format(
+                        self.scheduler.summary()))
 
             logger.debug('Stop _keep_fill_buffer.')
 
             return
 
         self.reset()
+        self.keep_filling = True
         t = threading.Thread(target=_loop, daemon=True)
         t.start()
 
 
 # %%
-if __name__ == '__main__':
+def main(argv=None, prog=None):
+    '''
+    Run the pseudo EEG device, it sends the signal to the connected clients
+
+    Args:
+        :param: argv: The command line arguments, None for the sys.argv;
+        :param: prog: The program name of the usage.
+    '''
+    parser = argparse.ArgumentParser(
+        prog=prog, description='Pseudo EEG device')
+    parser.add_argument('--replay', default=None,
+                        help='The folder of the recording to replay')
+    parser.add_argument('--source', default=signal_sender_setup['source'],
+                        choices=list(sources),
+                        help='The source of the signal, it is ignored if replay is provided')
+    parser.add_argument('--speed', default='1',
+                        help='The speed of the replay, e.g. 1, 2.5 or max')
+    parser.add_argument('--port', type=int, default=signal_sender_setup['port'],
+                        help='The port of the server, every device of the lab has its own port')
+    parser.add_argument('--compression', default=signal_sender_setup['compression'],
+                        choices=[e for e in compression_flags if e is not None],
+                        help='The compression of the body, it requires the protocol version 2')
+    args = parser.parse_args(argv)
+
     logger.info('Session starts')
+    metrics.keep_snapshotting(snapshot_path('sender'))
 
-    server = SocketServer()
+    if signal_sender_setup['server_mode'] == 'asyncio':
+        server = AsyncSocketServer()
+    else:
+        server = SocketServer()
+    server.port = args.port
     server.start()
 
-    eeg_pd = EEG_Pseudo_Device()
+    if args.replay is not None:
+        source = ReplaySource(args.replay)
+    else:
+        source = sources[args.source]()
+    speed = 'max' if args.speed == 'max' else float(args.speed)
+
+    eeg_pd = EEG_Pseudo_Device(
+        source=source, speed=speed, compression=args.compression)
     eeg_pd.keep_filling_buffer()
     eeg_pd.keep_sending_buffer(server)
 
     input('Press enter to quit')
 
+
 # %%
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+'''
+File: signal_source.py
+Author: listenzcc
+Date: 2023-01-15
+
+The signal sources of the Pseudo EEG device.
+The source reads the continuous samples, and the device chunks them into the packages.
+'''
+
+# %%
+import numpy as np
+
+from main_setup import main_setup, logger
+from eeg_generator import SyntheticSource
+
+# %%
+
+
+class RandomSource(object):
+    '''
+    The source of the uniform random integers
+    '''
+
+    def __init__(self, channels=main_setup['channels'], sample_rate=main_setup['sample_rate']):
+        '''
+        Args:
+            :param: channels: The channels of the source;
+            :param: sample_rate: The sample rate of the source.
+        '''
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.dtype = np.dtype('<i4')
+
+    def read(self, samples):
+        '''
+        Read the next samples
+
+        Args:
+            :param: samples: The number of the samples.
+
+        Return:
+            :return: data: The 2D array of the samples, (samples x channels).
+        '''
+        return np.random.randint(-1000, 1000, (samples, self.channels), dtype=self.dtype)
+
+
+class ReplaySource(object):
+    '''
+    The source of the recording on the disk.
+    The recording is memory-mapped, and the samples are read lazily,
+    so the packages of the recording are re-chunked into the packages of the device.
+    '''
+
+    def __init__(self, folder, loop=True):
+        '''
+        Args:
+            :param: folder: The folder of the recording;
+            :param: loop: Whether to replay from the beginning after the end.
+        '''
+        # The recorder is imported only when the recording is replayed,
+        # so the sender of the live sources does not import the dataset
+        from eeg_recorder import RecordingReader
+
+        self.reader = RecordingReader(folder)
+        self.channels = self.reader.channels
+        self.sample_rate = self.reader.sample_rate
+        self.dtype = np.dtype(self.reader.meta['dtype'])
+        self.loop = loop
+        # The cursor of the next sample
+        self.cursor = 0
+        self.total = self.reader.length() * self.reader.samples
+        logger.info('Replay source of {} samples of {} channels at {} Hz from {}'.format(
+            self.total, self.channels, self.sample_rate, folder))
+
+    def _read(self, start, stop):
+        '''
+        Read the samples from start to stop,
+        only the packages covering the samples are touched.
+
+        Args:
+            :param: start: The first sample;
+            :param: stop: The sample after the last sample.
+        '''
+        samples = self.reader.samples
+        a, b = start // samples, (stop + samples - 1) // samples
+        data = self.reader.get_packages(a, b).data
+        return data[start - a * samples:stop - a * samples]
+
+    def read(self, samples):
+        '''
+        Read the next samples,
+        it starts over if the recording ends and loop is True,
+        and returns the remaining samples (maybe empty) otherwise.
+
+        Args:
+            :param: samples: The number of the samples.
+
+        Return:
+            :return: data: The 2D array of the samples, (samples x channels).
+        '''
+        parts = []
+        remain = samples
+        while remain > 0:
+            if self.cursor >= self.total:
+                if not self.loop or self.total == 0:
+                    break
+                self.cursor = 0
+            m = min(remain, self.total - self.cursor)
+            parts.append(self._read(self.cursor, self.cursor + m))
+            self.cursor += m
+            remain -= m
+
+        if len(parts) == 1:
+            return parts[0]
+        if len(parts) == 0:
+            return np.zeros((0, self.channels), dtype=self.dtype)
+        return np.concatenate(parts)
+
+
+# The sources of the pseudo device by the name
+sources = dict(
+    random=RandomSource,
+    synthetic=SyntheticSource,
+)
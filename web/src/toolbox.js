@@ -2,45 +2,218 @@ BACKGROUND_COLOR = "#303030";
 REFRESH_INTERVAL = 0.1;
 REQUEST_SECONDS = 4.0;
 POINTS_PER_SECOND = parseInt(1000 / 40);
+// The format of the response, "binary" or "json"
+REQUEST_FORMAT = "binary";
+// The seconds of the min/max envelope
+ENVELOPE_SECONDS = 60.0;
+// The frame flag of the min/max envelope
+FRAME_ENVELOPE_FLAG = 1;
+// The frame flag of the since cursor being aged out
+FRAME_AGED_OUT_FLAG = 8;
+// The device of the data center, undefined for the default device
+DEVICE = undefined;
 
 INTERVALS = Object.assign({
   id: undefined,
 });
 
+// The subscription of the data center,
+// the frames and latency are the client-side buffer of the latest seconds,
+// the since is the latest package idx being requested,
+// and the lastIdx is the latest package idx in the buffer.
+STREAM = Object.assign({
+  ws: undefined,
+  frames: [],
+  latency: [],
+  channels: 0,
+  since: undefined,
+  lastIdx: undefined,
+});
+
+/**
+ * Reset the client-side buffer
+ */
+function resetStream() {
+  STREAM.frames = [];
+  STREAM.latency = [];
+  STREAM.lastIdx = undefined;
+}
+
 /**
- * Keep requesting frames from the data center.
+ * Push the converted frames into the client-side buffer,
+ * the packages whose idx is not newer than the buffer are dropped,
+ * and drop the frames older than the displaying seconds.
+ *
+ * @param {} converted The {frames, channels, latency, idx} of the convertFrame.
+ * @param {Number} seconds The displaying seconds.
+ */
+function pushFrames(converted, seconds) {
+  const { channels, idx } = converted;
+  let { frames, latency } = converted;
+
+  // The frames and latency are in the order of the packages
+  let k = 0;
+  if (STREAM.lastIdx !== undefined) {
+    while (k < idx.length && idx[k] <= STREAM.lastIdx) ++k;
+  }
+  if (k > 0) {
+    frames = frames.slice((k * frames.length) / idx.length);
+    latency = latency.slice((k * latency.length) / idx.length);
+  }
+  if (k < idx.length) STREAM.lastIdx = idx[idx.length - 1];
+  if (frames.length === 0) return;
+
+  STREAM.channels = channels;
+  STREAM.frames.push(...frames);
+  STREAM.latency.push(...latency);
+
+  const t0 = frames[frames.length - 1].t - seconds;
+  let i = 0;
+  while (i < STREAM.frames.length && STREAM.frames[i].t < t0) ++i;
+  if (i > 0) STREAM.frames.splice(0, i);
+  i = 0;
+  while (i < STREAM.latency.length && STREAM.latency[i].t < t0) ++i;
+  if (i > 0) STREAM.latency.splice(0, i);
+}
+
+/**
+ * Subscribe the data center and keep drawing the frames.
+ * The data center sends the backfill of the latest seconds once,
+ * and pushes the new packages as they arrive,
+ * the frames are drawn from the client-side buffer.
  */
 function requesting() {
   console.log("Requesting");
 
   const seconds = REQUEST_SECONDS;
 
+  stopRequesting();
+
+  const ws = new WebSocket("ws://localhost:23334/?accessToken=123456");
+  ws.binaryType = "arraybuffer";
+  STREAM.ws = ws;
+  resetStream();
+
+  ws.onopen = function (e) {
+    console.log("Connection established");
+    ws.send(
+      JSON.stringify({
+        subscribe: true,
+        latest: seconds * POINTS_PER_SECOND,
+        format: REQUEST_FORMAT,
+        device: DEVICE,
+      })
+    );
+  };
+
+  ws.onerror = function (e) {
+    console.error("Connection error", e);
+  };
+
+  ws.onclose = function (e) {
+    console.log("Connection closed", e.code);
+  };
+
+  ws.onmessage = function (response) {
+    pushFrames(convertFrame(response.data), seconds);
+  };
+
+  INTERVALS.id = setInterval(function () {
+    if (STREAM.frames.length === 0) return;
+    draw(
+      {
+        frames: STREAM.frames,
+        channels: STREAM.channels,
+        latency: STREAM.latency,
+      },
+      seconds
+    );
+  }, REFRESH_INTERVAL * 1000);
+  console.log(
+    "Start interval for drawing the subscribed frames",
+    INTERVALS.id
+  );
+}
+
+/**
+ * Keep polling the frames from the data center,
+ * the polls share one connection, and the next poll is sent after the reply of the previous one,
+ * every poll requests the packages since the latest idx of the client-side buffer,
+ * the buffer is dropped if the data center replies the cursor is aged out.
+ */
+function polling() {
+  console.log("Polling");
+
+  const seconds = REQUEST_SECONDS;
+
+  stopRequesting();
+  resetStream();
+  STREAM.since = undefined;
+
+  // Whether the poll is waiting for its reply
+  let waiting = false;
+
   /**
-   * Request single frame and draw it into the canvas.
-   * The draw method is called to draw the frame.
+   * Connect the data center, the connection is opened again by the next poll if it is closed.
    */
-  function freshRequest() {
+  function connect() {
     const ws = new WebSocket("ws://localhost:23334/?accessToken=123456");
-
-    ws.onopen = function (e) {
-      // console.log("Connection established");
-      ws.send(seconds * POINTS_PER_SECOND);
-    };
+    ws.binaryType = "arraybuffer";
+    STREAM.ws = ws;
+    waiting = false;
 
     ws.onerror = function (e) {
       console.error("Connection error", e);
     };
 
     ws.onmessage = function (response) {
-      const { data } = response;
-      // console.log("Received", data.slice(0, 80));
-      draw(data, seconds);
+      waiting = false;
+
+      const converted = convertFrame(response.data);
+      if (converted.agedOut) {
+        resetStream();
+      }
+      if (converted.idx.length > 0) {
+        STREAM.since = converted.idx[converted.idx.length - 1];
+      }
+      pushFrames(converted, seconds);
+
+      if (STREAM.frames.length === 0) return;
+      draw(
+        {
+          frames: STREAM.frames,
+          channels: STREAM.channels,
+          latency: STREAM.latency,
+        },
+        seconds
+      );
     };
   }
 
-  // freshRequest();
+  /**
+   * Request the packages since the latest idx,
+   * it is skipped if the previous poll is waiting for its reply.
+   */
+  function freshRequest() {
+    const ws = STREAM.ws;
+    if (!ws || ws.readyState === WebSocket.CLOSING || ws.readyState === WebSocket.CLOSED) {
+      connect();
+      return;
+    }
+    if (ws.readyState !== WebSocket.OPEN || waiting) return;
+
+    waiting = true;
+    ws.send(
+      JSON.stringify({
+        latest: seconds * POINTS_PER_SECOND,
+        since: STREAM.since,
+        format: REQUEST_FORMAT,
+        device: DEVICE,
+      })
+    );
+  }
 
-  stopRequesting();
+  connect();
   INTERVALS.id = setInterval(freshRequest, REFRESH_INTERVAL * 1000);
   console.log(
     "Start interval for requesting and drawing the frames",
@@ -49,9 +222,125 @@ function requesting() {
 }
 
 /**
- * Stop the requesting interval timer
+ * Keep requesting the min/max envelope of the latest seconds,
+ * the envelope has one bucket for every pixel of the canvas,
+ * so the payload and the drawing do not grow with the seconds.
+ */
+function envelopeRequesting() {
+  console.log("Envelope requesting");
+
+  const seconds = ENVELOPE_SECONDS,
+    { width } = document.getElementById("canvas-1");
+
+  stopRequesting();
+
+  const ws = new WebSocket("ws://localhost:23334/?accessToken=123456");
+  ws.binaryType = "arraybuffer";
+  STREAM.ws = ws;
+
+  // Whether the request is waiting for its reply
+  let waiting = false;
+
+  ws.onerror = function (e) {
+    console.error("Connection error", e);
+  };
+
+  ws.onmessage = function (response) {
+    waiting = false;
+    drawEnvelope(decodeFrame(response.data), seconds);
+  };
+
+  INTERVALS.id = setInterval(function () {
+    // The tick is skipped if the previous request is waiting for its reply
+    if (ws.readyState !== WebSocket.OPEN || waiting) return;
+    waiting = true;
+    ws.send(
+      JSON.stringify({
+        type: "envelope",
+        seconds,
+        width,
+        format: "binary",
+        device: DEVICE,
+      })
+    );
+  }, REFRESH_INTERVAL * 1000);
+  console.log("Start interval for requesting the envelope", INTERVALS.id);
+}
+
+/**
+ * Draw the min/max envelope into the canvas,
+ * every channel is drawn as the filled band between its min and max.
+ *
+ * @param {} envelope The decoded envelope frame, its data rows are the min and max of the buckets in turn.
+ * @param {Int} seconds The seconds of displaying.
+ */
+function drawEnvelope(envelope, seconds) {
+  const { channels, samples, flags, query, query2, idx, data } = envelope;
+
+  if (!(flags & FRAME_ENVELOPE_FLAG)) {
+    console.warn("Not an envelope frame", flags);
+    return;
+  }
+
+  const buckets = samples / 2,
+    tStart = query[0],
+    tEnd = query2[0],
+    bucketSeconds = buckets > 0 ? (tEnd - tStart) / buckets : 0;
+
+  document.getElementById("span-1").innerHTML =
+    tEnd.toFixed(4) + " | " + buckets + " buckets of " + idx[0] + " samples";
+
+  const { width, height, ctx } = prepareCanvas(true);
+
+  const scaleOffsetY = d3
+      .scaleLinear()
+      .domain([-1, channels])
+      .range([0, height]),
+    scaleY = d3
+      .scaleLinear()
+      .domain([0, -2000])
+      .range([0, height / channels])
+      .nice(),
+    scaleX = d3
+      .scaleLinear()
+      .domain([tEnd - seconds, tEnd])
+      .range([0, width]);
+
+  for (let j = 0; j < channels; ++j) {
+    ctx.save();
+    ctx.translate(0, scaleOffsetY(j));
+    ctx.fillStyle = d3.schemePaired[(j * 2 + 1) % 6];
+    ctx.beginPath();
+
+    // The max from left to right, and the min from right to left
+    for (let i = 0; i < buckets; ++i) {
+      ctx.lineTo(
+        scaleX(tStart + i * bucketSeconds),
+        scaleY(data[(i * 2 + 1) * channels + j])
+      );
+    }
+    for (let i = buckets - 1; i >= 0; --i) {
+      ctx.lineTo(
+        scaleX(tStart + i * bucketSeconds),
+        scaleY(data[i * 2 * channels + j])
+      );
+    }
+
+    ctx.closePath();
+    ctx.fill();
+    ctx.restore();
+  }
+}
+
+/**
+ * Stop the requesting interval timer and the subscription
  */
 function stopRequesting() {
+  if (STREAM.ws) {
+    STREAM.ws.close();
+    STREAM.ws = undefined;
+  }
+
   if (INTERVALS.id) {
     clearInterval(INTERVALS.id);
     console.log("Stop interval", INTERVALS.id);
@@ -66,11 +355,11 @@ function stopRequesting() {
  * the frames is plotted into the canvas,
  * using the prepareCanvas.
  *
- * @param {Bytes} rawData , the received bytes from the server.
+ * @param {} converted , the {frames, channels, latency} converted by convertFrame.
  * @param {Int} seconds , How many seconds the data contains.
  */
-function draw(rawData, seconds) {
-  const { frames, channels, latency } = convertFrame(rawData);
+function draw(converted, seconds) {
+  const { frames, channels, latency } = converted;
 
   const { max, res, leftFrames, rightFrames } = divideFrames(frames, seconds);
   document.getElementById("span-1").innerHTML =
@@ -152,33 +441,120 @@ function draw(rawData, seconds) {
     return { max, res, leftFrames, rightFrames };
   }
 
-  /**
-   * Convert the bytes into the frames array.
-   *
-   * @param {Bytes} rawData The raw data to be parsed as the JSON object.
-   * @returns {} {frames, channels, latency} The latency is the array of the latency of the frames.
-   */
-  function convertFrame(rawData) {
-    const { data, query, query2 } = JSON.parse(rawData);
-
-    const frames = [],
-      latency = [];
-
-    // i: The index of the frame package;
-    // j: There are 40 frames in the package, each refers a frame.
-    for (let i in query) {
-      data[i].map((d, j) => {
-        frames.push({ t: query[i] + 0.001 * j, frame: d });
-        latency.push({ t: query[i], t2: query2[i] });
+}
+
+/**
+ * Convert the bytes into the frames array.
+ *
+ * @param {Bytes} rawData The raw data, the binary frame or the JSON string.
+ * @returns {} {frames, channels, latency, idx, agedOut} The latency is the array of the latency of the frames,
+ *             the idx is the array of the package ids, and the agedOut is whether the since cursor is aged out.
+ */
+function convertFrame(rawData) {
+  if (rawData instanceof ArrayBuffer) {
+    return convertBinaryFrame(rawData);
+  }
+
+  const { data, query, query2, idx = [], aged_out = false, sample_rate: sampleRate } =
+    JSON.parse(rawData);
+
+  const frames = [],
+    latency = [];
+
+  // i: The index of the frame package;
+  // j: There are samples frames in the package, each refers a frame.
+  for (let i in query) {
+    data[i].map((d, j) => {
+      frames.push({ t: query[i] + j / sampleRate, frame: d });
+      latency.push({ t: query[i], t2: query2[i] });
+    });
+  }
+
+  latency.map((d) => (d.latency = d.t2 - d.t));
+
+  const channels = frames.length > 0 ? frames[0].frame.length : 0;
+
+  return { frames, channels, latency, idx, agedOut: aged_out };
+}
+
+/**
+ * Convert the binary frame into the frames array,
+ * every frame is the subarray view of the samples.
+ *
+ * @param {ArrayBuffer} buffer The binary frame.
+ * @returns {} {frames, channels, latency, idx, agedOut} The latency is the array of the latency of the packages.
+ */
+function convertBinaryFrame(buffer) {
+  const { channels, packages, samples, sampleRate, flags, query, query2, idx, data } =
+    decodeFrame(buffer);
+
+  const frames = [],
+    latency = [];
+
+  for (let i = 0; i < packages; ++i) {
+    for (let j = 0; j < samples; ++j) {
+      const s = (i * samples + j) * channels;
+      frames.push({
+        t: query[i] + j / sampleRate,
+        frame: data.subarray(s, s + channels),
       });
     }
+    latency.push({ t: query[i], t2: query2[i], latency: query2[i] - query[i] });
+  }
 
-    latency.map((d) => (d.latency = d.t2 - d.t));
+  return { frames, channels, latency, idx, agedOut: (flags & FRAME_AGED_OUT_FLAG) > 0 };
+}
 
-    const channels = frames[0].frame.length;
+/**
+ * Decode the binary frame of the data center,
+ * the blocks are typed-array views of the buffer without copying.
+ *
+ * b'EPDF' + version (u8) + dtype (u8) + channels (u16) + packages (u32) + samples (u32) + sampleRate (u32) + flags (u32),
+ * query (f64 x packages), query2 (f64 x packages), idx (u32 x packages),
+ * data (i32 or f32 x packages x samples x channels).
+ *
+ * @param {ArrayBuffer} buffer The binary frame.
+ * @returns {} {version, channels, packages, samples, sampleRate, flags, query, query2, idx, data}
+ */
+function decodeFrame(buffer) {
+  const view = new DataView(buffer),
+    magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
 
-    return { frames, channels, latency };
+  if (magic !== "EPDF") {
+    throw new Error("Invalid frame magic: " + magic);
   }
+
+  const version = view.getUint8(4),
+    dtype = view.getUint8(5),
+    channels = view.getUint16(6, true),
+    packages = view.getUint32(8, true),
+    samples = view.getUint32(12, true),
+    sampleRate = view.getUint32(16, true),
+    flags = view.getUint32(20, true);
+
+  let offset = 24;
+  const query = new Float64Array(buffer, offset, packages);
+  offset += packages * 8;
+  const query2 = new Float64Array(buffer, offset, packages);
+  offset += packages * 8;
+  const idx = new Uint32Array(buffer, offset, packages);
+  offset += packages * 4;
+
+  const DataArray = [Int32Array, Float32Array, Int16Array][dtype];
+  const data = new DataArray(buffer, offset, packages * samples * channels);
+
+  return {
+    version,
+    channels,
+    packages,
+    samples,
+    sampleRate,
+    flags,
+    query,
+    query2,
+    idx,
+    data,
+  };
 }
 
 /**